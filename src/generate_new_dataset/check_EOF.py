@@ -29,20 +29,20 @@ src_dir = str(Path(script_dir).parents[1])
 sys.path.append(src_dir)
 
 from src.vulcan_configs.vulcan_config_utils import CopyManager
+from src.vulcan_configs.vul_reader import check_vul
 from src.neural_net.dataset_utils import unscale_example, create_scaling_dict, scale_dataset
 from src.neural_net.dataloaders import SingleVulcanDataset
 from src.neural_net.interpolate_dataset import interpolate_dataset
 
 def check_EOF(vul_file,vul_name):
-    try:
-        with open(vul_file, 'rb') as handle:
-            data = pickle.load(handle)
+    # walks the pickle opcodes up to the final STOP instead of unpickling the whole output
+    if check_vul(vul_file):
         return False
-    except EOFError:
-        print(
-            f"\n################## EOFError! ##################"
-            f"\n{vul_name}")
-        return True
+
+    print(
+        f"\n################## EOFError! ##################"
+        f"\n{vul_name}")
+    return True
 
 def generate_input_output_pair(params):
     """
@@ -37,21 +37,24 @@ class LossWeightScheduler:
 
 # move non-tensor objects to the gpu
 # from https://discuss.pytorch.org/t/pytorch-tensor-to-device-for-a-list-of-dict/66283/2
-def move_to(obj, device):
+# floating point tensors are also cast to dtype if given
+def move_to(obj, device, dtype=None):
     if torch.is_tensor(obj):
+        if dtype is not None and obj.is_floating_point():
+            return obj.to(device=device, dtype=dtype)
         return obj.to(device)
     elif isinstance(obj, dict):
         res = {}
         for k, v in obj.items():
-            res[k] = move_to(v, device)
+            res[k] = move_to(v, device, dtype)
         return res
     elif isinstance(obj, list):
         res = []
         for v in obj:
-            res.append(move_to(v, device))
+            res.append(move_to(v, device, dtype))
         return res
     elif isinstance(obj, float) or isinstance(obj, int):
-        return move_to(torch.tensor(obj), device)
+        return move_to(torch.tensor(obj), device, dtype)
     else:
         raise TypeError("Invalid type for move_to")
 
@@ -14,7 +14,7 @@ src_dir = str(Path(script_dir).parents[2])
 sys.path.append(src_dir)
 
 from src.neural_nets.dataloaders import SingleVulcanDataset
-from src.neural_nets.dataset_utils import make_data_loaders
+from src.neural_nets.dataset_utils import make_data_loaders, dataset_constants, add_constants
 from src.neural_nets.NN_utils import move_to, plot_core_y_mixs, weight_decay
 
 from src.neural_nets.core.ae_params import ae_params
@@ -31,24 +31,21 @@ def loss_fn(x, y):
 
 
 def encode_y_mixs(device, y_mixs, mrae_model):
-    # mixing ratio's
-    y_mixs_latent = torch.zeros(y_mixs.shape[0], mrae_model.latent_dim, y_mixs.shape[2]).double().to(
-        device)  # [b, mrae_latent_dim, num_species]
-    for i_y in range(y_mixs.shape[-1]):
-        y_mix = y_mixs[:, :, i_y]  # [b, height_layers]
-        y_mixs_latent[:, :, i_y] = mrae_model.encode(y_mix)
-    y_mixs_latent = y_mixs_latent.flatten(start_dim=1)  # [b, num_species * mrae_latent_dim]
+    # mixing ratio's, all species (and time steps) through the shared MRAE in one batch
+    species_first = y_mixs.movedim(-1, -2)  # [b, (time_steps,) num_species, height_layers]
+    y_mixs_latent = mrae_model.encode(species_first.reshape(-1, species_first.shape[-1]))  # [b*..., mrae_latent_dim]
+    y_mixs_latent = y_mixs_latent.reshape(*species_first.shape[:-1], mrae_model.latent_dim).movedim(-1, -2)
+    y_mixs_latent = y_mixs_latent.flatten(start_dim=-2)  # [b, (time_steps,) num_species * mrae_latent_dim]
     return y_mixs_latent
 
 
 def decode_y_mixs(device, y_mixs_latent, mrae_model, num_species):
-    # mixing ratio's
-    y_mixs = torch.zeros(y_mixs_latent.shape[0], 150, num_species).double().to(device)  # [b, 150, num_species]
-    y_mixs_latent = y_mixs_latent.reshape(y_mixs_latent.shape[0], mrae_model.latent_dim,
+    # mixing ratio's, all species through the shared MRAE in one batch
+    y_mixs_latent = y_mixs_latent.reshape(*y_mixs_latent.shape[:-1], mrae_model.latent_dim,
                                           num_species)  # [b, mrae_latent_dim, num_species]
-    for i_y in range(y_mixs_latent.shape[-1]):
-        y_mix_latent = y_mixs_latent[:, :, i_y]  # [b, mrae_latent_dim]
-        y_mixs[:, :, i_y] = mrae_model.decode(y_mix_latent)
+    species_first = y_mixs_latent.movedim(-1, -2)  # [b, num_species, mrae_latent_dim]
+    y_mixs = mrae_model.decode(species_first.reshape(-1, mrae_model.latent_dim))  # [b*num_species, 150]
+    y_mixs = y_mixs.reshape(*species_first.shape[:-1], y_mixs.shape[-1]).movedim(-1, -2)  # [b, 150, num_species]
     return y_mixs
 
 
@@ -67,24 +64,25 @@ def initialize_models(device, models, state_dicts, model_params, save_model_dir)
     return initialized_models
 
 
-def encode_inputs_outputs(device, ae_models, example, time_series=False):
+def encode_inputs_outputs(device, ae_models, example, time_series=False, constants=None):
     # extract inputs
     inputs = move_to(example['inputs'], device)
     outputs = move_to(example['outputs'], device)
 
+    # broadcast the fields that are the same for every example (already on device), e.g. wavelengths
+    if constants:
+        batch_size = next(iter(example['outputs'].values())).shape[0]
+        inputs = add_constants(inputs, constants.get('inputs'), batch_size)
+        outputs = add_constants(outputs, constants.get('outputs'), batch_size)
+
     # encode individual parts for input and output example
 
     # mixing ratio's
     y_mixs_latent_inputs = encode_y_mixs(device, inputs['y_mix_ini'], ae_models['mrae'])
 
     if time_series:
-        y_mixs = outputs['y_mixs']
-        y_mixs_latent_outputs = torch.zeros(y_mixs.shape[0], y_mixs.shape[1],
-                                            # [b, time_steps, mrae_latent_dim*num_species]
-                                            ae_models['mrae'].latent_dim * y_mixs.shape[-1]).double().to(device)
-        for i_y_mix in range(y_mixs.shape[1]):
-            y_mixs_latent = encode_y_mixs(device, y_mixs[:, i_y_mix, :, :], ae_models['mrae'])
-            y_mixs_latent_outputs[:, i_y_mix, :] = y_mixs_latent
+        # [b, time_steps, mrae_latent_dim*num_species]
+        y_mixs_latent_outputs = encode_y_mixs(device, outputs['y_mixs'], ae_models['mrae'])
     else:
         y_mixs_latent_outputs = encode_y_mixs(device, outputs['y_mix'], ae_models['mrae'])
 
@@ -133,6 +131,9 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
                                                                      os.path.join(dataset_dir, 'interpolated_dataset/'),
                                                                      **params['ds_params'])
 
+    # fields that are the same for every example, only moved to the device once
+    constants = move_to(dataset_constants(train_loader.dataset), device)
+
     # initialize core model
     core_model = params['core_model'](
         **params['core_model_params'],
@@ -219,7 +220,8 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
 
             for n_iter, example in enumerate(train_epoch):
                 latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
-                                                                            time_series=time_series)
+                                                                            time_series=time_series,
+                                                                            constants=constants)
 
                 # add noise
                 if noise is not None:
@@ -256,7 +258,8 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
 
             for n_iter, example in enumerate(test_epoch):
                 latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
-                                                                            time_series=time_series)
+                                                                            time_series=time_series,
+                                                                            constants=constants)
 
                 # add noise
                 if noise is not None:
@@ -274,7 +277,8 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
         # show matplotlib graph every 10 epochs
         if epoch % 10 == 0 or epoch == epochs - 1:
             latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
-                                                                        time_series=time_series)
+                                                                        time_series=time_series,
+                                                                        constants=constants)
 
             if time_series:
                 loss, latent_model_output = params['core_model_step'](
@@ -329,7 +333,8 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
 
         for n_iter, example in enumerate(validation):
             latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
-                                                                        time_series=time_series)
+                                                                        time_series=time_series,
+                                                                        constants=constants)
 
             # add noise
             if noise is not None:
@@ -31,7 +31,7 @@ class GRUCore(nn.Module):
         )
 
     def init_hidden(self, batch_size, device):
-        return torch.zeros(1, batch_size, self.hidden_size, device=device, dtype=torch.double)
+        return torch.zeros(1, batch_size, self.hidden_size, device=device, dtype=self.out[0].weight.dtype)
 
     def forward(self, input, hidden):
         output, hidden = self.gru(
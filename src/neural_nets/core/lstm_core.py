@@ -43,6 +43,6 @@ class LSTMCore(nn.Module):
         return output, hidden, cell
 
     def init_hidden_cell(self, batch_size, device):
-        init_hidden = torch.zeros(1, batch_size, self.hidden_size, device=device, dtype=torch.double)
-        init_cell = torch.zeros(1, batch_size, self.hidden_size, device=device, dtype=torch.double)
+        init_hidden = torch.zeros(1, batch_size, self.hidden_size, device=device, dtype=self.out[0].weight.dtype)
+        init_cell = torch.zeros(1, batch_size, self.hidden_size, device=device, dtype=self.out[0].weight.dtype)
         return init_hidden, init_cell
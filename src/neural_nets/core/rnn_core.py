@@ -44,4 +44,4 @@ class RNNCore(nn.Module):
         return output, hidden
 
     def init_hidden(self, batch_size, device):
-        return torch.zeros(1, batch_size, self.hidden_size, device=device, dtype=torch.double)
+        return torch.zeros(1, batch_size, self.hidden_size, device=device, dtype=self.out[0].weight.dtype)
@@ -4,18 +4,22 @@ from pathlib import Path
 
 from tqdm import tqdm
 import torch
+from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from datetime import datetime
 import pickle
+import hashlib
 
 # own modules
 script_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = str(Path(script_dir).parents[2])
 sys.path.append(src_dir)
 
-from src.neural_nets.dataloaders import SingleVulcanDataset
-from src.neural_nets.dataset_utils import make_data_loaders
+from src.neural_nets.dataloaders import LatentVulcanDataset, vulcan_dataset_class
+from src.neural_nets.dataset_utils import make_data_loaders, dataset_constants, add_constants, PackedDatasetWriter, \
+    to_dtype
 from src.neural_nets.NN_utils import move_to, plot_core_y_mixs, weight_decay
+from src.neural_nets.precision import PrecisionPolicy, parity_error, PARITY_TOLERANCE
 
 from src.neural_nets.core_new.ae_params import ae_params
 from src.neural_nets.core_new.gaussian_noise import GaussianNoise
@@ -31,32 +35,29 @@ def loss_fn(x, y):
 
 
 def encode_y_mixs(device, y_mixs, mrae_model):
-    # mixing ratio's
-    y_mixs_latent = torch.zeros(y_mixs.shape[0], mrae_model.latent_dim, y_mixs.shape[2]).double().to(
-        device)  # [b, mrae_latent_dim, num_species]
-    for i_y in range(y_mixs.shape[-1]):
-        y_mix = y_mixs[:, :, i_y]  # [b, height_layers]
-        y_mixs_latent[:, :, i_y] = mrae_model.encode(y_mix)
-    y_mixs_latent = y_mixs_latent.flatten(start_dim=1)  # [b, num_species * mrae_latent_dim]
+    # mixing ratio's, all species (and time steps) through the shared MRAE in one batch
+    species_first = y_mixs.movedim(-1, -2)  # [b, (time_steps,) num_species, height_layers]
+    y_mixs_latent = mrae_model.encode(species_first.reshape(-1, species_first.shape[-1]))  # [b*..., mrae_latent_dim]
+    y_mixs_latent = y_mixs_latent.reshape(*species_first.shape[:-1], mrae_model.latent_dim).movedim(-1, -2)
+    y_mixs_latent = y_mixs_latent.flatten(start_dim=-2)  # [b, (time_steps,) num_species * mrae_latent_dim]
     return y_mixs_latent
 
 
 def decode_y_mixs(device, y_mixs_latent, mrae_model, num_species):
-    # mixing ratio's
-    y_mixs = torch.zeros(y_mixs_latent.shape[0], 150, num_species).double().to(device)  # [b, 150, num_species]
-    y_mixs_latent = y_mixs_latent.reshape(y_mixs_latent.shape[0], mrae_model.latent_dim,
+    # mixing ratio's, all species through the shared MRAE in one batch
+    y_mixs_latent = y_mixs_latent.reshape(*y_mixs_latent.shape[:-1], mrae_model.latent_dim,
                                           num_species)  # [b, mrae_latent_dim, num_species]
-    for i_y in range(y_mixs_latent.shape[-1]):
-        y_mix_latent = y_mixs_latent[:, :, i_y]  # [b, mrae_latent_dim]
-        y_mixs[:, :, i_y] = mrae_model.decode(y_mix_latent)
+    species_first = y_mixs_latent.movedim(-1, -2)  # [b, num_species, mrae_latent_dim]
+    y_mixs = mrae_model.decode(species_first.reshape(-1, mrae_model.latent_dim))  # [b*num_species, 150]
+    y_mixs = y_mixs.reshape(*species_first.shape[:-1], y_mixs.shape[-1]).movedim(-1, -2)  # [b, 150, num_species]
     return y_mixs
 
 
-def initialize_models(device, models, state_dicts, model_params, save_model_dir):
+def initialize_models(device, models, state_dicts, model_params, save_model_dir, dtype=torch.double):
     initialized_models = {}
 
     for key in models.keys():
-        model = models[key](**model_params[key]).double().to(device)
+        model = models[key](**model_params[key]).to(device=device, dtype=dtype)
         if state_dicts[key] is not None:
             model.load_state_dict(
                 torch.load(os.path.join(save_model_dir, state_dicts[key]), map_location=device)
@@ -67,27 +68,39 @@ def initialize_models(device, models, state_dicts, model_params, save_model_dir)
     return initialized_models
 
 
-def encode_inputs_outputs(device, ae_models, example, time_series=False):
+def encode_inputs_outputs(device, ae_models, example, time_series=False, constants=None):
+    # precomputed latent example (see make_latent_dataset), the autoencoders are frozen
+    if 'latent' in example:
+        latent = move_to(example['latent'], device)
+        return latent['input'], latent['output']
+
     # extract inputs
     inputs = move_to(example['inputs'], device)
     outputs = move_to(example['outputs'], device)
 
+    # broadcast the fields that are the same for every example (already on device), e.g. wavelengths
+    if constants:
+        batch_size = next(iter(example['outputs'].values())).shape[0]
+        inputs = add_constants(inputs, constants.get('inputs'), batch_size)
+        outputs = add_constants(outputs, constants.get('outputs'), batch_size)
+
     # encode individual parts for input and output example
+    latent_input = encode_inputs(device, ae_models, inputs)
 
     # mixing ratio's
-    y_mixs_latent_inputs = encode_y_mixs(device, inputs['y_mix_ini'], ae_models['mrae'])
-
     if time_series:
-        y_mixs = outputs['y_mixs']
-        y_mixs_latent_outputs = torch.zeros(y_mixs.shape[0], y_mixs.shape[1],
-                                            # [b, time_steps, mrae_latent_dim*num_species]
-                                            ae_models['mrae'].latent_dim * y_mixs.shape[-1]).double().to(device)
-        for i_y_mix in range(y_mixs.shape[1]):
-            y_mixs_latent = encode_y_mixs(device, y_mixs[:, i_y_mix, :, :], ae_models['mrae'])
-            y_mixs_latent_outputs[:, i_y_mix, :] = y_mixs_latent
+        # [b, time_steps, mrae_latent_dim*num_species]
+        y_mixs_latent_outputs = encode_y_mixs(device, outputs['y_mixs'], ae_models['mrae'])
     else:
         y_mixs_latent_outputs = encode_y_mixs(device, outputs['y_mix'], ae_models['mrae'])
 
+    return latent_input, y_mixs_latent_outputs
+
+
+def encode_inputs(device, ae_models, inputs):
+    # mixing ratio's
+    y_mixs_latent_inputs = encode_y_mixs(device, inputs['y_mix_ini'], ae_models['mrae'])
+
     # flux
     flux_latent_inputs = ae_models['fae'].encode(inputs['top_flux'])
 
@@ -105,7 +118,82 @@ def encode_inputs_outputs(device, ae_models, example, time_series=False):
         inputs["wavelengths"]),
         dim=1)  # [b, latent_dim]
 
-    return latent_input, y_mixs_latent_outputs
+    return latent_input
+
+
+def latent_cache_key(dataset_dir, ae_models, time_series):
+    """
+    Hash of everything the latent dataset depends on: the autoencoder weights, the time_series flag and the
+    dataset (index, scaling and species cut, and the interpolated examples).
+    """
+    key = hashlib.sha1()
+    key.update(str(time_series).encode())
+
+    for name, model in sorted(ae_models.items()):
+        key.update(name.encode())
+        for param_name, value in model.state_dict().items():
+            key.update(param_name.encode())
+            key.update(value.detach().cpu().numpy().tobytes())
+
+    for filename in ['index_dict.pkl', 'scaling_dict.pkl', 'species_idx.pkl']:
+        file = os.path.join(dataset_dir, filename)
+        if os.path.isfile(file):
+            with open(file, 'rb') as f:
+                key.update(f.read())
+
+    # the interpolated examples, by the layout of a packed dataset and the name, size and mtime of every file
+    # (field arrays, constants or .pt examples), so a regenerated dataset is encoded again
+    interp_ds_dir = os.path.join(dataset_dir, 'interpolated_dataset')
+    packed_index_file = os.path.join(interp_ds_dir, 'packed_index.pkl')
+    if os.path.isfile(packed_index_file):
+        with open(packed_index_file, 'rb') as f:
+            key.update(f.read())
+    if os.path.isdir(interp_ds_dir):
+        with os.scandir(interp_ds_dir) as entries:
+            for entry in sorted((entry for entry in entries if entry.is_file()), key=lambda entry: entry.name):
+                stat = entry.stat()
+                key.update(f'{entry.name},{stat.st_size},{stat.st_mtime_ns}'.encode())
+
+    return key.hexdigest()[:16]
+
+
+def make_latent_dataset(dataset_dir, ae_models, device, time_series=False, batch_size=64, num_workers=0,
+                        dtype=torch.double, memmap=False):
+    """
+    Encode the interpolated dataset once with the (frozen) autoencoders, into a packed dataset of latent inputs
+    and outputs in dataset_dir/latent_dataset_{key}. The key changes with the autoencoder weights (see
+    latent_cache_key), so a new checkpoint is encoded again and an existing latent dataset is reused.
+
+    Returns:
+        latent_ds_dir: str, load with LatentVulcanDataset
+    """
+    latent_ds_dir = os.path.join(dataset_dir, f'latent_dataset_{latent_cache_key(dataset_dir, ae_models, time_series)}')
+    if os.path.isfile(os.path.join(latent_ds_dir, 'packed_index.pkl')):
+        print(f'using latent dataset {latent_ds_dir}')
+        return latent_ds_dir
+    os.makedirs(latent_ds_dir, exist_ok=True)
+
+    interp_ds_dir = os.path.join(dataset_dir, 'interpolated_dataset/')
+    vulcan_dataset = vulcan_dataset_class(interp_ds_dir, memmap=memmap)(interp_ds_dir)
+    vulcan_dataset.dtype = dtype
+    constants = move_to(dataset_constants(vulcan_dataset), device, dtype)
+    dataloader = DataLoader(vulcan_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    writer = PackedDatasetWriter(latent_ds_dir, len(vulcan_dataset), detect_constants=False)
+    idx = 0
+    with torch.no_grad():
+        for example in tqdm(dataloader, desc='encoding latent dataset'):
+            latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
+                                                                        time_series=time_series,
+                                                                        constants=constants)
+            for latent_input_row, latent_output_row in zip(latent_input.cpu(), y_mixs_latent_outputs.cpu()):
+                writer.write(idx, {'latent': {'input': latent_input_row, 'output': latent_output_row}})
+                idx += 1
+
+    # the index is written last, an interrupted encoding is redone
+    writer.close()
+
+    return latent_ds_dir
 
 
 def train_core(dataset_dir, save_model_dir, log_dir, params):
@@ -120,21 +208,44 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f'running on device: {device}')
 
-    # load datasets
-    train_loader, test_loader, validation_loader = make_data_loaders(SingleVulcanDataset,
-                                                                     os.path.join(dataset_dir, 'interpolated_dataset/'),
-                                                                     **params['ds_params'])
+    # precision of the models and data, 'fp64', 'fp32', 'bf16' or 'fp16' (see PrecisionPolicy)
+    precision = PrecisionPolicy(params.get('precision', 'fp64'), device)
+    print(f'training with precision: {precision.precision}')
+
+    # Initialize models with the precision dtype
+    ae_models = initialize_models(device, ae_params['models'], ae_params['state_dicts'], ae_params['model_params'],
+                                  save_model_dir, dtype=precision.dtype)
+
+    # load datasets, with the autoencoders frozen the examples can be encoded once beforehand
+    # a packed interpolated dataset is read into memory, or memory-mapped with the memmap train param
+    memmap = params['train_params'].get('memmap', False)
+    latent_cache = params['train_params'].get('latent_cache', False)
+    if latent_cache and params['core_model_params']['sigma'] > 0:
+        # keep the noisy runs on the encode per batch path they were tuned with
+        print('input noise (sigma > 0) is configured, not using the latent cache')
+        latent_cache = False
+
+    if latent_cache:
+        latent_ds_dir = make_latent_dataset(dataset_dir, ae_models, device,
+                                            time_series=params['core_model_params']['time_series'],
+                                            dtype=precision.dtype, memmap=memmap)
+        train_loader, test_loader, validation_loader = make_data_loaders(LatentVulcanDataset, latent_ds_dir,
+                                                                         **params['ds_params'], dtype=precision.dtype)
+    else:
+        interp_ds_dir = os.path.join(dataset_dir, 'interpolated_dataset/')
+        train_loader, test_loader, validation_loader = make_data_loaders(vulcan_dataset_class(interp_ds_dir, memmap),
+                                                                         interp_ds_dir,
+                                                                         **params['ds_params'], dtype=precision.dtype)
+
+    # fields that are the same for every example, only moved to the device once
+    constants = move_to(dataset_constants(train_loader.dataset), device, precision.dtype)
 
     # initialize core model
-    core_model = params['core_model'](
+    core_model = precision.model(params['core_model'](
         **params['core_model_params'],
         **params['core_model_extra_params'],
         device=device
-    ).double().to(device)
-
-    # Initialize models with double precision
-    ae_models = initialize_models(device, ae_params['models'], ae_params['state_dicts'], ae_params['model_params'],
-                                  save_model_dir)
+    ))
 
     # Create optimizer and add weight decay if applicable
     if params['core_model_params']['weight_decay_norm'] > 0:
@@ -210,24 +321,25 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
             tot_loss = 0
 
             for n_iter, example in enumerate(train_epoch):
-                latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
-                                                                            time_series=time_series)
-
-                # add noise
-                if noise is not None:
-                    latent_input = noise(latent_input)
-
-                if time_series:
-                    loss, latent_model_output = params['core_model_step'](
-                        latent_input, y_mixs_latent_outputs, core_model, loss_fn, device=device)
-                else:
-                    latent_model_output = params['core_model_step'](latent_input, core_model, device=device)
-                    loss = loss_fn(latent_model_output, y_mixs_latent_outputs)
+                with precision.autocast():
+                    latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
+                                                                                time_series=time_series,
+                                                                                constants=constants)
+
+                    # add noise
+                    if noise is not None:
+                        latent_input = noise(latent_input)
+
+                    if time_series:
+                        loss, latent_model_output = params['core_model_step'](
+                            latent_input, y_mixs_latent_outputs, core_model, loss_fn, device=device)
+                    else:
+                        latent_model_output = params['core_model_step'](latent_input, core_model, device=device)
+                        loss = loss_fn(latent_model_output, y_mixs_latent_outputs)
 
                 # update gradients
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                precision.backward_step(loss, optimizer)
 
                 tot_loss += loss.detach()
 
@@ -247,26 +359,29 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
             tot_loss = 0
 
             for n_iter, example in enumerate(test_epoch):
-                latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
-                                                                            time_series=time_series)
-
-                # add noise
-                if noise is not None:
-                    latent_input = noise(latent_input)
-
-                if time_series:
-                    loss, latent_model_output = params['core_model_step'](
-                        latent_input, y_mixs_latent_outputs, core_model, loss_fn, device=device)
-                else:
-                    latent_model_output = params['core_model_step'](latent_input, core_model, device=device)
-                    loss = loss_fn(latent_model_output, y_mixs_latent_outputs)
+                with precision.autocast():
+                    latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
+                                                                                time_series=time_series,
+                                                                                constants=constants)
+
+                    # add noise
+                    if noise is not None:
+                        latent_input = noise(latent_input)
+
+                    if time_series:
+                        loss, latent_model_output = params['core_model_step'](
+                            latent_input, y_mixs_latent_outputs, core_model, loss_fn, device=device)
+                    else:
+                        latent_model_output = params['core_model_step'](latent_input, core_model, device=device)
+                        loss = loss_fn(latent_model_output, y_mixs_latent_outputs)
 
                 tot_loss += loss.detach()
 
         # show matplotlib graph every 10 epochs
         if epoch % 10 == 0 or epoch == epochs - 1:
             latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
-                                                                        time_series=time_series)
+                                                                        time_series=time_series,
+                                                                        constants=constants)
 
             if time_series:
                 loss, latent_model_output = params['core_model_step'](
@@ -320,19 +435,21 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
         tot_loss = 0
 
         for n_iter, example in enumerate(validation):
-            latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
-                                                                        time_series=time_series)
+            with precision.autocast():
+                latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
+                                                                            time_series=time_series,
+                                                                            constants=constants)
 
-            # add noise
-            if noise is not None:
-                latent_input = noise(latent_input)
+                # add noise
+                if noise is not None:
+                    latent_input = noise(latent_input)
 
-            if time_series:
-                loss, latent_model_output = params['core_model_step'](
-                    latent_input, y_mixs_latent_outputs, core_model, loss_fn, device=device)
-            else:
-                latent_model_output = params['core_model_step'](latent_input, core_model, device=device)
-                loss = loss_fn(latent_model_output, y_mixs_latent_outputs)
+                if time_series:
+                    loss, latent_model_output = params['core_model_step'](
+                        latent_input, y_mixs_latent_outputs, core_model, loss_fn, device=device)
+                else:
+                    latent_model_output = params['core_model_step'](latent_input, core_model, device=device)
+                    loss = loss_fn(latent_model_output, y_mixs_latent_outputs)
 
             tot_loss += loss.detach()
 
@@ -341,6 +458,47 @@ def train_core(dataset_dir, save_model_dir, log_dir, params):
 
     metric_dict = {"Validation/loss": validation_loss}
 
+    # accuracy parity of the precision with the same core model trained in fp64, on the validation loss
+    reference_file = params['train_params'].get('fp64_reference', None)
+    if precision.precision != 'fp64' and reference_file is not None:
+        reference_model = params['core_model'](
+            **params['core_model_params'],
+            **params['core_model_extra_params'],
+            device=device
+        ).to(device=device, dtype=torch.float64)
+        reference_model.load_state_dict(torch.load(reference_file, map_location=device))
+
+        def validation_loss(model, dtype, autocast):
+            # without noise, both models get the same latent inputs (encoded with the precision policy)
+            model.eval()
+            tot_loss = 0
+            with torch.no_grad():
+                for example in tqdm(validation_loader, unit='batch', desc='Validation parity'):
+                    with precision.autocast():
+                        latent_input, y_mixs_latent_outputs = encode_inputs_outputs(device, ae_models, example,
+                                                                                    time_series=time_series,
+                                                                                    constants=constants)
+                    latent_input = to_dtype(latent_input, dtype)
+                    y_mixs_latent_outputs = to_dtype(y_mixs_latent_outputs, dtype)
+
+                    with autocast():
+                        if time_series:
+                            loss, _ = params['core_model_step'](
+                                latent_input, y_mixs_latent_outputs, model, loss_fn, device=device)
+                        else:
+                            latent_model_output = params['core_model_step'](latent_input, model, device=device)
+                            loss = loss_fn(latent_model_output, y_mixs_latent_outputs)
+
+                    tot_loss += loss.item()
+            return tot_loss / len(validation_loader)
+
+        parity, parity_loss, reference_loss = parity_error(validation_loss, core_model, reference_model, precision)
+        metric_dict["Validation/parity_error"] = parity
+        print(f'validation loss {parity_loss:.4e}, fp64 reference {reference_loss:.4e}, relative difference '
+              f'{parity:.3e} (tolerance {PARITY_TOLERANCE})')
+        if parity > PARITY_TOLERANCE:
+            print(f'WARNING: {precision.precision} training is less accurate than fp64 training')
+
     # add hyperparameters
     writer.add_hparams(
         hparams,
@@ -26,6 +26,6 @@ class GaussianNoise(nn.Module):
     def forward(self, x):
         if self.training and self.sigma != 0:
             scale = self.sigma * x.detach() if self.is_relative_detach else self.sigma * x
-            sampled_noise = self.noise.repeat(*x.size()).normal_() * scale
+            sampled_noise = self.noise.to(x.dtype).repeat(*x.size()).normal_() * scale
             x = x + sampled_noise
         return x
@@ -100,9 +100,14 @@ def main():
             'lr': 1e-4
         },
 
+        # 'fp64', 'fp32', 'bf16' or 'fp16'
+        precision='fp64',
+
         train_params={
             'epochs': 100,
             'writer_interval': 10,
+            'fp64_reference': None,    # state dict of this model trained in fp64, to check a lower precision
+            'latent_cache': False,    # encode the dataset once with the frozen autoencoders (not with sigma > 0)
         },
     )
 
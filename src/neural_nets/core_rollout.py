@@ -0,0 +1,341 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# own modules
+script_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = str(Path(script_dir).parents[1])
+sys.path.append(src_dir)
+
+
+def check_recurrent_layer(layer):
+    if layer.num_layers != 1 or layer.bidirectional or not layer.bias or not layer.batch_first:
+        raise ValueError('fused rollout only supports single layer, unidirectional, batch_first cores with bias')
+
+
+def output_activation(core_model):
+    """
+    (tanh, negative_slope) of the activation of core_model.out, which is nn.Tanh or nn.LeakyReLU.
+    """
+    activation = core_model.out[1]
+    if isinstance(activation, nn.Tanh):
+        return True, 0.
+    if isinstance(activation, nn.LeakyReLU):
+        return False, activation.negative_slope
+    raise ValueError(f'activation function not supported: {activation}')
+
+
+class FusedRollout(nn.Module):
+    """
+    Inference rollout of a recurrent core (LSTMCore, GRUCore or RNNCore) for core_model.steps steps, like
+    model_step in train_lstm_core.py but without the per step overhead: the cell and the output projection are
+    computed with addmm into preallocated buffers and the output of a step is written in place as the input of
+    the next step.
+
+    The weights are copied from the core when the rollout is made, so make a new rollout after training.
+    """
+
+    def __init__(self, core_model):
+        super().__init__()
+        self.input_size = core_model.input_size
+        self.hidden_size = core_model.hidden_size
+        self.output_size = core_model.output_size
+        self.steps = core_model.steps
+        self.tanh, self.negative_slope = output_activation(core_model)
+
+        with torch.no_grad():
+            # transposed, so the projection is addmm(bias, hidden, out_weight)
+            self.register_buffer('out_weight', core_model.out[0].weight.detach().t().contiguous())
+            self.register_buffer('out_bias', core_model.out[0].bias.detach().clone())
+
+    def activation_(self, x):
+        if self.tanh:
+            x.tanh_()
+        else:
+            F.leaky_relu(x, self.negative_slope, inplace=True)
+
+
+class FusedLSTMRollout(FusedRollout):
+    def __init__(self, core_model):
+        super().__init__(core_model)
+        lstm = core_model.lstm
+        check_recurrent_layer(lstm)
+
+        with torch.no_grad():
+            # [input, hidden] @ weight gives all gates in one matmul
+            weight = torch.cat([lstm.weight_ih_l0, lstm.weight_hh_l0], dim=1)
+            self.register_buffer('weight', weight.detach().t().contiguous())    # (input + hidden, 4 * hidden)
+            self.register_buffer('bias', (lstm.bias_ih_l0 + lstm.bias_hh_l0).detach())
+
+    def forward(self, latent_input):
+        """
+        Args:
+            latent_input: (b, input_size)
+
+        Returns:
+            outputs: (b, steps, output_size), the output of every step
+        """
+        with torch.no_grad():
+            batch_size = latent_input.shape[0]
+            hs = self.hidden_size
+
+            # input and hidden state side by side, x and h are views
+            xh = latent_input.new_zeros(batch_size, self.input_size + hs)
+            xh[:, :self.input_size] = latent_input
+            x = xh[:, :self.input_size]
+            h = xh[:, self.input_size:]
+            cell = latent_input.new_zeros(batch_size, hs)
+            gates = latent_input.new_empty(batch_size, 4 * hs)
+            outputs = latent_input.new_empty(batch_size, self.steps, self.output_size)
+
+            for step in range(self.steps):
+                torch.addmm(self.bias, xh, self.weight, out=gates)
+
+                # input, forget, cell and output gates (same order as nn.LSTM)
+                gates[:, :2 * hs].sigmoid_()
+                gates[:, 2 * hs:3 * hs].tanh_()
+                gates[:, 3 * hs:].sigmoid_()
+
+                cell.mul_(gates[:, hs:2 * hs]).addcmul_(gates[:, :hs], gates[:, 2 * hs:3 * hs])
+                torch.tanh(cell, out=h)
+                h.mul_(gates[:, 3 * hs:])
+
+                # output is the next input
+                torch.addmm(self.out_bias, h, self.out_weight, out=x)
+                self.activation_(x)
+                outputs[:, step] = x[:, :self.output_size]
+
+        return outputs
+
+
+class FusedGRURollout(FusedRollout):
+    def __init__(self, core_model):
+        super().__init__(core_model)
+        gru = core_model.gru
+        check_recurrent_layer(gru)
+
+        with torch.no_grad():
+            # input and hidden are kept apart, the new gate only uses the reset part of the hidden
+            self.register_buffer('weight_ih', gru.weight_ih_l0.detach().t().contiguous())    # (input, 3 * hidden)
+            self.register_buffer('weight_hh', gru.weight_hh_l0.detach().t().contiguous())    # (hidden, 3 * hidden)
+            self.register_buffer('bias_ih', gru.bias_ih_l0.detach().clone())
+            self.register_buffer('bias_hh', gru.bias_hh_l0.detach().clone())
+
+    def forward(self, latent_input):
+        """
+        Args:
+            latent_input: (b, input_size)
+
+        Returns:
+            outputs: (b, steps, output_size), the output of every step
+        """
+        with torch.no_grad():
+            batch_size = latent_input.shape[0]
+            hs = self.hidden_size
+
+            x = latent_input.clone()
+            h = latent_input.new_zeros(batch_size, hs)
+            gi = latent_input.new_empty(batch_size, 3 * hs)
+            gh = latent_input.new_empty(batch_size, 3 * hs)
+            outputs = latent_input.new_empty(batch_size, self.steps, self.output_size)
+
+            for step in range(self.steps):
+                torch.addmm(self.bias_ih, x, self.weight_ih, out=gi)
+                torch.addmm(self.bias_hh, h, self.weight_hh, out=gh)
+
+                # reset and update gates, then the new gate (same order as nn.GRU)
+                rz = gi[:, :2 * hs].add_(gh[:, :2 * hs]).sigmoid_()
+                n = gi[:, 2 * hs:].addcmul_(rz[:, :hs], gh[:, 2 * hs:]).tanh_()
+
+                # h = (1 - z) * n + z * h
+                h.sub_(n).mul_(rz[:, hs:]).add_(n)
+
+                # output is the next input
+                torch.addmm(self.out_bias, h, self.out_weight, out=x)
+                self.activation_(x)
+                outputs[:, step] = x[:, :self.output_size]
+
+        return outputs
+
+
+class FusedRNNRollout(FusedRollout):
+    def __init__(self, core_model):
+        super().__init__(core_model)
+        rnn = core_model.rnn
+        check_recurrent_layer(rnn)
+        self.rnn_tanh = rnn.nonlinearity == 'tanh'
+
+        with torch.no_grad():
+            # [input, hidden] @ weight in one matmul
+            weight = torch.cat([rnn.weight_ih_l0, rnn.weight_hh_l0], dim=1)
+            self.register_buffer('weight', weight.detach().t().contiguous())    # (input + hidden, hidden)
+            self.register_buffer('bias', (rnn.bias_ih_l0 + rnn.bias_hh_l0).detach())
+
+    def forward(self, latent_input):
+        """
+        Args:
+            latent_input: (b, input_size)
+
+        Returns:
+            outputs: (b, steps, output_size), the output of every step
+        """
+        with torch.no_grad():
+            batch_size = latent_input.shape[0]
+
+            xh = latent_input.new_zeros(batch_size, self.input_size + self.hidden_size)
+            xh[:, :self.input_size] = latent_input
+            x = xh[:, :self.input_size]
+            h = xh[:, self.input_size:]
+            pre_activation = latent_input.new_empty(batch_size, self.hidden_size)
+            outputs = latent_input.new_empty(batch_size, self.steps, self.output_size)
+
+            for step in range(self.steps):
+                torch.addmm(self.bias, xh, self.weight, out=pre_activation)
+                if self.rnn_tanh:
+                    torch.tanh(pre_activation, out=h)
+                else:
+                    torch.relu(pre_activation, out=h)
+
+                # output is the next input
+                torch.addmm(self.out_bias, h, self.out_weight, out=x)
+                self.activation_(x)
+                outputs[:, step] = x[:, :self.output_size]
+
+        return outputs
+
+
+def fused_rollout(core_model, compile=None):
+    """
+    Fused inference rollout of a recurrent core, picked on its lstm, gru or rnn attribute.
+
+    Args:
+        core_model: LSTMCore, GRUCore or RNNCore (core/ or core_new/)
+        compile: None (eager), 'script' (TorchScript, deprecated in recent torch versions) or 'compile'
+            (torch.compile)
+
+    Returns:
+        rollout: module with rollout(latent_input) -> (b, steps, output_size), in the dtype and on the device of
+            core_model. The output of model_step is rollout(latent_input)[:, -1]
+    """
+    if hasattr(core_model, 'lstm'):
+        rollout = FusedLSTMRollout(core_model)
+    elif hasattr(core_model, 'gru'):
+        rollout = FusedGRURollout(core_model)
+    elif hasattr(core_model, 'rnn'):
+        rollout = FusedRNNRollout(core_model)
+    else:
+        raise ValueError(f'no fused rollout for {type(core_model).__name__}')
+
+    rollout.eval()
+
+    if compile == 'script':
+        return torch.jit.script(rollout)
+    elif compile == 'compile':
+        return torch.compile(rollout, dynamic=True)
+    elif compile is None:
+        return rollout
+    else:
+        raise ValueError(f'compile option not supported: {compile}')
+
+
+def eager_rollout(core_model, latent_input):
+    """
+    Rollout with the forward of the core, like model_step in the training scripts.
+    """
+    output = latent_input
+    if hasattr(core_model, 'lstm'):
+        hidden, cell = core_model.init_hidden_cell(latent_input.shape[0], latent_input.device)
+    else:
+        hidden = core_model.init_hidden(latent_input.shape[0], latent_input.device)
+
+    outputs = []
+    for step in range(core_model.steps):
+        if hasattr(core_model, 'lstm'):
+            output, hidden, cell = core_model(output.unsqueeze(dim=1), hidden, cell)
+        else:
+            output, hidden = core_model(output.unsqueeze(dim=1), hidden)
+        outputs.append(output[:, :core_model.output_size])
+
+    return torch.stack(outputs, dim=1)
+
+
+def time_rollout(rollout, latent_input, repeats=10, warmup=3):
+    """
+    Fastest of repeats calls of rollout(latent_input) in seconds, after warmup calls (TorchScript optimizes a
+    module during its first two calls).
+    """
+    def call():
+        rollout(latent_input)
+        if latent_input.is_cuda:
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        for _ in range(warmup):
+            call()
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def fastest_rollout(core_model, batch_size, compile=None, repeats=5):
+    """
+    fused_rollout of a recurrent core if it is faster than eager_rollout on a batch of batch_size random latent
+    inputs (on the device and in the dtype of the core), eager_rollout otherwise. Whether fusing pays off depends
+    on the cell, the sizes and the device: it saves the per step overhead, which matters less for large hidden
+    sizes, where the cuDNN/ATen cells of the eager forward can be faster.
+
+    Returns:
+        rollout: function, rollout(latent_input) -> (b, steps, output_size)
+        timings: dict, {'eager': seconds, 'fused': seconds} per batch
+    """
+    parameter = next(core_model.parameters())
+    latent_input = torch.rand(batch_size, core_model.input_size, device=parameter.device, dtype=parameter.dtype)
+
+    fused = fused_rollout(core_model, compile=compile)
+    eager = lambda latent_input: eager_rollout(core_model, latent_input)
+
+    timings = {
+        'eager': time_rollout(eager, latent_input, repeats=repeats),
+        'fused': time_rollout(fused, latent_input, repeats=repeats)
+    }
+
+    return (fused if timings['fused'] < timings['eager'] else eager), timings
+
+
+def main():
+    from src.neural_nets.core.lstm_core import LSTMCore
+    from src.neural_nets.core.gru_core import GRUCore
+    from src.neural_nets.core.rnn_core import RNNCore
+
+    torch.set_grad_enabled(False)
+
+    batch_size = 64
+    core_params = dict(input_size=512, hidden_size=1024, output_size=256, steps=10, activation_function='tanh')
+
+    for core in [LSTMCore, GRUCore, RNNCore]:
+        core_model = core(**core_params).double().eval()
+        latent_input = torch.rand(batch_size, core_params['input_size']).double()
+
+        rollout = fused_rollout(core_model)
+        error = torch.max(torch.abs(rollout(latent_input) - eager_rollout(core_model, latent_input))).item()
+
+        timings = {'eager': time_rollout(lambda x: eager_rollout(core_model, x), latent_input)}
+        for compile in [None, 'script']:
+            timings[f'fused ({compile})'] = time_rollout(fused_rollout(core_model, compile=compile), latent_input)
+
+        print(f'{core.__name__}: ' + ', '.join(f'{name} {timing * 1e3:.2f} ms' for name, timing in timings.items()) +
+              f' per batch of {batch_size}, max abs difference {error:.2e}')
+
+
+if __name__ == "__main__":
+    main()
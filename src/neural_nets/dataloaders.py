@@ -5,19 +5,24 @@ from pathlib import Path
 import glob
 import pickle
 import torch
+import numpy as np
 
 # own modules
 script_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = str(Path(script_dir).parents[1])
 sys.path.append(src_dir)
 
-from src.neural_nets.dataset_utils import copy_output_to_input
+from src.neural_nets.dataset_utils import copy_output_to_input, load_packed_dataset, load_packed_constants, \
+    add_constants, select_time_steps, load_species_cut, cut_species, to_dtype
 
 
 class VulcanDataset(Dataset):
     """
     Template for VULCAN dataset loader
     """
+    # dtype the floating point values of the examples are cast to, None keeps them as stored (double)
+    dtype = None
+
     def __init__(self, dataset_dir):
         self.dataset_dir = dataset_dir
 
@@ -25,11 +30,27 @@ class VulcanDataset(Dataset):
         with open(index_file, 'rb') as f:
             self.index_dict = pickle.load(f)
 
+        # species of a cut dataset, cut when loading
+        self.species_idx = load_species_cut(os.path.join(dataset_dir, '..'))
+
+    def process_example(self, example):
+        """
+        Cut the species of a cut dataset and cast the example to dtype.
+        """
+        if self.species_idx is not None:
+            example = cut_species(example, self.species_idx)
+        return to_dtype(example, self.dtype)
+
 
 class SingleVulcanDataset(VulcanDataset):
-    def __init__(self, dataset_dir, time_series_evaluation=False):
+    """
+    Dataset of the .pt examples in dataset_dir. time_idx selects steps of the time series outputs (e.g. every
+    other step), see select_time_steps.
+    """
+    def __init__(self, dataset_dir, time_series_evaluation=False, time_idx=None):
         super().__init__(dataset_dir)
         self.time_series_evaluation = time_series_evaluation
+        self.time_idx = time_idx
 
     def load_example(self, idx):
         if torch.is_tensor(idx):
@@ -38,6 +59,62 @@ class SingleVulcanDataset(VulcanDataset):
         filename = f'{idx:04}.pt'
         example = torch.load(os.path.join(self.dataset_dir, filename))
 
+        example = self.process_example(example)
+
+        if self.time_idx is not None:
+            example = select_time_steps(example, self.time_idx)
+
+        if self.time_series_evaluation:
+            example['outputs']['y_mixs'] = example['outputs']['y_mixs'][-1, ...]
+
+        return example
+
+    def __len__(self):
+        return len(self.index_dict)
+
+    def __getitem__(self, idx):
+        example = self.load_example(idx)
+
+        return example
+
+
+class PackedVulcanDataset(VulcanDataset):
+    """
+    SingleVulcanDataset for a packed dataset (see PackedDatasetWriter). The field arrays are read into memory
+    once, so loading an example is a copy of one row per field.
+
+    Fields that are the same for all examples are in self.constants and are not part of the examples, unless
+    include_constants is set. Use dataset_utils.add_constants to broadcast them to a batch.
+    """
+    def __init__(self, dataset_dir, time_series_evaluation=False, include_constants=False, time_idx=None):
+        super().__init__(dataset_dir)
+        self.time_series_evaluation = time_series_evaluation
+        self.include_constants = include_constants
+        self.time_idx = time_idx
+
+        self.packed_index, self.arrays = load_packed_dataset(dataset_dir)
+        self.constants = load_packed_constants(dataset_dir)
+
+    def add_constants(self, example):
+        if self.include_constants:
+            for top_key, top_value in self.constants.items():
+                example[top_key] = add_constants(example.get(top_key, {}), top_value)
+        return example
+
+    def load_example(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        example = {}
+        for top_key, top_value in self.arrays.items():
+            example[top_key] = {key: torch.from_numpy(np.array(value[idx])) for key, value in top_value.items()}
+        example = self.add_constants(example)
+
+        example = self.process_example(example)
+
+        if self.time_idx is not None:
+            example = select_time_steps(example, self.time_idx)
+
         if self.time_series_evaluation:
             example['outputs']['y_mixs'] = example['outputs']['y_mixs'][-1, ...]
 
@@ -52,6 +129,72 @@ class SingleVulcanDataset(VulcanDataset):
         return example
 
 
+class MemmapVulcanDataset(PackedVulcanDataset):
+    """
+    PackedVulcanDataset that memory-maps the field arrays instead of reading them into memory. The arrays are
+    opened lazily in every DataLoader worker, so all workers share the page cache and examples are returned as
+    zero-copy views of the mapped arrays.
+    """
+    def __init__(self, dataset_dir, time_series_evaluation=False, include_constants=False, time_idx=None):
+        VulcanDataset.__init__(self, dataset_dir)
+        self.time_series_evaluation = time_series_evaluation
+        self.include_constants = include_constants
+        self.time_idx = time_idx
+
+        self.packed_index = None
+        self.arrays = None
+        self.constants = load_packed_constants(dataset_dir)
+
+    def __getstate__(self):
+        # don't send the mapped arrays to the workers, they are opened again in each process
+        state = self.__dict__.copy()
+        state['packed_index'] = None
+        state['arrays'] = None
+        return state
+
+    def load_example(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        if self.arrays is None:
+            # copy-on-write mapping, so the tensors are writable without touching the files
+            self.packed_index, self.arrays = load_packed_dataset(self.dataset_dir, mmap_mode='c')
+
+        example = {}
+        for top_key, top_value in self.arrays.items():
+            example[top_key] = {key: torch.from_numpy(value[idx, ...]) for key, value in top_value.items()}
+        example = self.add_constants(example)
+
+        example = self.process_example(example)
+
+        if self.time_idx is not None:
+            example = select_time_steps(example, self.time_idx)
+
+        if self.time_series_evaluation:
+            example['outputs']['y_mixs'] = example['outputs']['y_mixs'][-1, ...]
+
+        return example
+
+
+class LatentVulcanDataset(PackedVulcanDataset):
+    """
+    Packed dataset of encoded examples, {'latent': {'input': latent input, 'output': latent output(s)}}, made by
+    core_training_routine.make_latent_dataset.
+    """
+    def __init__(self, dataset_dir):
+        super().__init__(dataset_dir)
+
+
+def vulcan_dataset_class(dataset_dir, memmap=False):
+    """
+    Dataset class of the (interpolated) dataset in dataset_dir: PackedVulcanDataset, or MemmapVulcanDataset if
+    memmap, when it is a packed dataset (see PackedDatasetWriter), otherwise SingleVulcanDataset.
+    """
+    if os.path.isfile(os.path.join(dataset_dir, 'packed_index.pkl')):
+        return MemmapVulcanDataset if memmap else PackedVulcanDataset
+    return SingleVulcanDataset
+
+
 class DoubleVulcanDataset(VulcanDataset):
     def __init__(self, dataset_dir):
         super().__init__(dataset_dir)
@@ -61,7 +204,7 @@ class DoubleVulcanDataset(VulcanDataset):
             idx = idx.tolist()
 
         filename = f'{int(idx / 2):04}.pt'
-        example = torch.load(os.path.join(self.dataset_dir, filename))
+        example = self.process_example(torch.load(os.path.join(self.dataset_dir, filename)))
 
         if idx % 2 != 0:
             example = copy_output_to_input(example)
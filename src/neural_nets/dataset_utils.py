@@ -38,143 +38,539 @@ def copy_output_to_input(example):
     return new_example
 
 
-def calculate_log_mean_std_min_max(value):
-    value = value.detach().numpy()
-    value = np.where(value == 0.0, zero_value, value)
+def select_time_steps(example, time_idx):
+    """
+    Select steps of the time series outputs of an example (and their times in the metadata), e.g. to train at a
+    lower temporal resolution than the dataset was generated with.
 
-    log_value = np.log10(value)
-    mean = np.mean(log_value)
-    std = np.std(log_value)
+    Args:
+        example: dict, the example
+        time_idx: list or slice, steps to keep
 
-    standardized_value = distribution_standardization(log_value, mean, std)
+    Returns:
+        example: dict, the example with the selected steps
+    """
+    example['outputs']['y_mixs'] = example['outputs']['y_mixs'][time_idx, ...]
+    if 'times' in example.get('metadata', {}):
+        example['metadata']['times'] = example['metadata']['times'][time_idx]
 
-    return mean, std, np.min(standardized_value), np.max(standardized_value)
+    return example
 
 
-def create_scaling_dict(ds_dir, time_series):
-    
+def log_values(value):
+    value = to_numpy(value).astype(np.float64)
+    value = np.where(value == 0.0, zero_value.item(), value)
+
+    return np.log10(value)
+
+
+class LogScalingStats:
+    """
+    Streaming, mergeable statistics of the log10 values of every field of the examples, used to build the
+    scaling dict in a single pass.
+
+    Per field the count, mean and sum of squared deviations (Welford) are kept, and every new example or other
+    accumulator is combined with the parallel merge of Chan et al., so per-example (or per-worker) statistics
+    can be reduced in any order. The running min and max are kept in log space and are standardized with the
+    final mean and std, which gives the min and max in the scaled domain.
+    """
+
+    def __init__(self):
+        self.fields = {}    # {top_key: {key: [count, mean, m2, log_min, log_max]}}
+
+    @staticmethod
+    def merge_field(field_a, field_b):
+        count_a, mean_a, m2_a, min_a, max_a = field_a
+        count_b, mean_b, m2_b, min_b, max_b = field_b
+
+        count = count_a + count_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * count_b / count
+        m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+
+        return [count, mean, m2, min(min_a, min_b), max(max_a, max_b)]
+
+    def update_field(self, top_key, key, field):
+        top_value = self.fields.setdefault(top_key, {})
+        if key in top_value:
+            top_value[key] = self.merge_field(top_value[key], field)
+        else:
+            top_value[key] = list(field)
+
+    def update(self, example):
+        """
+        Add the values of an (unscaled) example.
+        """
+        for top_key in ['inputs', 'outputs']:
+            for key, value in example[top_key].items():
+                log_value = log_values(value)
+                mean = np.mean(log_value)
+
+                field = [log_value.size, mean, np.sum((log_value - mean) ** 2), np.min(log_value), np.max(log_value)]
+                self.update_field(top_key, key, field)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another LogScalingStats into this one.
+        """
+        for top_key, top_value in other.fields.items():
+            for key, field in top_value.items():
+                self.update_field(top_key, key, field)
+
+        return self
+
+    def scaling_dict(self, same_scale_items=()):
+        """
+        Make the scaling dict, {top_key: {key: (mean, std, min, max)}}, as used by scale and unscale.
+
+        Args:
+            same_scale_items: list of [top_key_a, key_a, top_key_b, key_b] rows, fields that share their scaling
+
+        Returns:
+            scaling_dict: dict
+        """
+        fields = {top_key: dict(top_value) for top_key, top_value in self.fields.items()}
+
+        # pool the statistics of fields with the same scale
+        for top_key_a, key_a, top_key_b, key_b in same_scale_items:
+            if key_a in fields.get(top_key_a, {}) and key_b in fields.get(top_key_b, {}):
+                field = self.merge_field(fields[top_key_a][key_a], fields[top_key_b][key_b])
+                fields[top_key_a][key_a] = field
+                fields[top_key_b][key_b] = field
+
+        scaling_dict = {}
+        for top_key, top_value in fields.items():
+            scaling_dict[top_key] = {}
+            for key, (count, mean, m2, log_min, log_max) in top_value.items():
+                std = np.sqrt(m2 / count)
+                prop_min = distribution_standardization(log_min, mean, std)
+                prop_max = distribution_standardization(log_max, mean, std)
+
+                scaling_dict[top_key][key] = (float(mean), float(std), float(prop_min), float(prop_max))
+
+        return scaling_dict
+
+
+class LogQuantileSketch:
+    """
+    Approximate quantiles of every element of a fixed shape array (e.g. y_mix_ini, per height layer and
+    species) over a stream of examples, in bounded memory.
+
+    Every element keeps a histogram of its log10 values, with bins_per_dex bins per decade between log_min and
+    log_max. Values at or below 10**log_min (including zeros) go in an underflow bin, NaNs are ignored. Sketches
+    are merged by adding the histograms, so workers can accumulate their own.
+    """
+
+    def __init__(self, shape, log_min=-50., log_max=1., bins_per_dex=20):
+        self.shape = tuple(shape)
+        self.log_min = log_min
+        self.bins_per_dex = bins_per_dex
+        self.num_bins = int(np.ceil((log_max - log_min) * bins_per_dex)) + 1    # including underflow
+
+        self.counts = np.zeros((int(np.prod(self.shape)), self.num_bins), dtype=np.int32)
+
+    def update(self, values):
+        """
+        Add one array, or a batch of arrays, of the sketch shape.
+        """
+        values = to_numpy(values).astype(np.float64).reshape(-1, len(self.counts))
+
+        cells = np.arange(len(self.counts))
+        for row in values:
+            valid = ~np.isnan(row)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bins = np.floor((np.log10(row[valid]) - self.log_min) * self.bins_per_dex) + 1
+            bins = np.clip(np.nan_to_num(bins, nan=0., neginf=0.), 0, self.num_bins - 1).astype(np.int64)
+
+            # every cell is in a row once, so no np.add.at needed
+            self.counts[cells[valid], bins] += 1
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def quantile(self, q):
+        """
+        Returns:
+            quantiles: (np.ndarray) of the sketch shape, the center of the bin holding the q quantile (0 for the
+                underflow bin, NaN for elements without values)
+        """
+        cumulative = np.cumsum(self.counts, axis=1)
+        total = cumulative[:, -1]
+        bins = np.argmax(cumulative >= np.maximum(q * total, 1)[:, None], axis=1)
+
+        quantiles = 10 ** (self.log_min + (bins - 0.5) / self.bins_per_dex)
+        quantiles[bins == 0] = 0.
+        quantiles[total == 0] = np.nan
+
+        return quantiles.reshape(self.shape)
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+def species_cut_index(species_sketch, threshold):
+    """
+    Indices of the species with a height median of their (per layer) median mixing ratio above threshold.
+
+    Args:
+        species_sketch: LogQuantileSketch of y_mix_ini, [height_layers, num_species]
+        threshold: float
+
+    Returns:
+        species_idx: (np.ndarray) indices of the kept species
+    """
+    y_mix_ini_median = species_sketch.median()    # (150, 69)
+    y_mix_ini_median_height = np.median(y_mix_ini_median, axis=0)    # (69,)
+
+    return np.where(y_mix_ini_median_height > threshold)[0]
+
+
+def save_species_cut(ds_dir, species_idx):
+    """
+    Save the species indices to ds_dir/species_idx.pkl. The species are cut when loading, see cut_species.
+    """
+    species_idx_file = os.path.join(ds_dir, 'species_idx.pkl')
+    with open(species_idx_file, 'wb') as f:
+        pickle.dump(np.asarray(species_idx), f)
+
+
+def load_species_cut(ds_dir):
+    """
+    Species indices saved by save_species_cut, None if the dataset is not cut.
+    """
+    species_idx_file = os.path.join(ds_dir, 'species_idx.pkl')
+    if not os.path.isfile(species_idx_file):
+        return None
+
+    with open(species_idx_file, 'rb') as f:
+        return torch.from_numpy(pickle.load(f))
+
+
+def cut_species(example, species_idx):
+    """
+    Select species (last axis) of the mixing ratios in an example.
+    """
+    for top_key, key in [('inputs', 'y_mix_ini'), ('outputs', 'y_mix'), ('outputs', 'y_mixs')]:
+        if key in example.get(top_key, {}):
+            example[top_key][key] = example[top_key][key][..., species_idx]
+
+    return example
+
+
+def save_scaling_dict(ds_dir, scaling_stats, time_series):
+    """
+    Save the scaling dict of the accumulated LogScalingStats to ds_dir/scaling_dict.pkl.
+    """
     if time_series:
         mix_mixs = 'y_mixs'
     else:
         mix_mixs = 'y_mix'
 
-    same_scale_items = np.array([
+    same_scale_items = [
         ['inputs', 'y_mix_ini', 'outputs', mix_mixs]
-    ])
-    
+    ]
+
+    scaling_dict = scaling_stats.scaling_dict(same_scale_items)
+
+    # save dict
+    scaling_dict_file = os.path.join(ds_dir, 'scaling_dict.pkl')
+    with open(scaling_dict_file, 'wb') as f:
+        pickle.dump(scaling_dict, f)
+
+    return scaling_dict
+
+
+def create_scaling_dict(ds_dir, time_series):
+    """
+    Create the scaling dict of the .pt examples in ds_dir in a single streaming pass. When generating a dataset
+    the statistics are accumulated by the workers instead, see generate_dataset.py.
+    """
     examples_files = glob.glob(os.path.join(ds_dir, '*.pt'))
-    num_files = len(examples_files)
-
-    test_example = torch.load(examples_files[0])
-    num_input_items = len(test_example['inputs'])
-    inputs_keys = test_example['inputs'].keys()
-    num_output_items = len(test_example['outputs'])
-    outputs_keys = test_example['outputs'].keys()
-
-    input_means = np.empty(shape=(num_files, num_input_items))
-    input_stds = np.empty(shape=(num_files, num_input_items))
-    input_min = np.ones(shape=num_input_items) * np.inf
-    input_max = np.ones(shape=num_input_items) * -np.inf
-
-    output_means = np.empty(shape=(num_files, num_output_items))
-    output_stds = np.empty(shape=(num_files, num_output_items))
-    output_min = np.ones(shape=num_input_items) * np.inf
-    output_max = np.ones(shape=num_input_items) * -np.inf
-
-    # extract all means, stds, mins, maxs
-    for i_file, example_file in enumerate(tqdm(examples_files, desc='calculating means, stds, mins en maxs')):
-        example = torch.load(example_file)
-
-        inputs = example['inputs']
-        outputs = example['outputs']
-
-        for i_dict, (key, value) in enumerate(inputs.items()):
-            mean, std, v_min, v_max = calculate_log_mean_std_min_max(value)
-            input_means[i_file, i_dict] = mean
-            input_stds[i_file, i_dict] = std
-
-            if v_min < input_min[i_dict]:
-                input_min[i_dict] = v_min
-            if v_max > input_max[i_dict]:
-                input_max[i_dict] = v_max
-
-        for i_dict, (key, value) in enumerate(outputs.items()):
-            mean, std, v_min, v_max = calculate_log_mean_std_min_max(value)
-            output_means[i_file, i_dict] = mean
-            output_stds[i_file, i_dict] = std
-
-            if v_min < output_min[i_dict]:
-                output_min[i_dict] = v_min
-            if v_max > output_max[i_dict]:
-                output_max[i_dict] = v_max
-
-
-    # calculate means
-    avg_input_means = np.mean(input_means, axis=0)
-    avg_input_stds = np.mean(input_stds, axis=0)
-    avg_output_means = np.mean(output_means, axis=0)
-    avg_output_stds = np.mean(output_stds, axis=0)
-
-    # create scaling dict
-    scaling_dict_inputs = {}
-    for key, mean, std, min, max in zip(inputs_keys, avg_input_means, avg_input_stds, input_min, input_max):
-        scaling_dict_inputs.update(
-            {key: (mean, std, min, max)}
-        )
 
-    scaling_dict_outputs = {}
-    for key, mean, std, min, max in zip(outputs_keys, avg_output_means, avg_output_stds, output_min, output_max):
-        scaling_dict_outputs.update(
-            {key: (mean, std, min, max)}
-        )
+    scaling_stats = LogScalingStats()
+    for example_file in tqdm(examples_files, desc='calculating means, stds, mins en maxs'):
+        scaling_stats.update(torch.load(example_file))
 
-    scaling_dict = {
-        'inputs': scaling_dict_inputs,
-        'outputs': scaling_dict_outputs
-    }
+    return save_scaling_dict(ds_dir, scaling_stats, time_series)
 
-    # copy dict
-    same_scaling_dict = {key: {} for key, _ in scaling_dict.items()}
-    for top_key, top_value in same_scaling_dict.items():
-        same_scaling_dict[top_key] = {key: value[:] for key, value in scaling_dict[top_key].items()}
 
-    for top_key, top_value in scaling_dict.items():
-        for key, value in top_value.items():
-            if key in same_scale_items:
-                row = np.where(same_scale_items == key)[0][0]
-                mean = np.mean([
-                    scaling_dict[same_scale_items[row, 0]][same_scale_items[row, 1]][0],
-                    scaling_dict[same_scale_items[row, 2]][same_scale_items[row, 3]][0]
-                ])
+class PackedDatasetWriter:
+    """
+    Write examples into a packed dataset: one contiguous .npy array per field, where row i holds example i.
+
+    The layout of the store is described by packed_index.pkl, which is only written on close(), so a packed
+    dataset without an index is incomplete. If packed_dir is None the arrays are kept in memory.
+
+    On close, fields that are the same for every example (e.g. wavelengths) are stored once in constants.pkl
+    instead of once per example, see load_packed_constants and add_constants. The arrays are not initialized, so
+    every example has to be written before close().
+    """
 
-                std = np.mean([
-                    scaling_dict[same_scale_items[row, 0]][same_scale_items[row, 1]][1],
-                    scaling_dict[same_scale_items[row, 2]][same_scale_items[row, 3]][1]
-                ])
+    def __init__(self, packed_dir, num_examples, detect_constants=True):
+        self.packed_dir = packed_dir
+        self.num_examples = num_examples
+        self.detect_constants = detect_constants
+
+        self.fields = None
+        self.arrays = None
+        self.constants = {}
+        self.written = np.zeros(num_examples, dtype=bool)
+
+    def allocate(self, example):
+        """
+        Create the field arrays with the shapes and dtypes of the first example.
+        """
+        self.fields = {}
+        self.arrays = {}
+
+        for top_key, top_value in example.items():
+            self.fields[top_key] = {}
+            self.arrays[top_key] = {}
+            for key, value in top_value.items():
+                value = to_numpy(value)
+                filename = f'{top_key}.{key}.npy'
+
+                if self.packed_dir is None:
+                    self.arrays[top_key][key] = np.empty((self.num_examples, *value.shape), dtype=value.dtype)
+                else:
+                    self.arrays[top_key][key] = np.lib.format.open_memmap(os.path.join(self.packed_dir, filename),
+                                                                          mode='w+',
+                                                                          dtype=value.dtype,
+                                                                          shape=(self.num_examples, *value.shape))
+                self.fields[top_key][key] = {
+                    'file': filename,
+                    'shape': value.shape,
+                    'dtype': str(value.dtype)
+                }
+
+    def write(self, idx, example):
+        if self.arrays is None:
+            self.allocate(example)
+
+        for top_key, top_value in example.items():
+            for key, value in top_value.items():
+                self.arrays[top_key][key][idx] = to_numpy(value)
+        self.written[idx] = True
+
+    def read(self, idx):
+        """
+        Read example idx back, including the fields moved to the constants on close().
+        """
+        example = {}
+        for top_key, top_value in self.arrays.items():
+            example[top_key] = {key: torch.from_numpy(np.array(value[idx])) for key, value in top_value.items()}
+            for key, value in self.constants.get(top_key, {}).items():
+                example[top_key][key] = torch.from_numpy(np.array(value))
+
+        return example
+
+    def close(self):
+        if self.arrays is None:
+            raise ValueError('No examples written to packed dataset!')
+
+        missing = np.flatnonzero(~self.written)
+        if len(missing) > 0:
+            raise ValueError(f'{len(missing)} of {self.num_examples} examples not written to packed dataset, '
+                             f'e.g. {missing[:10].tolist()}!')
+
+        if self.packed_dir is None:
+            return
+
+        for top_value in self.arrays.values():
+            for array in top_value.values():
+                array.flush()
+
+        packed_index = {
+            'num_examples': self.num_examples,
+            'fields': self.fields
+        }
+
+        if self.detect_constants and self.num_examples > 1:
+            packed_index['constants'] = self.store_constants()
+
+        packed_index_file = os.path.join(self.packed_dir, 'packed_index.pkl')
+        with open(packed_index_file, 'wb') as f:
+            pickle.dump(packed_index, f)
+
+    def store_constants(self, chunk_size=1024):
+        """
+        Move the fields that are equal for all examples to constants.pkl, and remove their arrays.
+
+        Returns:
+            constants: dict, {'file': filename, 'fields': {top_key: {key: {'shape', 'dtype'}}}}
+        """
+        constants = {}
+        constant_fields = {}
+
+        for top_key, top_value in self.arrays.items():
+            for key, array in list(top_value.items()):
+                equal_nan = np.issubdtype(array.dtype, np.inexact)
+                is_constant = all(
+                    np.array_equal(array[start:start + chunk_size],
+                                   np.broadcast_to(array[0], array[start:start + chunk_size].shape),
+                                   equal_nan=equal_nan)
+                    for start in range(0, self.num_examples, chunk_size)
+                )
+                if not is_constant:
+                    continue
+
+                constants.setdefault(top_key, {})[key] = np.array(array[0])
+                self.constants.setdefault(top_key, {})[key] = constants[top_key][key]
+                constant_fields.setdefault(top_key, {})[key] = {
+                    'shape': self.fields[top_key][key]['shape'],
+                    'dtype': self.fields[top_key][key]['dtype']
+                }
+
+                # remove the per example array
+                filename = self.fields[top_key][key]['file']
+                del top_value[key]
+                del self.fields[top_key][key]
+                del array
+                os.remove(os.path.join(self.packed_dir, filename))
+
+        constants_file = 'constants.pkl'
+        with open(os.path.join(self.packed_dir, constants_file), 'wb') as f:
+            pickle.dump(constants, f)
+
+        return {
+            'file': constants_file,
+            'fields': constant_fields
+        }
+
+
+def to_numpy(value):
+    if torch.is_tensor(value):
+        return value.detach().cpu().numpy()
+    else:
+        return np.asarray(value)
 
-                prop_min = np.mean([
-                    scaling_dict[same_scale_items[row, 0]][same_scale_items[row, 1]][2],
-                    scaling_dict[same_scale_items[row, 2]][same_scale_items[row, 3]][2]
-                ])
 
-                prop_max = np.mean([
-                    scaling_dict[same_scale_items[row, 0]][same_scale_items[row, 1]][3],
-                    scaling_dict[same_scale_items[row, 2]][same_scale_items[row, 3]][3]
-                ])
+def to_dtype(obj, dtype):
+    """
+    Cast the floating point tensors in a (nested dict of) tensor(s) to dtype, other values are kept as they are.
+    """
+    if dtype is None:
+        return obj
+    if torch.is_tensor(obj):
+        return obj.to(dtype) if obj.is_floating_point() else obj
+    if isinstance(obj, dict):
+        return {key: to_dtype(value, dtype) for key, value in obj.items()}
+    return obj
 
-                same_scaling_dict[top_key][key] = (mean, std, prop_min, prop_max)
 
-    scaling_dict = same_scaling_dict
+def load_packed_dataset(packed_dir, mmap_mode=None):
+    """
+    Load the field arrays of a packed dataset.
+
+    Args:
+        packed_dir: str, directory of the packed dataset
+        mmap_mode: None or str, passed to np.load. None reads the arrays into memory
+
+    Returns:
+        packed_index: dict, layout of the packed dataset
+        arrays: dict, {top_key: {key: array of shape (num_examples, *shape)}}
+    """
+    packed_index_file = os.path.join(packed_dir, 'packed_index.pkl')
+    with open(packed_index_file, 'rb') as f:
+        packed_index = pickle.load(f)
+
+    arrays = {}
+    for top_key, top_value in packed_index['fields'].items():
+        arrays[top_key] = {}
+        for key, field in top_value.items():
+            arrays[top_key][key] = np.load(os.path.join(packed_dir, field['file']), mmap_mode=mmap_mode)
+
+    return packed_index, arrays
+
+
+def load_packed_constants(packed_dir):
+    """
+    Load the fields that are the same for every example of a packed dataset.
+
+    Returns:
+        constants: dict, {top_key: {key: tensor of the shape of one example}}, empty if there are none
+    """
+    packed_index_file = os.path.join(packed_dir, 'packed_index.pkl')
+    with open(packed_index_file, 'rb') as f:
+        packed_index = pickle.load(f)
+
+    if 'constants' not in packed_index:
+        return {}
+
+    with open(os.path.join(packed_dir, packed_index['constants']['file']), 'rb') as f:
+        constants = pickle.load(f)
+
+    return {top_key: {key: torch.from_numpy(value) for key, value in top_value.items()}
+            for top_key, top_value in constants.items()}
 
-    # save dict
-    scaling_dict_file = os.path.join(ds_dir, 'scaling_dict.pkl')
-    with open(scaling_dict_file, 'wb') as f:
-        pickle.dump(scaling_dict, f)
 
+def dataset_constants(dataset):
+    """
+    Constant fields of a (random_split subset of a) dataset, empty for datasets without them.
+    """
+    while isinstance(dataset, torch.utils.data.Subset):
+        dataset = dataset.dataset
+    return getattr(dataset, 'constants', {})
+
+
+def add_constants(top_value, constants, batch_size=None):
+    """
+    Add constant fields to the inputs or outputs dict of an example. With batch_size they are broadcast to the
+    batch with expand, which doesn't copy.
+
+    Args:
+        top_value: dict, {key: tensor}, e.g. example['inputs']
+        constants: dict, {key: tensor}, e.g. constants['inputs']
+        batch_size: None or int
+
+    Returns:
+        dict with the fields of top_value and the constants
+    """
+    if not constants:
+        return top_value
+
+    top_value = dict(top_value)
+    for key, value in constants.items():
+        if key not in top_value:
+            top_value[key] = value if batch_size is None else value.expand(batch_size, *value.shape)
+
+    return top_value
+
+
+def pack_dataset(ds_dir, packed_dir=None):
+    """
+    Convert a directory of NNNN.pt examples into a packed dataset.
+
+    Args:
+        ds_dir: str, directory with the .pt examples
+        packed_dir: str, output directory, defaults to a sibling "<ds_dir>_packed" directory so that the
+                    index_dict.pkl one level up is still found by the dataset loaders
+    """
+    if packed_dir is None:
+        packed_dir = os.path.normpath(ds_dir) + '_packed'
+
+    # remake the packed directory
+    if os.path.isdir(packed_dir):
+        shutil.rmtree(packed_dir)
+    os.mkdir(packed_dir)
+
+    torch_files = glob.glob(os.path.join(ds_dir, '*.pt'))
+    indices = [int(os.path.basename(torch_file)[:-3]) for torch_file in torch_files]
 
-def make_data_loaders(dataloader, dataset_dir, train_test_validation_ratios, batch_size, shuffle, num_workers):
-    # dataset loader
+    writer = PackedDatasetWriter(packed_dir, num_examples=max(indices) + 1)
+    for idx, torch_file in zip(tqdm(indices, desc='packing torch files'), torch_files):
+        writer.write(idx, torch.load(torch_file))
+    writer.close()
+
+    return packed_dir
+
+
+def make_data_loaders(dataloader, dataset_dir, train_test_validation_ratios, batch_size, shuffle, num_workers,
+                      dtype=None):
+    # dataset loader, examples are cast to dtype (e.g. float32) by the dataset
     vulcan_dataset = dataloader(dataset_dir)
+    vulcan_dataset.dtype = dtype
 
     # split like this to make sure len(subsets) = len(dataset)
     train_size = int(train_test_validation_ratios[0] * len(vulcan_dataset))
@@ -185,18 +581,24 @@ def make_data_loaders(dataloader, dataset_dir, train_test_validation_ratios, bat
                                                                                     [train_size, test_size,
                                                                                      validation_size])
 
+    # keep workers (and their opened/mapped datasets) alive between epochs
+    persistent_workers = num_workers > 0
+
     train_loader = DataLoader(train_dataset, batch_size=batch_size,
                               shuffle=shuffle,
                               num_workers=num_workers,
-                              pin_memory=True)
+                              pin_memory=True,
+                              persistent_workers=persistent_workers)
     test_loader = DataLoader(test_dataset, batch_size=batch_size,
                              shuffle=shuffle,
                              num_workers=num_workers,
-                              pin_memory=True)
+                             pin_memory=True,
+                             persistent_workers=persistent_workers)
     validation_loader = DataLoader(validation_dataset, batch_size=batch_size,
                                    shuffle=shuffle,
                                    num_workers=num_workers,
-                              pin_memory=True)
+                                   pin_memory=True,
+                                   persistent_workers=persistent_workers)
 
     return train_loader, test_loader, validation_loader
 
@@ -215,8 +617,8 @@ def reverse_distribution_standardization(prop, prop_mean, prop_std):
         return prop * prop_std + prop_mean
 
 
-def scale(prop, prop_mean, prop_std, prop_min, prop_max, nans=False):
-    # cap values
+def scale(prop, prop_mean, prop_std, prop_min, prop_max, nans=False, dtype=None):
+    # cap values, the log scaling is always done in double, the result is cast to dtype
 
     prop = prop.double()
     prop = torch.where(prop < zero_value,
@@ -228,31 +630,38 @@ def scale(prop, prop_mean, prop_std, prop_min, prop_max, nans=False):
     standardized_prop = distribution_standardization(torch.log10(prop), prop_mean, prop_std)
 
     if prop_min == prop_max:
-        return standardized_prop
+        scaled_prop = standardized_prop
     else:
-        return (standardized_prop - prop_min) / (prop_max - prop_min)
+        scaled_prop = (standardized_prop - prop_min) / (prop_max - prop_min)
 
+    return scaled_prop if dtype is None else scaled_prop.to(dtype)
 
-def unscale(prop, prop_mean, prop_std, prop_min, prop_max):
+
+def unscale(prop, prop_mean, prop_std, prop_min, prop_max, dtype=None):
+    # in double, 10** of float32 values loses too much precision for tiny mixing ratios
+    prop = prop.double()
     if prop_min == prop_max:
         unnorm_prop = prop
     else:
         unnorm_prop = prop * (prop_max - prop_min) + prop_min
     unscaled_prop = 10**reverse_distribution_standardization(unnorm_prop, prop_mean, prop_std)
     # unscaled_prop[unscaled_prop <= zero_value] = 0.0
-    return unscaled_prop
+    return unscaled_prop if dtype is None else unscaled_prop.to(dtype)
 
 
-def scale_example(example, scaling_dict, nans=False):
-    scaled_example = {
-        'inputs': {},
-        'outputs': {}
-    }
+def scale_example(example, scaling_dict, nans=False, dtype=None):
+    scaled_example = {}
+
+    for top_key, top_value in example.items():
+        # values without scaling params (e.g. metadata) are kept as they are
+        if top_key not in scaling_dict:
+            scaled_example[top_key] = top_value
+            continue
 
-    for top_key in scaled_example.keys():
-        for (key, value), scales in zip(example[top_key].items(), scaling_dict[top_key].values()):
+        scaled_example[top_key] = {}
+        for key, value in top_value.items():
             # scale values
-            scaled_value = scale(value, *scales, nans=nans)
+            scaled_value = scale(value, *scaling_dict[top_key][key], nans=nans, dtype=dtype)
             scaled_example[top_key].update(
                 {key: scaled_value}
             )
@@ -263,6 +672,8 @@ def scale_example(example, scaling_dict, nans=False):
 def unscale_example(example, scaling_params):
     unscaled_example = example.copy()
     for top_key, top_value in example.items():
+        if top_key not in scaling_params:
+            continue
         for key, value in top_value.items():
             scales = scaling_params[top_key][key]
             uncsaled_value = unscale(value, *scales)
@@ -0,0 +1,184 @@
+import os
+import sys
+import glob
+from pathlib import Path
+import pickle
+import timeit
+
+import numpy as np
+import torch
+
+# own modules
+script_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = str(Path(script_dir).parents[1])
+sys.path.append(src_dir)
+
+from src.neural_nets.dataset_utils import scale, unscale, load_species_cut, load_packed_constants, add_constants
+from src.neural_nets.interpolate_dataset import interp_y_mixs
+from src.neural_nets.core_rollout import fastest_rollout
+from src.neural_nets.core_new.ae_params import ae_params as default_ae_params
+from src.neural_nets.core_new.core_training_routine import initialize_models, encode_inputs, decode_y_mixs
+
+
+def core_model_name(params):
+    """
+    Name the core training routine saves the core with, {model_name}_state_dict.
+    """
+    hparams = {}
+    hparams.update(params['core_model_params'])
+    hparams.update(params['optimizer_params'])
+    return f'{params["name"]},{hparams=}'
+
+
+class Emulator:
+    """
+    Emulate VULCAN with a trained core: from the (unscaled) inputs of a batch of configs to the (unscaled) mixing
+    ratios. The autoencoders, the core and the scaling and species information of the dataset are loaded once,
+    predict does no file I/O.
+
+    Inputs are the fields of example['inputs'] of the dataset (e.g. y_mix_ini, elemental_abs, pressure, gravity,
+    planet_radius, T_irr, top_flux and wavelengths) with a batch dimension. Fields that are the same for every
+    example of a packed dataset (see PackedDatasetWriter) can be left out.
+
+    Args:
+        dataset_dir: str, dataset the models were trained on (scaling_dict.pkl, species_list.pkl, ...)
+        save_model_dir: str, directory of the autoencoder and core state dicts
+        core_params: dict, like the settings in core_settings.py (model, name, core_model_params,
+            core_model_extra_params, optimizer_params and model_step for non-recurrent cores)
+        ae_params: dict, autoencoder models, state dicts and model params
+        device: torch.device
+        dtype: torch.dtype of the models, the scaling is always done in double
+        compile: compile option of fused_rollout for recurrent cores (None, 'script' or 'compile')
+        batch_size: int, maximum number of examples per forward pass
+    """
+
+    def __init__(self, dataset_dir, save_model_dir, core_params, ae_params=default_ae_params,
+                 device=torch.device('cpu'), dtype=torch.double, compile=None, batch_size=1024):
+        self.device = device
+        self.dtype = dtype
+        self.batch_size = batch_size
+
+        # scaling parameters
+        with open(os.path.join(dataset_dir, 'scaling_dict.pkl'), 'rb') as f:
+            self.scaling_params = pickle.load(f)
+
+        # species of the predicted mixing ratios, and the cut of the input species
+        with open(os.path.join(dataset_dir, 'species_list.pkl'), 'rb') as f:
+            self.spec_list = pickle.load(f)
+        self.species_idx = load_species_cut(dataset_dir)
+
+        # already scaled fields that are the same for every example
+        interp_ds_dir = os.path.join(dataset_dir, 'interpolated_dataset')
+        self.constants = {}
+        if os.path.isfile(os.path.join(interp_ds_dir, 'packed_index.pkl')):
+            self.constants = {key: value.to(device=device, dtype=dtype)
+                              for key, value in load_packed_constants(interp_ds_dir).get('inputs', {}).items()}
+
+        self.input_keys = [key for key in self.scaling_params['inputs'].keys() if key not in self.constants]
+
+        # models
+        self.ae_models = initialize_models(device, ae_params['models'], ae_params['state_dicts'],
+                                           ae_params['model_params'], save_model_dir, dtype=dtype)
+
+        self.core_model = core_params['model'](
+            **core_params['core_model_params'],
+            **core_params['core_model_extra_params'],
+            device=device
+        ).to(device=device, dtype=dtype)
+        state_dict_file = os.path.join(save_model_dir, f'{core_model_name(core_params)}_state_dict')
+        self.core_model.load_state_dict(torch.load(state_dict_file, map_location=device))
+        self.core_model.eval()
+
+        # recurrent cores are rolled out with a fused module when that is faster than their forward (timed on a
+        # batch of at most 128, to keep loading cheap), others with their model step
+        if any(hasattr(self.core_model, layer) for layer in ['lstm', 'gru', 'rnn']):
+            self.rollout, self.rollout_timings = fastest_rollout(self.core_model, min(batch_size, 128),
+                                                                 compile=compile)
+        else:
+            model_step = core_params['model_step']
+            self.rollout_timings = None
+            self.rollout = lambda latent_input: model_step(latent_input, self.core_model, device=device)[:, None]
+
+        self.num_species = self.core_model.output_size // self.ae_models['mrae'].latent_dim
+
+    def scale_inputs(self, inputs):
+        """
+        Scale a batch of raw inputs like the interpolated dataset: cut the species, log scale and interpolate
+        the mixing ratios below the scaling range along the height layers.
+        """
+        missing = [key for key in self.input_keys if key not in inputs]
+        if missing:
+            raise KeyError(f'missing inputs: {missing}')
+
+        scaled_inputs = {}
+        for key in self.input_keys:
+            value = torch.as_tensor(inputs[key], dtype=torch.double)
+            if key == 'y_mix_ini' and self.species_idx is not None:
+                value = value[..., self.species_idx]
+            scaled_inputs[key] = scale(value, *self.scaling_params['inputs'][key], nans=True)
+
+        scaled_inputs['y_mix_ini'] = interp_y_mixs(scaled_inputs['y_mix_ini'], dim=-2)
+
+        return scaled_inputs
+
+    def predict_batch(self, scaled_inputs, time_series):
+        batch_size = scaled_inputs['y_mix_ini'].shape[0]
+
+        inputs = {key: value.to(device=self.device, dtype=self.dtype) for key, value in scaled_inputs.items()}
+        inputs = add_constants(inputs, self.constants, batch_size)
+
+        latent_input = encode_inputs(self.device, self.ae_models, inputs)
+        latent_outputs = self.rollout(latent_input)    # [b, steps, output_size]
+        if not time_series:
+            latent_outputs = latent_outputs[:, -1]
+
+        y_mixs = decode_y_mixs(self.device, latent_outputs, self.ae_models['mrae'], self.num_species)
+
+        return unscale(y_mixs.cpu(), *self.scaling_params['inputs']['y_mix_ini'])
+
+    def predict(self, inputs, time_series=False):
+        """
+        Args:
+            inputs: dict, {key: array or tensor of shape (b, *shape)} raw inputs of a batch of configs
+            time_series: bool, return the mixing ratios of every step of the core instead of only the last
+
+        Returns:
+            y_mix: (np.ndarray) [b, height_layers, num_species], or [b, steps, height_layers, num_species]
+        """
+        scaled_inputs = self.scale_inputs(inputs)
+        num_examples = scaled_inputs['y_mix_ini'].shape[0]
+
+        y_mixs = []
+        with torch.no_grad():
+            for start in range(0, num_examples, self.batch_size):
+                batch = {key: value[start:start + self.batch_size] for key, value in scaled_inputs.items()}
+                y_mixs.append(self.predict_batch(batch, time_series))
+
+        return torch.cat(y_mixs, dim=0).numpy()
+
+
+def main():
+    from src.visualization.plot_core_performance.core_settings import get_params
+
+    # setup directories
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    MRP_dir = str(Path(script_dir).parents[1])
+    dataset_dir = os.path.join(MRP_dir, 'data/poly_dataset/time_series_dataset')
+    save_model_dir = os.path.join(MRP_dir, 'src/neural_nets/saved_models_final')
+
+    emulator = Emulator(dataset_dir, save_model_dir, get_params('LSTM_new'))
+
+    # raw inputs of the first examples of the dataset
+    example_files = sorted(glob.glob(os.path.join(dataset_dir, '*.pt')))[:256]
+    examples = [torch.load(example_file) for example_file in example_files]
+    inputs = {key: torch.stack([example['inputs'][key] for example in examples]) for key in emulator.input_keys}
+
+    time_start = timeit.default_timer()
+    y_mix = emulator.predict(inputs)
+    elapsed_time = timeit.default_timer() - time_start
+
+    print(f'predicted {y_mix.shape} in {elapsed_time:.3f} s ({elapsed_time / len(examples) * 1e3:.2f} ms/example)')
+
+
+if __name__ == "__main__":
+    main()
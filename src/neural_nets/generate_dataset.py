@@ -3,7 +3,6 @@ import glob
 import sys
 from pathlib import Path
 import multiprocessing as mp
-from multiprocessing.managers import BaseManager
 import shutil
 import psutil
 from tqdm import tqdm
@@ -11,6 +10,7 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader
 import pickle
+import json
 import importlib
 import argparse
 
@@ -28,183 +28,56 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = str(Path(script_dir).parents[1])
 sys.path.append(src_dir)
 
-from src.vulcan_configs.vulcan_config_utils import CopyManager
-from src.neural_nets.dataset_utils import unscale_example, create_scaling_dict, scale_dataset
+from src.vulcan_configs.vulcan_config_utils import CopyScheduler
+from src.vulcan_configs.vul_reader import VulReader
+from src.vulcan_configs.vulcan_worker import init_vulcan_worker, get_vulcan_worker
+from src.neural_nets.dataset_utils import unscale_example, create_scaling_dict, scale_dataset, LogScalingStats, \
+    save_scaling_dict, PackedDatasetWriter, LogQuantileSketch, species_cut_index, save_species_cut
 from src.neural_nets.dataloaders import SingleVulcanDataset
-from src.neural_nets.interpolate_dataset import interpolate_dataset
+from src.neural_nets.interpolate_dataset import interpolate_dataset, scale_interpolate_example
 
 # TODO: don't know if this is nescessary
 # Limiting the number of threads
 os.environ["OMP_NUM_THREADS"] = "1"
 
 
-def cut_values(dataset_dir, threshold, spec_list):
-    # dataset loader
-    vulcan_dataset = SingleVulcanDataset(dataset_dir)
-    dataloader = DataLoader(vulcan_dataset, batch_size=1,
-                            shuffle=True,
-                            num_workers=0)
-    # get scaling parameters
-    scaling_file = os.path.join(dataset_dir, 'scaling_dict.pkl')
-    with open(scaling_file, 'rb') as f:
-        scaling_params = pickle.load(f)
-
-    # create tot dict
-    for i, dummy_example in enumerate(dataloader):
-        unscaled_dummy_example = unscale_example(dummy_example, scaling_params)
-        tot_dict = unscaled_dummy_example.copy()
-        for top_key, top_value in tot_dict.items():
-            for key, value in top_value.items():
-                zero_value = np.zeros_like(value)
-                tot_dict[top_key][key] = np.tile(zero_value[..., None], len(dataloader))
-        break
-
-    # loop through examples
-    with tqdm(dataloader, unit='example', desc=f'Summing values') as dataloader:
-        for i, example in enumerate(dataloader):
-            # unscale dict
-            unscaled_dict = unscale_example(example, scaling_params)
-
-            # add
-            for top_key, top_value in tot_dict.items():
-                for key, value in top_value.items():
-                    tot_dict[top_key][key][..., i] = unscaled_dict[top_key][key]
-
-    # calculate means
-    agg_dict = tot_dict.copy()
-    for top_key, top_value in tot_dict.items():
-        for key, value in top_value.items():
-            agg_dict[top_key][key] = np.median(value, axis=-1)
-
-    y_mix_ini = agg_dict['inputs']['y_mix_ini'].swapaxes(0, 1)
-    y_mix_ini_median_height = np.median(y_mix_ini, axis=1)
-
-    inds = np.where(y_mix_ini_median_height > threshold)[0]
-    print(f'cutting to {len(inds)} species...')
-    spec_list = spec_list[inds]
-
-    torch_files = glob.glob(os.path.join(dataset_dir, '*.pt'))
-
-    for torch_file in tqdm(torch_files, desc='cutting torch files'):
-        example = torch.load(torch_file)
-
-        cut_example = example.copy()
-        cut_example['inputs']['y_mix_ini'] = example['inputs']['y_mix_ini'][:, inds]
-        cut_example['outputs']['y_mix'] = example['outputs']['y_mix'][:, inds]
-
-        torch.save(cut_example, torch_file)
-
-    return spec_list
-
-
-def ini_vulcan():
+def species_median_sketch(dataset_dir):
     """
-    Initial steps of a VULCAN simulation, taken from vulcan.py.
+    Stream the (unscaled) .pt examples in dataset_dir into a LogQuantileSketch of y_mix_ini.
     """
+    torch_files = glob.glob(os.path.join(dataset_dir, '*.pt'))
 
-    # import the configuration inputs
-    # reload vulcan_cfg per worker
-    import vulcan_cfg
-    importlib.reload(sys.modules['vulcan_cfg'])
-
-    # import chem_funs
-    import chem_funs
-
-    # import VULCAN modules
-    import store, build_atm, op
-
-    from phy_const import kb, Navo, au, r_sun
-
-    from chem_funs import ni, nr  # number of species and reactions in the network
-
-    ### read in the basic chemistry data
-    with open(vulcan_cfg.com_file, 'r') as f:
-        columns = f.readline()  # reading in the first line
-        num_ele = len(columns.split()) - 2  # number of elements (-2 for removing "species" and "mass")
-    type_list = ['int' for i in range(num_ele)]
-    type_list.insert(0, 'U20');
-    type_list.append('float')
-    compo = np.genfromtxt(vulcan_cfg.com_file, names=True, dtype=type_list)
-    # dtype=None in python 2.X but Sx -> Ux in python3
-    compo_row = list(compo['species'])
-    ### read in the basic chemistry data
-
-    ### creat the instances for storing the variables and parameters
-    data_var = store.Variables()
-    data_atm = store.AtmData()
-    data_para = store.Parameters()
-
-    # record starting CPU time
-    data_para.start_time = time.time()
-
-    make_atm = build_atm.Atm()
-
-    # construct pico
-    data_atm = make_atm.f_pico(data_atm)
-    # construct Tco and Kzz
-    data_atm = make_atm.load_TPK(data_atm)
-    # construct Dzz (molecular diffusion)
-
-    # Only setting up ms (the species molecular weight) if vulcan_cfg.use_moldiff == False
-    make_atm.mol_diff(data_atm)
-
-    # calculating the saturation pressure
-    if vulcan_cfg.use_condense == True: make_atm.sp_sat(data_atm)
-
-    # for reading rates
-    rate = op.ReadRate()
-
-    # read-in network and calculating forward rates
-    data_var = rate.read_rate(data_var, data_atm)
-
-    # for low-T rates e.g. Jupiter
-    if vulcan_cfg.use_lowT_limit_rates == True: data_var = rate.lim_lowT_rates(data_var, data_atm)
-
-    # reversing rates
-    data_var = rate.rev_rate(data_var, data_atm)
-    # removing rates
-    data_var = rate.remove_rate(data_var)
-
-    ini_abun = build_atm.InitialAbun()
-    # initialing y and ymix (the number density and the mixing ratio of every species)
-    data_var = ini_abun.ini_y(data_var, data_atm)
-
-    # storing the initial total number of atmos
-    data_var = ini_abun.ele_sum(data_var)
-
-    # calculating mean molecular weight, dz, and dzi and plotting TP
-    data_atm = make_atm.f_mu_dz(data_var, data_atm, output=None)
-
-    # specify the BC
-    make_atm.BC_flux(data_atm)
-
-
-    # Setting up for photo chemistry
-    if vulcan_cfg.use_photo == True:
-        rate.make_bins_read_cross(data_var, data_atm)
-        # rate.read_cross(data_var)
-        make_atm.read_sflux(data_var, data_atm)
+    species_sketch = None
+    for torch_file in tqdm(torch_files, desc='species medians'):
+        y_mix_ini = torch.load(torch_file)['inputs']['y_mix_ini']
+        if species_sketch is None:
+            species_sketch = LogQuantileSketch(y_mix_ini.shape)
+        species_sketch.update(y_mix_ini)
 
-    # modified vulcan code but with 2500 points so all spectra are uniform
-    bins = np.linspace(data_var.bins[0], data_var.bins[-1], 2500)
+    return species_sketch
 
-    sflux_top = np.zeros(len(bins))
 
-    inter_sflux = interp1d(data_atm.sflux_raw['lambda'], data_atm.sflux_raw['flux'] * (
-                vulcan_cfg.r_star * r_sun / (au * vulcan_cfg.orbit_radius)) ** 2, bounds_error=False, fill_value=0)
+def cut_values(dataset_dir, threshold, spec_list, species_sketch=None):
+    """
+    Cut the species with a median mixing ratio below threshold. The examples are not changed, the species indices
+    are saved to dataset_dir/species_idx.pkl and the dataset loaders cut the species when loading.
 
-    for n, ld in enumerate(bins):
-        sflux_top[n] = inter_sflux(ld)
+    Returns:
+        spec_list: (np.ndarray) the kept species
+    """
+    if species_sketch is None:
+        species_sketch = species_median_sketch(dataset_dir)
 
-    data_var.sflux_top = sflux_top
-    data_var.bins = bins
+    inds = species_cut_index(species_sketch, threshold)
+    print(f'cutting to {len(inds)} species...')
+    save_species_cut(dataset_dir, inds)
 
-    return data_atm, data_var
+    return spec_list[inds]
 
 
 def generate_inputs(mode):
-    # generate simulation state
-    data_atm, data_var = ini_vulcan()
+    # generate simulation state with the VULCAN copy of this worker
+    data_atm, data_var = get_vulcan_worker().ini_vulcan()
 
     # flux
     top_flux = data_var.sflux_top    # (2500,)
@@ -253,14 +126,11 @@ def generate_inputs(mode):
 
 def generate_output(vul_file, mode):
     # extract data
-    with open(vul_file, 'rb') as handle:
-        data = pickle.load(handle)
-
-    y = data['variable']['y']
+    with VulReader(vul_file) as reader:
+        y = reader.read('variable', 'y')
 
     # mixing  ratios
-    total_abundances = np.sum(y, axis=-1)
-    y_mix = y / np.tile(total_abundances[..., None], y.shape[-1])
+    y_mix = y / np.sum(y, axis=-1, keepdims=True)
 
     if mode == 'clipped':
         # clipping of values
@@ -273,28 +143,173 @@ def generate_output(vul_file, mode):
     return outputs
 
 
-def generate_output_time(vul_file, mode):
-    # extract data
-    with open(vul_file, 'rb') as handle:
-        data = pickle.load(handle)
+# default time sampling of the time series outputs: 10 steps evenly spaced in index
+DEFAULT_TIME_SAMPLING = {
+    'sampling': 'uniform',    # 'uniform' (in index), 'log' (log-uniform in t_time) or 'explicit'
+    'num_samples': 10,
+    'times': None    # explicit only: times (s) to sample, the closest saved steps are used
+}
+
 
-    y_time = data['variable']['y_time']    # (256, 150, 69)
+def sample_time_indices(t_time, sampling='uniform', num_samples=10, times=None):
+    """
+    Select time steps of a VULCAN run.
 
-    # 10 evenly spaced integers including first and last, but ignore first time as it is practically t=0
-    idx = np.round(np.linspace(0, y_time.shape[0] - 1, 11)[1:]).astype(int)    # (10,)
-    y_t = y_time[idx, :, :]  # (10, 150, 69)
-    total_abundances = np.sum(y_t, axis=-1)  # (10, 150)
-    y_mixs = y_t / np.tile(total_abundances[..., None], y_t.shape[-1])  # (10, 150, 69)
+    Args:
+        t_time: (np.ndarray) [num_steps] times of the saved steps (y_time) of the run, increasing
+        sampling: (str) 'uniform': evenly spaced in index, 'log': log-uniform in time, 'explicit': the given times
+        num_samples: (int) number of steps for 'uniform' and 'log'
+        times: (list) times for 'explicit'
+
+    Returns:
+        idx: (np.ndarray) [num_samples] indices into y_time, the first step (practically t=0) is never used
+    """
+    num_steps = len(t_time)
+
+    if sampling == 'uniform':
+        # evenly spaced integers including first and last, but ignore first time as it is practically t=0
+        return np.round(np.linspace(0, num_steps - 1, num_samples + 1)[1:]).astype(int)
+
+    if sampling == 'log':
+        t_min = t_time[t_time > 0][0]
+        times = np.logspace(np.log10(t_min), np.log10(t_time[-1]), num_samples)
+    elif sampling != 'explicit':
+        raise ValueError(f'unknown time sampling: {sampling}')
+
+    # closest saved step to each time
+    times = np.asarray(times, dtype=np.float64)
+    right = np.clip(np.searchsorted(t_time, times), 1, num_steps - 1)
+    left = right - 1
+    idx = np.where(np.abs(t_time[left] - times) <= np.abs(t_time[right] - times), left, right)
+
+    return np.maximum(idx, 1)
+
+
+def generate_output_time(vul_file, mode, time_sampling=None):
+    """
+    Time series outputs of a run, sampled with the time_sampling options (see DEFAULT_TIME_SAMPLING).
+
+    Returns:
+        outputs: dict, {'y_mixs': (num_samples, 150, 69)}
+        times: (np.ndarray) [num_samples] times of the sampled steps
+    """
+    if time_sampling is None:
+        time_sampling = DEFAULT_TIME_SAMPLING
+
+    # extract data, only the selected time steps are read from a converted output
+    with VulReader(vul_file) as reader:
+        t_time = np.asarray(reader.read('variable', 't_time'), dtype=np.float64)    # (256,)
+        idx = sample_time_indices(t_time, **time_sampling)    # (10,)
+        y_t = reader.read('variable', 'y_time', index=idx)  # (10, 150, 69)
+
+    y_mixs = y_t / np.sum(y_t, axis=-1, keepdims=True)  # (10, 150, 69)
 
     if mode == 'clipped':
         # clipping of values
-        y_mix = np.where(y_mixs < 1e-14, 1e-14, y_mixs)
+        y_mixs = np.where(y_mixs < 1e-14, 1e-14, y_mixs)
 
     outputs = {
-        "y_mixs": torch.from_numpy(y_mixs)    # (150, 69)
+        "y_mixs": torch.from_numpy(y_mixs)    # (10, 150, 69)
     }
 
-    return outputs
+    return outputs, t_time[idx]
+
+
+def save_example(example, example_file):
+    """
+    Save an example to a temporary file that is renamed afterwards, so a killed worker never leaves a partially
+    written example behind.
+    """
+    tmp_file = f'{example_file}.{os.getpid()}.tmp'
+    torch.save(example, tmp_file)
+    os.replace(tmp_file, example_file)
+
+
+class GenerationJournal:
+    """
+    Append-only record (one json line per example) of the generated examples of a dataset and their scaling
+    statistics, so an interrupted generation can be resumed without regenerating or reloading finished examples.
+
+    The first line holds the generation settings (e.g. mode, time_series and time_sampling), examples generated
+    with other settings are never resumed.
+    """
+
+    def __init__(self, dataset_dir, settings):
+        self.dataset_dir = dataset_dir
+        self.journal_file = os.path.join(dataset_dir, 'generation_journal.jsonl')
+        self.entries = {}    # {i: (config filename, LogScalingStats fields)}
+        # as read back from json
+        settings = json.loads(json.dumps(settings))
+
+        lines = ['']
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file, 'r') as f:
+                lines = f.read().split('\n')
+
+            # drop the partial last line of a crashed run, so new records start on a line of their own
+            if lines[-1] != '':
+                with open(self.journal_file, 'w') as f:
+                    f.write(''.join(line + '\n' for line in lines[:-1]))
+
+        if len(lines) == 1:
+            with open(self.journal_file, 'w') as f:
+                f.write(json.dumps({'settings': settings}) + '\n')
+        else:
+            journal_settings = json.loads(lines[0]).get('settings')
+            if journal_settings != settings:
+                raise ValueError(f'examples in {dataset_dir} were generated with {journal_settings} instead of '
+                                 f'{settings}, start over without resume')
+
+            for line in lines[1:-1]:
+                record = json.loads(line)
+                self.entries[record['i']] = (record['config'], record['stats'])
+
+        # partial examples of killed workers
+        for tmp_file in glob.glob(os.path.join(dataset_dir, '*.tmp')):
+            os.remove(tmp_file)
+
+    def is_done(self, i, cf_name):
+        if i not in self.entries:
+            return False
+        if self.entries[i][0] != cf_name:
+            raise ValueError(f'example {i} was generated for {self.entries[i][0]} instead of {cf_name}, the config '
+                             f'files changed since the last run, start over without resume')
+        return os.path.isfile(os.path.join(self.dataset_dir, f'{i:04}.pt'))
+
+    def record(self, entry, scaling_stats):
+        (i, cf_name), = entry.items()
+        stats = {top_key: {key: [float(v) for v in field] for key, field in top_value.items()}
+                 for top_key, top_value in scaling_stats.fields.items()}
+        self.entries[int(i)] = (cf_name, stats)
+
+        with open(self.journal_file, 'a') as f:
+            f.write(json.dumps({'i': int(i), 'config': cf_name, 'stats': stats}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove_examples(self, num_examples):
+        """
+        Remove the examples of configs from i = num_examples on, left over from a run with more config files.
+        """
+        for i in [i for i in self.entries.keys() if i >= num_examples]:
+            del self.entries[i]
+        for example_file in glob.glob(os.path.join(self.dataset_dir, '*.pt')):
+            name = os.path.splitext(os.path.basename(example_file))[0]
+            if name.isdigit() and int(name) >= num_examples:
+                os.remove(example_file)
+
+    def index_dict(self, num_examples):
+        return {str(i): cf_name for i, (cf_name, _) in sorted(self.entries.items()) if i < num_examples}
+
+    def scaling_stats(self, num_examples):
+        scaling_stats = LogScalingStats()
+        for i, (_, stats) in self.entries.items():
+            if i >= num_examples:
+                continue
+            example_stats = LogScalingStats()
+            example_stats.fields = stats
+            scaling_stats.merge(example_stats)
+        return scaling_stats
 
 
 def generate_input_output_pair(params):
@@ -303,17 +318,11 @@ def generate_input_output_pair(params):
     """
 
     # extract params
-    (i, config_file, copy_manager, output_dir, dataset_dir, mode, time_series) = params
-
-    # get available VULCAN dir copy
-    available_dir = copy_manager.get_available_copy()
+    (i, config_file, output_dir, dataset_dir, mode, time_series, time_sampling) = params
 
-    # change working directory of this process
-    os.chdir(available_dir)
-    sys.path.append(available_dir)
-
-    # copy config file to VULCAN directory
-    shutil.copyfile(config_file, os.path.join(available_dir, 'vulcan_cfg.py'))
+    # load config file in the VULCAN copy of this worker
+    vulcan_worker = get_vulcan_worker()
+    vulcan_worker.load_config(config_file)
 
     # make std_output redirect file
     cf_name = os.path.basename(config_file)
@@ -332,22 +341,29 @@ def generate_input_output_pair(params):
     # generate output tensor
     vul_file = os.path.join(output_dir, f'output_{cf_name[11:-3]}.vul')
 
+    metadata = {}
     if time_series:
-        outputs = generate_output_time(vul_file, mode)
+        outputs, times = generate_output_time(vul_file, mode, time_sampling)
+        metadata['times'] = torch.from_numpy(times)    # (10,)
     else:
         outputs = generate_output(vul_file, mode)
 
-    # save example
+    # save example, metadata is not scaled
     example = {
         'inputs': inputs,
         'outputs': outputs
     }
+    if metadata:
+        example['metadata'] = metadata
 
-    filename = f'{i:04}.pt'
-    torch.save(example, os.path.join(dataset_dir, filename))
+    # without a dataset_dir (fused pipeline) the example is returned instead of saved
+    if dataset_dir is not None:
+        filename = f'{i:04}.pt'
+        save_example(example, os.path.join(dataset_dir, filename))
 
-    # add VULCAN dir copy back to list
-    copy_manager.add_used_copy(available_dir)
+    # scaling statistics of this example, reduced in the main process
+    scaling_stats = LogScalingStats()
+    scaling_stats.update(example)
 
     # print info
     print(
@@ -360,7 +376,92 @@ def generate_input_output_pair(params):
         str(i): cf_name
     }
 
-    return entry
+    vulcan_worker.finish_task()
+
+    if dataset_dir is None:
+        return entry, scaling_stats, example
+
+    return entry, scaling_stats
+
+
+def generate_fused_dataset(pool, mp_params, dataset_dir, time_series, keep_raw=False, chunk_size=64,
+                           species_sketch=False):
+    """
+    Generate, scale and interpolate the dataset in one pipeline. The unscaled examples are spilled to a packed
+    dataset on disk (raw_dataset if keep_raw, otherwise a temporary raw_dataset.tmp that is removed at the end)
+    until the scaling statistics of all examples are reduced, after which they are read back, scaled and
+    interpolated into the packed interpolated_dataset.
+
+    Args:
+        pool: multiprocessing.Pool
+        mp_params: list, generate_input_output_pair params with dataset_dir=None
+        dataset_dir: str, dataset directory
+        time_series: bool, whether the examples are time series
+        keep_raw: bool, also save the unscaled examples as a packed dataset in dataset_dir/raw_dataset
+        chunk_size: int, number of examples queued at once for scaling and interpolation
+        species_sketch: bool, also accumulate a LogQuantileSketch of y_mix_ini for cutting species
+
+    Returns:
+        index_dict: dict, {str(i): config filename}
+        species_sketch: LogQuantileSketch, only if species_sketch
+    """
+    num_examples = len(mp_params)
+
+    # a whole (time series) dataset doesn't fit in memory, the raw examples are always memory-mapped
+    raw_ds_dir = os.path.join(dataset_dir, 'raw_dataset' if keep_raw else 'raw_dataset.tmp')
+    os.mkdir(raw_ds_dir)
+    raw_writer = PackedDatasetWriter(raw_ds_dir, num_examples)
+
+    # generate examples and reduce their scaling statistics
+    index_dict = {}
+    scaling_stats = LogScalingStats()
+    sketch = None
+    results = pool.imap_unordered(generate_input_output_pair, mp_params)
+    for entry, example_stats, example in tqdm(results, total=num_examples, desc='generating'):
+        i = int(next(iter(entry)))
+        index_dict.update(entry)
+        scaling_stats.merge(example_stats)
+        raw_writer.write(i, example)
+
+        if species_sketch:
+            if sketch is None:
+                sketch = LogQuantileSketch(example['inputs']['y_mix_ini'].shape)
+            sketch.update(example['inputs']['y_mix_ini'])
+
+    # barrier: all statistics are known
+    scaling_dict = save_scaling_dict(dataset_dir, scaling_stats, time_series=time_series)
+
+    # scale and interpolate in memory
+    interp_ds_dir = os.path.join(dataset_dir, 'interpolated_dataset')
+    os.mkdir(interp_ds_dir)
+    interp_writer = PackedDatasetWriter(interp_ds_dir, num_examples)
+
+    with tqdm(total=num_examples, desc='scaling and interpolating') as progress:
+        for start in range(0, num_examples, chunk_size):
+            interp_params = [(i, raw_writer.read(i), scaling_dict, time_series)
+                             for i in range(start, min(start + chunk_size, num_examples))]
+            for i, interp_example in pool.imap(scale_interpolate_example, interp_params):
+                interp_writer.write(i, interp_example)
+                progress.update()
+
+    # after reading the examples back, closing moves the constant fields out of the raw arrays
+    raw_writer.close()
+    interp_writer.close()
+
+    # every field has to end up in the interpolated dataset, with or without keep_raw
+    raw_fields = {top_key: sorted(top_value) for top_key, top_value in raw_writer.read(0).items()}
+    interp_fields = {top_key: sorted(top_value) for top_key, top_value in interp_writer.read(0).items()}
+    if raw_fields != interp_fields:
+        raise ValueError(f'interpolated dataset fields {interp_fields} differ from the generated {raw_fields}')
+
+    if not keep_raw:
+        del raw_writer
+        shutil.rmtree(raw_ds_dir)
+
+    if species_sketch:
+        return index_dict, sketch
+
+    return index_dict
 
 
 def main(num_workers, generate=True):
@@ -374,6 +475,14 @@ def main(num_workers, generate=True):
 
     mode = ''    # '', 'clipped', 'cut'
     time_series = False
+    time_sampling = DEFAULT_TIME_SAMPLING    # time steps of the time series outputs, see sample_time_indices
+    packed = False    # write the interpolated dataset as a packed dataset (load with PackedVulcanDataset)
+    fused = False    # generate, scale and interpolate in one pass, only writing the packed interpolated dataset
+    keep_raw = False    # fused only: also save the unscaled examples in a packed raw_dataset
+    resume = True    # not fused: keep the examples of an interrupted generation instead of starting over
+
+    if fused and not generate:
+        raise ValueError('the fused pipeline always generates the dataset')
 
     if mode == '':
         dataset_dir = os.path.join(data_maindir, 'dataset')
@@ -382,43 +491,71 @@ def main(num_workers, generate=True):
 
     if generate:
         # create dataset dir
-        if os.path.isdir(dataset_dir):
+        if os.path.isdir(dataset_dir) and (fused or not resume):
             shutil.rmtree(dataset_dir)
-        os.mkdir(dataset_dir)
+        os.makedirs(dataset_dir, exist_ok=True)
 
         # extract saved config files, but in .txt format for some reason?
-        config_files = glob.glob(os.path.join(config_dir, '*.py'))
-
-        # setup copy manager
-        BaseManager.register('CopyManager', CopyManager)
-        manager = BaseManager()
-        manager.start()
-        mp_copy_manager = manager.CopyManager(num_workers, VULCAN_dir)
-
-        # setup_mp_params
-        mp_params = [(i, config_file, mp_copy_manager, output_dir, dataset_dir, mode, time_series)
-                     for i, config_file in enumerate(config_files)]
-
-        # run parallel
-        print(f'running with {num_workers} workers...')
-        with mp.get_context("spawn").Pool(processes=num_workers) as pool:
-            entries = list(tqdm(pool.imap(generate_input_output_pair, mp_params),  # return results otherwise it doesn't work properly
-                                total=len(mp_params)))
+        # sorted, so every config gets the same example index when resuming
+        config_files = sorted(glob.glob(os.path.join(config_dir, '*.py')))
+
+        # setup copy scheduler, every worker leases its own VULCAN copy
+        copy_scheduler = CopyScheduler(num_workers, VULCAN_dir)
+
+        if fused:
+            mp_params = [(i, config_file, output_dir, None, mode, time_series, time_sampling)
+                         for i, config_file in enumerate(config_files)]
+
+            print(f'running fused pipeline with {num_workers} workers...')
+            with mp.get_context("spawn").Pool(processes=num_workers, initializer=init_vulcan_worker,
+                                              initargs=(copy_scheduler,)) as pool:
+                if mode == 'cut':
+                    index_dict, species_sketch = generate_fused_dataset(pool, mp_params, dataset_dir, time_series,
+                                                                        keep_raw=keep_raw, species_sketch=True)
+                else:
+                    index_dict = generate_fused_dataset(pool, mp_params, dataset_dir, time_series,
+                                                        keep_raw=keep_raw)
+
+        else:
+            # examples that are done already (resume)
+            journal = GenerationJournal(dataset_dir, dict(mode=mode, time_series=time_series,
+                                                          time_sampling=time_sampling))
+            journal.remove_examples(len(config_files))
+
+            # setup_mp_params
+            mp_params = [(i, config_file, output_dir, dataset_dir, mode, time_series, time_sampling)
+                         for i, config_file in enumerate(config_files)
+                         if not journal.is_done(i, os.path.basename(config_file))]
+            print(f'{len(config_files) - len(mp_params)} example(s) generated already')
+
+            # run parallel, every worker keeps its VULCAN copy, and record every example when it is done
+            print(f'running with {num_workers} workers...')
+            with mp.get_context("spawn").Pool(processes=num_workers, initializer=init_vulcan_worker,
+                                              initargs=(copy_scheduler,)) as pool:
+                for entry, example_stats in tqdm(pool.imap_unordered(generate_input_output_pair, mp_params),
+                                                 total=len(mp_params)):
+                    journal.record(entry, example_stats)
+
+            # reduce scaling statistics
+            index_dict = journal.index_dict(len(config_files))
+            scaling_stats = journal.scaling_stats(len(config_files))
+
+            # save scaling dict
+            save_scaling_dict(dataset_dir, scaling_stats, time_series=time_series)
+
+        copy_scheduler.print_utilization()
 
         # save index dict
-        index_dict = {}
-        for entry in entries:
-            index_dict.update(entry)
-
         index_dict_file = os.path.join(dataset_dir, 'index_dict.pkl')
         with open(index_dict_file, 'wb') as f:
             pickle.dump(index_dict, f)
-
-    # save scaling dict
-    create_scaling_dict(dataset_dir, time_series=time_series)
+    else:
+        # save scaling dict
+        create_scaling_dict(dataset_dir, time_series=time_series)
 
     # scale dataset
-    scale_dataset(dataset_dir)
+    if not fused:
+        scale_dataset(dataset_dir)
 
     # save species list
     os.chdir(VULCAN_dir)
@@ -428,14 +565,15 @@ def main(num_workers, generate=True):
 
     if mode == 'cut':
         spec_list = np.array(spec_list)
-        spec_list = cut_values(dataset_dir, 1e-30, spec_list)
+        spec_list = cut_values(dataset_dir, 1e-30, spec_list, species_sketch=species_sketch if fused else None)
         spec_list = spec_list.tolist()
 
     species_list_file = os.path.join(dataset_dir, 'species_list.pkl')
     with open(species_list_file, 'wb') as f:
         pickle.dump(spec_list, f)
 
-    interpolate_dataset(dataset_dir, num_workers=num_workers, time_series=time_series)
+    if not fused:
+        interpolate_dataset(dataset_dir, num_workers=num_workers, time_series=time_series, packed=packed)
 
 
 if __name__ == "__main__":
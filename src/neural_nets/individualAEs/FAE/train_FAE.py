@@ -18,6 +18,7 @@ sys.path.append(src_dir)
 
 from src.neural_nets.dataloaders import SingleVulcanDataset
 from src.neural_nets.dataset_utils import make_data_loaders
+from src.neural_nets.precision import PrecisionPolicy
 from src.neural_nets.NN_utils import move_to, plot_variable, derivative_MSE, LossWeightScheduler
 from src.neural_nets.individualAEs.FAE.FluxAE import FluxAE
 
@@ -66,10 +67,13 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f'running on device: {device}')
 
-    # Initialize model with double precision
-    model = FluxAE(
+    # precision of the model and data, 'fp64', 'fp32', 'bf16' or 'fp16' (see PrecisionPolicy)
+    precision = PrecisionPolicy(params.get('precision', 'fp64'), device)
+
+    # Initialize model with the precision dtype
+    model = precision.model(FluxAE(
         **params['model_params']
-    ).double().to(device)
+    ))
 
     # Create optimizer
     optimizer = torch.optim.Adam(model.parameters(), **params['optimizer_params'])
@@ -91,7 +95,7 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     # load datasets
     train_loader, test_loader, validation_loader = make_data_loaders(SingleVulcanDataset,
                                                                      os.path.join(dataset_dir, 'interpolated_dataset/'),
-                                                                     **params['ds_params'])
+                                                                     **params['ds_params'], dtype=precision.dtype)
 
     # save validation indices
     torch.save(validation_loader.dataset.indices, os.path.join(save_model_dir, f'{model_name}_validation_indices.pt'))
@@ -131,13 +135,13 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
             # loop through examples
             for n_iter, example in enumerate(train_epoch):
-                flux, flux_decoded = model_step(device, model, example)
-                loss, diff_loss = loss_fn(device, flux, flux_decoded, diff_weight)
+                with precision.autocast():
+                    flux, flux_decoded = model_step(device, model, example)
+                    loss, diff_loss = loss_fn(device, flux, flux_decoded, diff_weight)
 
                 # update gradients
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                precision.backward_step(loss, optimizer)
 
                 tot_loss += loss.detach()
 
@@ -163,8 +167,9 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
             # loop through examples
             for n_iter, example in enumerate(test_epoch):
-                flux, flux_decoded = model_step(device, model, example)
-                loss, diff_loss = loss_fn(device, flux, flux_decoded, diff_weight)
+                with precision.autocast():
+                    flux, flux_decoded = model_step(device, model, example)
+                    loss, diff_loss = loss_fn(device, flux, flux_decoded, diff_weight)
 
                 tot_loss += loss.detach()
                 tot_diff_loss += diff_loss.detach()
@@ -227,8 +232,9 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
         # loop through examples
         for n_iter, example in enumerate(validation):
-            flux, flux_decoded = model_step(device, model, example)
-            loss, diff_loss = loss_fn(device, flux, flux_decoded, diff_weight)
+            with precision.autocast():
+                flux, flux_decoded = model_step(device, model, example)
+                loss, diff_loss = loss_fn(device, flux, flux_decoded, diff_weight)
 
             tot_loss += loss.detach()
             tot_diff_loss += diff_loss.detach()
@@ -304,6 +310,9 @@ def main():
             ),
         },
 
+        # 'fp64', 'fp32', 'bf16' or 'fp16'
+        precision='fp64',
+
         train_params={
             'epochs': 200,
             'writer_interval': 10,
@@ -18,6 +18,7 @@ sys.path.append(src_dir)
 
 from src.neural_nets.dataloaders import SingleVulcanDataset
 from src.neural_nets.dataset_utils import make_data_loaders
+from src.neural_nets.precision import PrecisionPolicy
 from src.neural_nets.NN_utils import move_to, plot_variable, derivative_MSE
 from src.neural_nets.individualAEs.MRAE.MixingRatioAE import MixingRatioAE
 
@@ -67,10 +68,13 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f'running on device: {device}')
 
-    # Initialize model with double precision
-    model = MixingRatioAE(
+    # precision of the model and data, 'fp64', 'fp32', 'bf16' or 'fp16' (see PrecisionPolicy)
+    precision = PrecisionPolicy(params.get('precision', 'fp64'), device)
+
+    # Initialize model with the precision dtype
+    model = precision.model(MixingRatioAE(
         **params['model_params']
-    ).double().to(device)
+    ))
 
     # Create optimizer
     optimizer = torch.optim.Adam(model.parameters(), **params['optimizer_params'])
@@ -92,7 +96,7 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     # load datasets
     train_loader, test_loader, validation_loader = make_data_loaders(SingleVulcanDataset,
                                                                      os.path.join(dataset_dir, 'interpolated_dataset/'),
-                                                                     **params['ds_params'])
+                                                                     **params['ds_params'], dtype=precision.dtype)
 
     # save validation indices
     torch.save(validation_loader.dataset.indices, os.path.join(save_model_dir, f'{model_name}_validation_indices.pt'))
@@ -137,13 +141,14 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
             # loop through examples
             for n_iter, example in enumerate(train_epoch):
-                variable, variable_decoded = model_step(device, model, example, params['train_params']['variable_key'])
-                loss, diff_loss = loss_fn(device, variable, variable_decoded, diff_weight)
+                with precision.autocast():
+                    variable, variable_decoded = model_step(device, model, example,
+                                                            params['train_params']['variable_key'])
+                    loss, diff_loss = loss_fn(device, variable, variable_decoded, diff_weight)
 
                 # update gradients
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                precision.backward_step(loss, optimizer)
 
                 tot_loss += loss.detach()
 
@@ -169,8 +174,10 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
             # loop through examples
             for n_iter, example in enumerate(test_epoch):
-                variable, variable_decoded = model_step(device, model, example, params['train_params']['variable_key'])
-                loss, diff_loss = loss_fn(device, variable, variable_decoded, diff_weight)
+                with precision.autocast():
+                    variable, variable_decoded = model_step(device, model, example,
+                                                            params['train_params']['variable_key'])
+                    loss, diff_loss = loss_fn(device, variable, variable_decoded, diff_weight)
 
                 tot_loss += loss.detach()
                 tot_diff_loss += diff_loss.detach()
@@ -230,8 +237,9 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
         # loop through examples
         for n_iter, example in enumerate(validation):
-            variable, variable_decoded = model_step(device, model, example, params['train_params']['variable_key'])
-            loss, diff_loss = loss_fn(device, variable, variable_decoded, diff_weight)
+            with precision.autocast():
+                variable, variable_decoded = model_step(device, model, example, params['train_params']['variable_key'])
+                loss, diff_loss = loss_fn(device, variable, variable_decoded, diff_weight)
 
             tot_loss += loss.detach()
             tot_diff_loss += diff_loss.detach()
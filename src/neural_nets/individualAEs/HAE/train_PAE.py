@@ -54,6 +54,9 @@ def main():
             ),
         },
 
+        # 'fp64', 'fp32', 'bf16' or 'fp16'
+        precision='fp64',
+
         train_params={
             'epochs': 200,
             'writer_interval': 10,
@@ -15,6 +15,7 @@ sys.path.append(src_dir)
 
 from src.neural_nets.dataloaders import MixingRatioVulcanDataset
 from src.neural_nets.dataset_utils import make_data_loaders
+from src.neural_nets.precision import PrecisionPolicy
 from src.neural_nets.NN_utils import move_to, plot_single_y_mix, derivative_MSE, LossWeightScheduler, plot_variable
 from src.neural_nets.individualAEs.MRAE.MixingRatioAE import MixingRatioAE
 
@@ -48,10 +49,13 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f'running on device: {device}')
 
-    # Initialize model with double precision
-    model = MixingRatioAE(
+    # precision of the model and data, 'fp64', 'fp32', 'bf16' or 'fp16' (see PrecisionPolicy)
+    precision = PrecisionPolicy(params.get('precision', 'fp64'), device)
+
+    # Initialize model with the precision dtype
+    model = precision.model(MixingRatioAE(
         **params['model_params']
-    ).double().to(device)
+    ))
 
     # Create optimizer
     optimizer = torch.optim.Adam(model.parameters(), **params['optimizer_params'])
@@ -73,7 +77,7 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     # load datasets
     train_loader, test_loader, validation_loader = make_data_loaders(MixingRatioVulcanDataset,
                                                                      os.path.join(dataset_dir, 'interpolated_dataset/'),
-                                                                     **params['ds_params'])
+                                                                     **params['ds_params'], dtype=precision.dtype)
     # save validation indices
     torch.save(validation_loader.dataset.indices, os.path.join(save_model_dir, f'{model_name}_validation_indices.pt'))
 
@@ -116,13 +120,13 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
             # loop through examples
             for n_iter, spec_example in enumerate(train_epoch):
-                y_mix, y_mix_decoded = model_step(device, model, spec_example)
-                loss = loss_fn(device, y_mix, y_mix_decoded)
+                with precision.autocast():
+                    y_mix, y_mix_decoded = model_step(device, model, spec_example)
+                    loss = loss_fn(device, y_mix, y_mix_decoded)
 
                 # update gradients
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                precision.backward_step(loss, optimizer)
 
                 tot_loss += loss.detach()
 
@@ -146,8 +150,9 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
             # loop through examples
             for n_iter, spec_example in enumerate(test_epoch):
-                y_mix, y_mix_decoded = model_step(device, model, spec_example)
-                loss = loss_fn(device, y_mix, y_mix_decoded)
+                with precision.autocast():
+                    y_mix, y_mix_decoded = model_step(device, model, spec_example)
+                    loss = loss_fn(device, y_mix, y_mix_decoded)
 
                 tot_loss += loss.detach()
 
@@ -205,8 +210,9 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
         # loop through examples
         for n_iter, spec_example in enumerate(validation):
-            y_mix, y_mix_decoded = model_step(device, model, spec_example)
-            loss = loss_fn(device, y_mix, y_mix_decoded)
+            with precision.autocast():
+                y_mix, y_mix_decoded = model_step(device, model, spec_example)
+                loss = loss_fn(device, y_mix, y_mix_decoded)
 
             tot_loss += loss.detach()
 
@@ -281,6 +287,9 @@ def main():
             ),
         },
 
+        # 'fp64', 'fp32', 'bf16' or 'fp16'
+        precision='fp64',
+
         train_params={
             'epochs': 200,
             'writer_interval': 5,
@@ -16,8 +16,9 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = str(Path(script_dir).parents[3])
 sys.path.append(src_dir)
 
-from src.neural_nets.dataloaders import SingleVulcanDataset
-from src.neural_nets.dataset_utils import make_data_loaders
+from src.neural_nets.dataloaders import vulcan_dataset_class
+from src.neural_nets.dataset_utils import make_data_loaders, dataset_constants, add_constants
+from src.neural_nets.precision import PrecisionPolicy
 from src.neural_nets.NN_utils import move_to, plot_variable, derivative_MSE, LossWeightScheduler
 from src.neural_nets.individualAEs.FAE.FluxAE import FluxAE
 
@@ -47,15 +48,24 @@ def loss_fn(device, wavelengths, wavelengths_decoded, diff_weight):
     return loss, diff_loss
 
 
-def model_step(device, model, example):
-    # extract inputs
-    wavelengths = move_to(example['inputs']['wavelengths'], device)
+def model_step(device, model, example, constants=None):
+    # extract inputs, wavelengths can be a constant of a packed dataset
+    wavelengths = example_wavelengths(device, example, constants)
     # output of autoencoder
     wavelengths_decoded = model(wavelengths)
 
     return wavelengths, wavelengths_decoded
 
 
+def example_wavelengths(device, example, constants=None):
+    if constants:
+        batch_size = next(iter(example['inputs'].values())).shape[0]
+        inputs = add_constants(example['inputs'], constants.get('inputs'), batch_size)
+    else:
+        inputs = example['inputs']
+    return move_to(inputs['wavelengths'], device)
+
+
 def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     # headless plotting
     import matplotlib
@@ -65,10 +75,13 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f'running on device: {device}')
 
-    # Initialize model with double precision
-    model = FluxAE(
+    # precision of the model and data, 'fp64', 'fp32', 'bf16' or 'fp16' (see PrecisionPolicy)
+    precision = PrecisionPolicy(params.get('precision', 'fp64'), device)
+
+    # Initialize model with the precision dtype
+    model = precision.model(FluxAE(
         **params['model_params']
-    ).double().to(device)
+    ))
 
     # Create optimizer
     optimizer = torch.optim.Adam(model.parameters(), **params['optimizer_params'])
@@ -88,9 +101,13 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
     )
 
     # load datasets
-    train_loader, test_loader, validation_loader = make_data_loaders(SingleVulcanDataset,
-                                                                     os.path.join(dataset_dir, 'interpolated_dataset/'),
-                                                                     **params['ds_params'])
+    interp_ds_dir = os.path.join(dataset_dir, 'interpolated_dataset/')
+    train_loader, test_loader, validation_loader = make_data_loaders(vulcan_dataset_class(interp_ds_dir),
+                                                                     interp_ds_dir,
+                                                                     **params['ds_params'], dtype=precision.dtype)
+
+    # fields that are the same for every example of a packed dataset
+    constants = move_to(dataset_constants(train_loader.dataset), device, precision.dtype)
 
     # save validation indices
     torch.save(validation_loader.dataset.indices, os.path.join(save_model_dir, f'{model_name}_validation_indices.pt'))
@@ -130,13 +147,13 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
             # loop through examples
             for n_iter, example in enumerate(train_epoch):
-                wavelengths, wavelengths_decoded =  model_step(device, model, example)
-                loss, diff_loss = loss_fn(device, wavelengths, wavelengths_decoded, diff_weight)
+                with precision.autocast():
+                    wavelengths, wavelengths_decoded = model_step(device, model, example, constants)
+                    loss, diff_loss = loss_fn(device, wavelengths, wavelengths_decoded, diff_weight)
 
                 # update gradients
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                precision.backward_step(loss, optimizer)
 
                 tot_loss += loss.detach()
 
@@ -162,8 +179,9 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
             # loop through examples
             for n_iter, example in enumerate(test_epoch):
-                wavelengths, wavelengths_decoded =  model_step(device, model, example)
-                loss, diff_loss = loss_fn(device, wavelengths, wavelengths_decoded, diff_weight)
+                with precision.autocast():
+                    wavelengths, wavelengths_decoded = model_step(device, model, example, constants)
+                    loss, diff_loss = loss_fn(device, wavelengths, wavelengths_decoded, diff_weight)
 
                 tot_loss += loss.detach()
                 tot_diff_loss += diff_loss.detach()
@@ -174,7 +192,7 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
         # show matplotlib graph every 10 epochs
         if epoch % 10 == 0 or epoch == epochs - 1:
             # extract inputs
-            wavelengths = move_to(example['inputs']['wavelengths'], device)
+            wavelengths = example_wavelengths(device, example, constants)
 
             # output of autoencoder
             wavelengths_decoded = model(wavelengths)
@@ -223,8 +241,9 @@ def train_autoencoder(dataset_dir, save_model_dir, log_dir, params):
 
         # loop through examples
         for n_iter, example in enumerate(validation):
-            wavelengths, wavelengths_decoded = model_step(device, model, example)
-            loss, diff_loss = loss_fn(device, wavelengths, wavelengths_decoded, diff_weight)
+            with precision.autocast():
+                wavelengths, wavelengths_decoded = model_step(device, model, example, constants)
+                loss, diff_loss = loss_fn(device, wavelengths, wavelengths_decoded, diff_weight)
 
             tot_loss += loss.detach()
             tot_diff_loss += diff_loss.detach()
@@ -300,6 +319,9 @@ def main():
             ),
         },
 
+        # 'fp64', 'fp32', 'bf16' or 'fp16'
+        precision='fp64',
+
         train_params={
             'epochs': 200,
             'writer_interval': 10,
@@ -8,12 +8,22 @@ import pickle
 import copy
 import numpy as np
 import multiprocessing as mp
+import sys
+import timeit
+import argparse
 
 # own modules
-from dataset_utils import scale_example
+script_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = str(Path(script_dir).parents[1])
+sys.path.append(src_dir)
 
+from src.neural_nets.dataset_utils import scale_example, PackedDatasetWriter
 
-def interp_y_mix(y_mix):
+
+def interp_y_mix_loop(y_mix):
+    """
+    Reference (per layer) implementation of interp_y_mixs for a single column, kept for benchmarking.
+    """
     interp_y_mix = y_mix.clone()
 
     # loop over layers
@@ -48,15 +58,52 @@ def interp_y_mix(y_mix):
     return interp_y_mix
 
 
-def interpolate_y_mixs(y_mixs):
-    interp_y_mixs = y_mixs.clone()
+def interp_y_mixs(y_mixs, dim=-2):
+    """
+    Linearly interpolate the nan values of y_mixs along the height layer dimension, for all species (and time
+    steps) at once. Leading nans take the first non-nan value of their column and trailing nans the last one.
+
+    Args:
+        y_mixs: torch.Tensor, [..., height_layers, num_species] for dim=-2
+        dim: int, height layer dimension
+
+    Returns:
+        interp_y_mixs: torch.Tensor, y_mixs without nans
+    """
+    y = y_mixs.movedim(dim, -1)    # [..., height_layers]
+    nans = torch.isnan(y)
+
+    if not nans.any():
+        return y_mixs.clone()
+
+    if nans.all(dim=-1).any():
+        raise ValueError('All non-nan element found for interpolation!')
 
-    # loop over mixing ratios
-    for i_y in range(y_mixs.shape[-1]):
-        y_mix = y_mixs[:, i_y]  # [height_layers]
-        interp_y_mixs[:, i_y] = interp_y_mix(y_mix)
+    num_layers = y.shape[-1]
+    layers = torch.arange(num_layers, device=y.device).expand_as(y)
 
-    return interp_y_mixs
+    # index of the previous and next non-nan layer, by forward and backward fill of the non-nan indices
+    prev_idx = torch.where(nans, -1, layers).cummax(dim=-1).values
+    next_idx = torch.where(nans, num_layers, layers).flip(-1).cummin(dim=-1).values.flip(-1)
+
+    has_prev = prev_idx >= 0
+    has_next = next_idx < num_layers
+
+    prev_value = y.gather(-1, prev_idx.clamp(min=0))
+    next_value = y.gather(-1, next_idx.clamp(max=num_layers - 1))
+
+    # in the dtype of y, int64 / int64 gives float32 weights
+    weight = (layers - prev_idx).to(y.dtype) / (next_idx - prev_idx).clamp(min=1).to(y.dtype)
+    interp_value = prev_value + (next_value - prev_value) * weight
+
+    fill_value = torch.where(has_prev & has_next, interp_value, torch.where(has_prev, prev_value, next_value))
+    interp_y = torch.where(nans, fill_value, y)
+
+    return interp_y.movedim(-1, dim)
+
+
+def interpolate_y_mixs(y_mixs):
+    return interp_y_mixs(y_mixs, dim=-2)    # [height_layers, num_species] or [steps, height_layers, num_species]
 
 
 def interpolate_example(scaled_example, time_series=False):
@@ -64,28 +111,45 @@ def interpolate_example(scaled_example, time_series=False):
     interp_example['inputs']['y_mix_ini'] = interpolate_y_mixs(scaled_example['inputs']['y_mix_ini'])
 
     if time_series:
-        for i_y_mix in range(interp_example['outputs']['y_mixs'].shape[0]):    # (steps, height_layers, num_species)
-            interp_example['outputs']['y_mixs'][i_y_mix, :, :] = interpolate_y_mixs(interp_example['outputs']['y_mixs'][i_y_mix, :, :])
+        # (steps, height_layers, num_species) in one go
+        interp_example['outputs']['y_mixs'] = interpolate_y_mixs(scaled_example['outputs']['y_mixs'])
     else:
         interp_example['outputs']['y_mix'] = interpolate_y_mixs(scaled_example['outputs']['y_mix'])
     return interp_example
 
 
-def interpolate_torch_file(params):
-    torch_file, interp_ds_dir, scaling_dict, time_series = params
-    example = torch.load(torch_file)
+def scale_interpolate_example(params):
+    idx, example, scaling_dict, time_series = params
 
     scaled_example = scale_example(example, scaling_dict, nans=True)
     interp_example = interpolate_example(scaled_example, time_series=time_series)
 
+    return idx, interp_example
+
+
+def interpolate_torch_file(params):
+    torch_file, interp_ds_dir, scaling_dict, time_series, packed = params
+    example = torch.load(torch_file)
+
+    _, interp_example = scale_interpolate_example((None, example, scaling_dict, time_series))
+
     torch_filename = os.path.basename(torch_file)
+
+    # packed examples are written by the main process
+    if packed:
+        return int(torch_filename[:-3]), interp_example
+
     interp_torch_file = os.path.join(interp_ds_dir, torch_filename)
     torch.save(interp_example, interp_torch_file)
 
     return 0
 
 
-def interpolate_dataset(ds_dir, num_workers, time_series=False):
+def interpolate_dataset(ds_dir, num_workers, time_series=False, packed=False):
+    """
+    Scale and interpolate all examples in ds_dir into ds_dir/interpolated_dataset. If packed, the
+    interpolated_dataset is written as a packed dataset (load with PackedVulcanDataset) instead of .pt files.
+    """
     interp_ds_dir = os.path.join(ds_dir, 'interpolated_dataset')
 
     # remake the config directory
@@ -100,29 +164,97 @@ def interpolate_dataset(ds_dir, num_workers, time_series=False):
 
     torch_files = glob.glob(os.path.join(ds_dir, '*.pt'))
 
-    if num_workers > 1:
-        mp_params = [(torch_file, interp_ds_dir, scaling_dict, time_series) for torch_file in torch_files]
+    mp_params = [(torch_file, interp_ds_dir, scaling_dict, time_series, packed) for torch_file in torch_files]
+
+    if packed:
+        num_examples = max(int(os.path.basename(torch_file)[:-3]) for torch_file in torch_files) + 1
+        writer = PackedDatasetWriter(interp_ds_dir, num_examples)
 
+    if num_workers > 1:
         print(f'running with {num_workers} workers...')
         with mp.get_context("spawn").Pool(processes=num_workers) as pool:
-            results = list(tqdm(
-                pool.imap(interpolate_torch_file, mp_params),  # return results otherwise it doesn't work properly
-                                total=len(mp_params), desc='interpolating and scaling torch files'))
+            results = tqdm(pool.imap(interpolate_torch_file, mp_params),
+                           total=len(mp_params), desc='interpolating and scaling torch files')
+            if packed:
+                for idx, interp_example in results:
+                    writer.write(idx, interp_example)
+            else:
+                results = list(results)  # return results otherwise it doesn't work properly
 
     else:
         # loop through examples
-        for torch_file in tqdm(torch_files, desc='interpolating and scaling torch files'):
-            interpolate_torch_file((torch_file, scaling_dict))
+        for params in tqdm(mp_params, desc='interpolating and scaling torch files'):
+            result = interpolate_torch_file(params)
+            if packed:
+                writer.write(*result)
+
+    if packed:
+        writer.close()
+
+
+def benchmark_interpolation(ds_dir, num_examples=10, time_series=False):
+    """
+    Time interpolate_y_mixs against the per layer loop on scaled examples of ds_dir.
+
+    The results differ for nans below the last non-nan layer of a column: the loop never stops scanning
+    upwards, so it uses the topmost non-nan layer instead of the nearest one (and skips values of exactly 0).
+    """
+    # get scaling parameters
+    scaling_file = os.path.join(ds_dir, 'scaling_dict.pkl')
+    with open(scaling_file, 'rb') as f:
+        scaling_dict = pickle.load(f)
+
+    torch_files = glob.glob(os.path.join(ds_dir, '*.pt'))[:num_examples]
+    key = 'y_mixs' if time_series else 'y_mix'
+
+    loop_time = 0
+    vectorized_time = 0
+    max_diff = 0
+    num_nans = 0
+    for torch_file in tqdm(torch_files, desc='benchmarking interpolation'):
+        scaled_example = scale_example(torch.load(torch_file), scaling_dict, nans=True)
+        blocks = [scaled_example['inputs']['y_mix_ini'], scaled_example['outputs'][key]]
+
+        for y_mixs in blocks:
+            num_nans += torch.isnan(y_mixs).sum().item()
+
+            start = timeit.default_timer()
+            columns = y_mixs.reshape(-1, *y_mixs.shape[-2:])
+            loop_result = torch.stack([
+                torch.stack([interp_y_mix_loop(y_mix[:, i_y]) for i_y in range(y_mix.shape[-1])], dim=-1)
+                for y_mix in columns
+            ]).reshape(y_mixs.shape)
+            loop_time += timeit.default_timer() - start
 
+            start = timeit.default_timer()
+            vectorized_result = interpolate_y_mixs(y_mixs)
+            vectorized_time += timeit.default_timer() - start
 
-def main():
+            max_diff = max(max_diff, torch.max(torch.abs(loop_result - vectorized_result)).item())
+
+    print(f'{len(torch_files)} examples, {num_nans} nans')
+    print(f'loop:       {loop_time / len(torch_files) * 1e3:.3f} ms per example')
+    print(f'vectorized: {vectorized_time / len(torch_files) * 1e3:.3f} ms per example')
+    print(f'speedup:    {loop_time / vectorized_time:.1f}x')
+    print(f'{max_diff = }')
+
+
+def main(benchmark):
     # setup directories
     script_dir = os.path.dirname(os.path.abspath(__file__))
     MRP_dir = str(Path(script_dir).parents[1])
     dataset_dir = os.path.join(MRP_dir, 'data/bday_dataset/dataset')
 
-    interpolate_dataset(dataset_dir, num_workers=mp.cpu_count() - 1, time_series=False)
+    if benchmark:
+        benchmark_interpolation(dataset_dir, time_series=False)
+    else:
+        interpolate_dataset(dataset_dir, num_workers=mp.cpu_count() - 1, time_series=False)
 
 
 if __name__ == '__main__':
-    main()
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Scale and interpolate the dataset')
+    parser.add_argument('-b', '--benchmark', help='Benchmark the interpolation instead', action='store_true')
+    args = vars(parser.parse_args())
+
+    main(args['benchmark'])
@@ -0,0 +1,77 @@
+from contextlib import nullcontext
+
+import torch
+
+# parameter (and data) dtype and autocast dtype per precision
+PRECISIONS = {
+    'fp64': (torch.float64, None),
+    'fp32': (torch.float32, None),
+    'bf16': (torch.float32, torch.bfloat16),
+    'fp16': (torch.float32, torch.float16),
+}
+
+# accepted relative difference of the validation loss with the model trained in fp64
+PARITY_TOLERANCE = 0.05
+
+
+class PrecisionPolicy:
+    """
+    Precision of training a model: 'fp64' (everything in double, as before), 'fp32', or float parameters with
+    'bf16' or 'fp16' autocast. fp16 uses gradient scaling to avoid underflowing gradients, and is meant for CUDA
+    (not all CPU kernels support it, e.g. the LSTM).
+
+    The log scaling of the dataset (scale and unscale in dataset_utils) is always done in double, only its
+    results are cast to the policy dtype.
+    """
+
+    def __init__(self, precision='fp64', device=torch.device('cpu')):
+        if precision not in PRECISIONS:
+            raise ValueError(f'precision not supported: {precision}, use one of {list(PRECISIONS.keys())}')
+
+        self.precision = precision
+        self.device = device
+        self.dtype, self.autocast_dtype = PRECISIONS[precision]
+        self.scaler = torch.amp.GradScaler(device.type, enabled=precision == 'fp16')
+
+    def model(self, model):
+        """
+        Move a model to the device with the parameter dtype of the policy.
+        """
+        return model.to(device=self.device, dtype=self.dtype)
+
+    def autocast(self):
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype)
+
+    def backward_step(self, loss, optimizer):
+        """
+        loss.backward() and optimizer.step(), with gradient scaling for fp16.
+        """
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+
+def parity_error(validation_loss, model, reference_model, policy):
+    """
+    Relative difference of the validation loss of model, trained with the precision policy, and of
+    reference_model, the same model trained in fp64. Used to check that training in a lower precision doesn't
+    cost accuracy, a difference up to PARITY_TOLERANCE is accepted.
+
+    Args:
+        validation_loss: function(model, dtype, autocast) -> float, mean loss over the validation set with the
+            parameters and inputs in dtype, inside the autocast context
+        model: torch.nn.Module, in the policy dtype
+        reference_model: torch.nn.Module, in float64
+        policy: PrecisionPolicy
+
+    Returns:
+        error: float
+        loss: float, validation loss of model
+        reference_loss: float, validation loss of reference_model
+    """
+    loss = validation_loss(model, policy.dtype, policy.autocast)
+    reference_loss = validation_loss(reference_model, torch.float64, nullcontext)
+
+    return abs(loss - reference_loss) / abs(reference_loss), loss, reference_loss
@@ -5,6 +5,10 @@ import csv
 import sys
 import os
 import shutil
+import io
+import hashlib
+import multiprocessing as mp
+from tqdm import tqdm
 from astropy.io import fits
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -28,6 +32,13 @@ TEMP_grid = np.linspace(3000, 6000, 61)
 au = 1.4959787e13
 r_sun = 6.957e10
 
+# default on-disk spectrum cache, in the data dir. Change the version when the spectrum creation changes
+spectrum_cache_dir = os.path.normpath(os.path.join(script_dir, '../../data/spectrum_cache'))
+SPECTRUM_VERSION = 'v2'
+
+# MUSCLES data of this process, see load_MUSCLES
+MUSCLES_data = None
+
 
 # Functions to open and save hdf5 files
 def save_dict_to_hdf5(dic, filename):
@@ -122,16 +133,123 @@ def read_MUSCLES():
     return MUS
 
 
-def create_specs(TEMP_grid, output_dir, save_to_txt=False):
+def load_MUSCLES():
     '''
-		Function to create the stellar spectra with
+		MUSCLES data, read only once per process
 	'''
 
-    MUS = read_MUSCLES()
+    global MUSCLES_data
+    if MUSCLES_data is None:
+        MUSCLES_data = read_MUSCLES()
+    return MUSCLES_data
+
+
+def make_spec(T, MUS):
+    '''
+		Create the stellar spectrum for temperature T, returns (wavs_total, flux_total, T_diff, spec_diff)
+	'''
 
     Temps_MUS = np.array(list(MUS.values()), dtype=object)[:, 0]
     names_MUS = list(MUS.keys())
 
+    Tdiff_indx = np.argmin(abs(Temps_MUS - T))
+
+    stellar_spec = nc.get_PHOENIX_spec(T)
+
+    wlen = stellar_spec[:, 0]  # *1e8
+    flux_star = stellar_spec[:, 1]
+    flux_star = flux_star * (3e10) / (wlen ** 2)
+    wlen = stellar_spec[:, 0] * 1e8
+    flux_star = flux_star * 1e-8
+
+    # If the difference in MUSCLES star temperature and evaluated temperature is too big,
+    # simply use the PHOENIX spectra solely
+    if abs(Temps_MUS[Tdiff_indx] - T) > 1000:
+        # print('Using PHOENIX')
+        return np.copy(wlen), np.copy(flux_star), 1, 1
+
+    # Otherwise stitch the MUSCLES UV part with the PHOENIX spectrum
+    # print('Stitching MUSCLES UV')
+    name_MUS = names_MUS[Tdiff_indx]
+    flux_MUS = MUS[name_MUS][3] * ((63241 * au * MUS[name_MUS][1] * 3.262 / (r_sun * MUS[name_MUS][2])) ** 2)
+    wavs_MUS = MUS[name_MUS][4]
+
+    flux_total = np.concatenate((flux_MUS, flux_star[np.where(wlen > max(wavs_MUS))[0]]))
+    wavs_total = np.concatenate((wavs_MUS, wlen[np.where(wlen > max(wavs_MUS))[0]]))
+
+    T_diff = Temps_MUS[Tdiff_indx] - T
+    spec_diff = get_diff(flux_MUS, flux_star[np.where(wlen > max(wavs_MUS))[0]])
+
+    # If the PHOENIX spectrum is more than 2 times bigger than the MUSCLES spectrum
+    # at the same wavelength point (where they are stitched), also use the PHOENIX
+    # spectrum solely
+    if spec_diff > 2:
+        # print('Spectral difference too big! - switching back to PHOENIX')
+        return np.copy(wlen), np.copy(flux_star), 1, 1
+
+    return wavs_total, flux_total, T_diff, spec_diff
+
+
+def spec_to_array(wavs_total, flux_total):
+    '''
+		Spectrum in the units VULCAN reads (nm, erg / (nm cm2 s)), up to 10000 nm, as a structured array with
+		the fields VULCAN uses for sflux_raw ('lambda', 'flux')
+	'''
+
+    wavs = wavs_total * 0.1
+    flux = flux_total * 10
+
+    # up to the first wavelength above 10000 nm
+    above = np.flatnonzero(wavs > 10000.)
+    num_points = above[0] if len(above) > 0 else len(wavs)
+
+    sflux = np.empty(num_points, dtype=[('lambda', float), ('flux', float)])
+    sflux['lambda'] = wavs[:num_points]
+    sflux['flux'] = flux[:num_points]
+
+    return sflux
+
+
+def spec_to_txt(sflux):
+    '''
+		Text of a spectrum array in the format VULCAN reads
+	'''
+
+    buffer = io.StringIO()
+    np.savetxt(buffer, np.column_stack((sflux['lambda'], sflux['flux'])), fmt='%.17g', delimiter='\t',
+               header='Wavelength (nm),' + '\t' + 'Flux (erg / (nm cm2 s))', comments='')
+
+    return buffer.getvalue()
+
+
+def sidecar_file(txt_file):
+    '''
+		Binary (.npy) version of a spectrum txt file, read by VulcanWorker instead of parsing the text
+	'''
+
+    return os.path.splitext(txt_file)[0] + '.npy'
+
+
+def save_spec(txt_file, sflux, text=None):
+    '''
+		Save a spectrum as txt file (for VULCAN) with its .npy sidecar, both written atomically
+	'''
+
+    write_atomic(txt_file, spec_to_txt(sflux) if text is None else text)
+
+    # sidecar after the text, so it's never older
+    tmp_file = f'{sidecar_file(txt_file)}.{os.getpid()}.tmp.npy'
+    np.save(tmp_file, sflux)
+    os.replace(tmp_file, sidecar_file(txt_file))
+
+
+def create_specs(TEMP_grid, output_dir, save_to_txt=False):
+    '''
+		Function to create the stellar spectra with
+	'''
+
+    MUS = load_MUSCLES()
+
     spec_diff = np.zeros(len(TEMP_grid))
     T_diff = np.zeros_like(spec_diff)
 
@@ -139,81 +257,110 @@ def create_specs(TEMP_grid, output_dir, save_to_txt=False):
     for i in range(len(TEMP_grid)):
         T = TEMP_grid[i]
 
-        Tdiff_indx = np.argmin(abs(Temps_MUS - T))
+        wavs_total, flux_total, T_diff[i], spec_diff[i] = make_spec(T, MUS)
 
-        stellar_spec = nc.get_PHOENIX_spec(T)
+        # Saving the spectrum to txt file such that it can be used straight away in
+        # VULCAN
+        if save_to_txt:
 
-        # If the difference in MUSCLES star temperature and evaluated temperature is too big,
-        # simply use the PHOENIX spectra solely
-        if abs(Temps_MUS[Tdiff_indx] - T) > 1000:
-            # print('Using PHOENIX')
-            wlen = stellar_spec[:, 0]  # *1e8
-            flux_star = stellar_spec[:, 1]
-            flux_star = flux_star * (3e10) / (wlen ** 2)
-            wlen = stellar_spec[:, 0] * 1e8
-            flux_star = flux_star * 1e-8
+            txt_file = os.path.join(output_dir, f'{T}_K.txt')
 
-            flux_total = np.copy(flux_star)
-            wavs_total = np.copy(wlen)
+            if not os.path.isfile(txt_file):
+                save_spec(txt_file, spec_to_array(wavs_total, flux_total))
 
-            T_diff[i] = 1
-            spec_diff[i] = 1
+    return txt_file
 
-            # continue
 
-        # Otherwise stitch the MUSCLES UV part with the PHOENIX spectrum
-        else:
-            # print('Stitching MUSCLES UV')
-            wlen = stellar_spec[:, 0]  # *1e8
-            flux_star = stellar_spec[:, 1]
-            flux_star = flux_star * (3e10) / (wlen ** 2)
-            wlen = stellar_spec[:, 0] * 1e8
-            flux_star = flux_star * 1e-8
-
-            name_MUS = names_MUS[Tdiff_indx]
-            flux_MUS = MUS[name_MUS][3] * ((63241 * au * MUS[name_MUS][1] * 3.262 / (r_sun * MUS[name_MUS][2])) ** 2)
-            wavs_MUS = MUS[name_MUS][4]
-
-            flux_total = np.concatenate((flux_MUS, flux_star[np.where(wlen > max(wavs_MUS))[0]]))
-            wavs_total = np.concatenate((wavs_MUS, wlen[np.where(wlen > max(wavs_MUS))[0]]))
-
-            T_diff[i] = Temps_MUS[Tdiff_indx] - T
-            spec_diff[i] = get_diff(flux_MUS, flux_star[np.where(wlen > max(wavs_MUS))[0]])
-
-            # If the PHOENIX spectrum is more than 2 times bigger than the MUSCLES spectrum
-            # at the same wavelength point (where they are stitched), also use the PHOENIX
-            # spectrum solely
-            if spec_diff[i] > 2:
-                # print('Spectral difference too big! - switching back to PHOENIX')
-                flux_total = np.copy(flux_star)
-                wavs_total = np.copy(wlen)
-                T_diff[i] = 1
-                spec_diff[i] = 1
-
-            # Saving the spectrum to txt file such that it can be used straight away in
-        # VULCAN
-        if save_to_txt:
+def quantize_temperature(T, resolution=1.):
+    '''
+		Round T to the resolution (in K) of the spectrum cache
+	'''
 
-            wavs = wavs_total * 0.1
-            flux = flux_total * 10
+    return float(np.round(T / resolution) * resolution)
 
-            new_str = 'Wavelength (nm),' + '\t' + 'Flux (erg / (nm cm2 s))' + '\n'
 
-            for j in range(len(wavs)):
+def write_atomic(file, text):
+    tmp_file = f'{file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file, file)
 
-                if wavs[j] > 10000.:
-                    break
-                new_str += str(wavs[j]) + '\t' + str(flux[j]) + '\n'
 
-            txt_file = os.path.join(output_dir, f'{T}_K.txt')
+def cached_spec_file(T, cache_dir=None):
+    '''
+		Spectrum file of temperature T from the content-addressed cache, creating it if it isn't cached.
+		Keys (temperature and spectrum version) point to objects named by the hash of their content.
+	'''
 
-            if not os.path.isfile(txt_file):
-                with open(txt_file, 'w') as f:
-                    f.write(new_str)
+    if cache_dir is None:
+        cache_dir = spectrum_cache_dir
+    key_dir = os.path.join(cache_dir, 'keys')
+    object_dir = os.path.join(cache_dir, 'objects')
+    os.makedirs(key_dir, exist_ok=True)
+    os.makedirs(object_dir, exist_ok=True)
+
+    key_file = os.path.join(key_dir, f'{SPECTRUM_VERSION}_{T}_K')
+    if os.path.isfile(key_file):
+        with open(key_file, 'r') as f:
+            object_file = os.path.join(object_dir, f'{f.read().strip()}.txt')
+        if os.path.isfile(object_file) and os.path.isfile(sidecar_file(object_file)):
+            return object_file
+
+    wavs_total, flux_total, _, _ = make_spec(T, load_MUSCLES())
+    sflux = spec_to_array(wavs_total, flux_total)
+    text = spec_to_txt(sflux)
+
+    content_hash = hashlib.sha1(text.encode()).hexdigest()
+    object_file = os.path.join(object_dir, f'{content_hash}.txt')
+    if not os.path.isfile(object_file) or not os.path.isfile(sidecar_file(object_file)):
+        save_spec(object_file, sflux, text)
+    write_atomic(key_file, content_hash)
+
+    return object_file
+
+
+def create_cached_spec(mp_params):
+    '''
+		Spectrum file of temperature T in output_dir, taken from the cache
+	'''
+
+    (T, output_dir, cache_dir) = mp_params
+
+    txt_file = os.path.join(output_dir, f'{T}_K.txt')
+    if not os.path.isfile(txt_file) or not os.path.isfile(sidecar_file(txt_file)):
+        object_file = cached_spec_file(T, cache_dir)
+
+        # sidecar last, so it's never older than the txt file
+        for src, dst in [(object_file, txt_file), (sidecar_file(object_file), sidecar_file(txt_file))]:
+            if os.path.isfile(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
 
     return txt_file
 
 
+def create_specs_parallel(TEMP_grid, output_dir, num_workers, resolution=1., cache_dir=None):
+    '''
+		Create the spectra of all unique (quantized) temperatures in TEMP_grid in parallel, using the cache.
+		Returns a list with the spectrum file of every temperature in TEMP_grid.
+	'''
+
+    T_quantized = [quantize_temperature(T, resolution) for T in TEMP_grid]
+    unique_T = sorted(set(T_quantized))
+
+    mp_params = [(T, output_dir, cache_dir) for T in unique_T]
+    with mp.Pool(min(num_workers, len(mp_params)) or 1) as p:
+        txt_files = list(tqdm(p.imap(create_cached_spec, mp_params),  # return results otherwise it doesn't work properly
+                              total=len(mp_params)))
+
+    spec_files = dict(zip(unique_T, txt_files))
+
+    return [spec_files[T] for T in T_quantized]
+
+
 def get_diff(spec_A, spec_B):
     '''
 		Function to get ratio between Phoenix and Muscles, can
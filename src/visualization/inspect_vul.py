@@ -3,8 +3,16 @@ import numpy as np
 import pickle
 import os
 import glob
+import sys
 from pathlib import Path
 
+# own modules
+script_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = str(Path(script_dir).parents[1])
+sys.path.append(src_dir)
+
+from src.vulcan_configs.vul_reader import VulReader
+
 def inspect_vul():
     # setup directories
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -18,22 +26,16 @@ def inspect_vul():
 
     vulcan_file = np.random.choice(vulcan_files)
 
-    # extract data
-    with open(vulcan_file, 'rb') as handle:
-        data = pickle.load(handle)
-
-
-    for key, value in data.items():
-        print(key)
-        for k, v in value.items():
-            print(k)
-        print('\n')
-
-    ins_data = data['variable']['y_time']
+    # extract data, converted outputs are read per key
+    with VulReader(vulcan_file) as reader:
+        for key in reader.keys():
+            print(key)
+            for k in reader.keys(key):
+                print(k)
+            print('\n')
 
-    # print(ins_data)
-    print(ins_data.shape)
-    print(type(ins_data))
+        # print(reader.read('variable', 'y_time'))
+        print(reader.shape('variable', 'y_time'))
 
 
 def plot_times():
@@ -1,5 +1,6 @@
 import matplotlib.pyplot as plt
 import os
+import sys
 import glob
 import pickle
 import shutil
@@ -7,6 +8,13 @@ import multiprocessing as mp
 from tqdm import tqdm
 from pathlib import Path
 
+# own modules
+script_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = str(Path(script_dir).parents[1])
+sys.path.append(src_dir)
+
+from src.vulcan_configs.vul_reader import VulReader
+
 use_height = False
 
 # plot_spec = ('H', 'O', 'C', 'N')
@@ -27,9 +35,12 @@ def plot_vulcan_file(params):
     filename = os.path.basename(vulcan_file)
     plot_filename = os.path.join(plot_dir, f'{filename[:-4]}.png')
 
-    # extract data
-    with open(vulcan_file, 'rb') as handle:
-        data = pickle.load(handle)
+    # extract data, only the keys needed for plotting
+    with VulReader(vulcan_file) as reader:
+        data = {
+            'variable': {key: reader.read('variable', key) for key in ('species', 'ymix')},
+            'atm': {key: reader.read('atm', key) for key in ('pco', 'zco', 'zmco')}
+        }
 
     # plotting takes from plot_vulcan.py
     vulcan_spec = data['variable']['species']
@@ -3,6 +3,9 @@ import glob
 from pathlib import Path
 import argparse
 
+from run_ledger import RunLedger, CREATED, RUNNING, FAILED
+from scan_outputs import scan_outputs
+
 
 def main(remove):
     print(f'{remove = }')
@@ -13,37 +16,41 @@ def main(remove):
     
     script_dir = os.path.dirname(os.path.abspath(__file__))
     git_dir = str(Path(script_dir).parents[1])
-    std_output = os.path.join(git_dir, f'{dataset}/vulcan_output/std_output')
     output_dir = os.path.join(git_dir, f'{dataset}/vulcan_output/')
     config_dir = os.path.join(git_dir, f'{dataset}/configs/')
 
-    # check for missing runs
-    std_out_files = glob.glob(os.path.join(std_output, '*.txt'))
-    std_out_file_names = [f'{os.path.basename(f)[11:-4]}' for f in std_out_files]
-
+    # update run ledger with the config and output files
+    run_ledger = RunLedger()
     cfg_files = glob.glob(os.path.join(config_dir, '*.py'))
-    cfg_file_names = [f'{os.path.basename(f)[11:-3]}' for f in cfg_files]
+    num_added = run_ledger.add_config_files(cfg_files)
+    num_synced = run_ledger.sync_outputs(output_dir)
 
-    output_files = glob.glob(os.path.join(output_dir, '*.vul'))
-    output_file_names = [f'{os.path.basename(f)[7:-4]}' for f in output_files]
-
-    print(f'{len(std_out_files) = }')
     print(f'{len(cfg_files) = }')
-    print(f'{len(output_files) = }')
+    print(f'{num_added = }')
+    print(f'{num_synced = }')
+    print(f'{run_ledger.counts() = }')
 
-    std_not_in_output = []
-    print('\nstd files not in output')
-    for i, std_out_file_name in enumerate(std_out_file_names):
-        if std_out_file_name not in output_file_names:
-            std_not_in_output.append(std_out_files[i])
-            print(f'file {i}: {std_out_file_name}')
+    # started but no output
+    std_not_in_output = sorted(run_ledger.configs_with_status(RUNNING, FAILED))
+    print('\nruns started but not in output')
+    for i, name in enumerate(std_not_in_output):
+        print(f'file {i}: {name}')
 
-    cfg_not_in_output = []
+    not_done = run_ledger.configs_with_status(CREATED, RUNNING, FAILED)
+    cfg_not_in_output = [cfg_file for cfg_file in cfg_files if os.path.basename(cfg_file)[11:-3] in not_done]
     print('\ncfg files not in output')
-    for i, cfg_file_name in enumerate(cfg_file_names):
-        if cfg_file_name not in output_file_names:
-            cfg_not_in_output.append(cfg_files[i])
-            print(f'file {i}: {cfg_file_name}')
+    for i, cfg_file in enumerate(cfg_not_in_output):
+        print(f'file {i}: {os.path.basename(cfg_file)[11:-3]}')
+
+    # truncated and non-converged outputs
+    # outputs are checked in full once, the scan cache keeps the result until they change
+    report = scan_outputs(output_dir, config_dir, num_workers=max(os.cpu_count() - 1, 1), verify=True)
+    print('\ntruncated outputs')
+    for i, name in enumerate(report['truncated']):
+        print(f'file {i}: {name}')
+    print('\nnot converged outputs (end_case)')
+    for i, (name, end_case) in enumerate(report['not_converged'].items()):
+        print(f'file {i}: {name} ({end_case})')
 
     # remove missing output cfg files
     if remove:
@@ -0,0 +1,89 @@
+import hashlib
+import numpy as np
+from scipy import sparse
+
+# number of wavelength bins of the top flux in the dataset inputs
+NUM_FLUX_BINS = 2500
+
+# {(source grid hash, bins hash): resampling matrix} of this process
+resampling_cache = {}
+
+
+def flux_bins(bin_min, bin_max, num_bins=NUM_FLUX_BINS):
+    """
+    Wavelength bins of the dataset top flux: num_bins points evenly spaced over [bin_min, bin_max] (the first and
+    last VULCAN bin in vulcan_worker).
+    """
+    return np.linspace(bin_min, bin_max, num_bins)
+
+
+def linear_resampling_matrix(source, target):
+    """
+    Sparse matrix M with M @ y equal to interp1d(source, y, bounds_error=False, fill_value=0)(target), also at
+    duplicate source wavelengths.
+
+    Args:
+        source: (np.ndarray) [n] source wavelengths, not necessarily sorted
+        target: (np.ndarray) [m] target wavelengths
+
+    Returns:
+        M: (scipy.sparse.csr_matrix) [m, n], at most two non-zeros per row
+    """
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+
+    order = np.argsort(source, kind='stable')
+    sorted_source = source[order]
+
+    # same bracketing as interp1d (np.interp): lo is the last source point <= target, so at duplicate source
+    # wavelengths the value of the last duplicate is used
+    hi = np.clip(np.searchsorted(sorted_source, target, side='right'), 1, len(source) - 1)
+    lo = hi - 1
+    # the bracket only has zero width at the last source point, where target is the value at hi
+    width = sorted_source[hi] - sorted_source[lo]
+    weight = np.divide(target - sorted_source[lo], width, out=np.ones_like(target), where=width > 0)
+
+    # outside the source grid the flux is 0
+    inside = (target >= sorted_source[0]) & (target <= sorted_source[-1])
+    rows = np.flatnonzero(inside)
+
+    data = np.concatenate([1. - weight[rows], weight[rows]])
+    row_index = np.concatenate([rows, rows])
+    column_index = np.concatenate([order[lo[rows]], order[hi[rows]]])
+
+    return sparse.csr_matrix((data, (row_index, column_index)), shape=(len(target), len(source)))
+
+
+def resampling_matrix(source, bins):
+    """
+    linear_resampling_matrix, cached on the source grid and the bins (the whole arrays, so any bins can be used).
+    """
+    source = np.ascontiguousarray(source, dtype=np.float64)
+    bins = np.ascontiguousarray(bins, dtype=np.float64)
+    key = (hashlib.sha1(source.tobytes()).hexdigest(), hashlib.sha1(bins.tobytes()).hexdigest())
+
+    if key not in resampling_cache:
+        resampling_cache[key] = linear_resampling_matrix(source, bins)
+
+    return resampling_cache[key]
+
+
+def resample_flux(source, flux, bins):
+    """
+    Linearly resample flux (zero outside the source grid) from the source wavelengths to the bins.
+
+    Args:
+        source: (np.ndarray) [n] source wavelengths
+        flux: (np.ndarray) [n] or [num_spectra, n] fluxes on the (shared) source grid
+        bins: (np.ndarray) [m] target wavelengths, e.g. from flux_bins
+
+    Returns:
+        resampled flux: (np.ndarray) [m] or [num_spectra, m]
+    """
+    M = resampling_matrix(source, bins)
+
+    flux = np.asarray(flux, dtype=np.float64)
+    if flux.ndim == 1:
+        return M @ flux
+
+    return (M @ flux.T).T
@@ -9,6 +9,7 @@ import multiprocessing as mp
 from astropy import units as u
 
 from vulcan_config_utils import make_valid_parameter_grid
+from run_ledger import RunLedger, CREATED
 
 
 def make_config(mp_params):
@@ -17,12 +18,12 @@ def make_config(mp_params):
     which should be in the same directory as this script.
 
     Args:
-        mp_params: (tuple) (params, configs_dir, output_dir)
+        mp_params: (tuple) (params, configs_dir, output_dir, script_dir, run_ledger)
 data
     Returns:
 
     """
-    (params, configs_dir, output_dir, script_dir, runs_index) = mp_params
+    (params, configs_dir, output_dir, script_dir, run_ledger) = mp_params
 
     # extract parameters
     orbit_radius = params['orbit_radius']
@@ -40,46 +41,42 @@ data
     dec = 3
     config_name = f'{round(orbit_radius,dec)}_{round(r_star,dec)}_{round(planet_mass,dec)}_{Z}'
 
-    # check if config has already been run
-    # (uses rounded values for check!)
-    with open(runs_index) as file:
-        contents=file.read()
-        if config_name in contents:
-            return 0
-        else:
-            pass
-
     config_filename = f'{configs_dir}/vulcan_cfg_{config_name}.py'
     output_name = f'output_{config_name}.vul'
 
-    # copy template file
-    shutil.copyfile(os.path.join(script_dir, 'vulcan_cfg_template.py'), config_filename)
-
-    # append to template file
-    with open(config_filename, 'a') as file:
-        text_to_append = f"output_dir = '{output_dir}'\n" \
-                         "plot_dir = 'plot/'\n" \
-                         "movie_dir = 'plot/movie/'\n" \
-                         f"out_name = '{output_name}'\n" \
-                         f"O_H = {Z} * 6.0618E-4\n" \
-                         f"C_H = {Z} * 2.7761E-4\n" \
-                         f"N_H = {Z} * 8.1853E-5\n" \
-                         f"S_H = {Z} * 1.3183E-5\n" \
-                         f"He_H = {He_H} * 0.09692\n" \
-                         f"para_warm = [120., {T_irr}, 0.1, 0.02, 1., 1.]\n" \
-                         "para_anaTP = para_warm\n" \
-                         f"sflux_file = '{sflux_file}'\n" \
-                         f"r_star = {r_star}\n" \
-                         f"Rp = {Rp}\n" \
-                         f"orbit_radius = {orbit_radius}\n" \
-                         f"gs = {gs}\n" \
-                         f"planet_mass = {planet_mass}"
-
-        file.write(text_to_append)
-    
-    # append filename to index file
-    with open(runs_index, "a") as file:
-        file.write("\n"+config_name)
+    # config is the template file with the parameters appended
+    with open(os.path.join(script_dir, 'vulcan_cfg_template.py'), 'r') as file:
+        template_text = file.read()
+
+    text_to_append = f"output_dir = '{output_dir}'\n" \
+                     "plot_dir = 'plot/'\n" \
+                     "movie_dir = 'plot/movie/'\n" \
+                     f"out_name = '{output_name}'\n" \
+                     f"O_H = {Z} * 6.0618E-4\n" \
+                     f"C_H = {Z} * 2.7761E-4\n" \
+                     f"N_H = {Z} * 8.1853E-5\n" \
+                     f"S_H = {Z} * 1.3183E-5\n" \
+                     f"He_H = {He_H} * 0.09692\n" \
+                     f"para_warm = [120., {T_irr}, 0.1, 0.02, 1., 1.]\n" \
+                     "para_anaTP = para_warm\n" \
+                     f"sflux_file = '{sflux_file}'\n" \
+                     f"r_star = {r_star}\n" \
+                     f"Rp = {Rp}\n" \
+                     f"orbit_radius = {orbit_radius}\n" \
+                     f"gs = {gs}\n" \
+                     f"planet_mass = {planet_mass}"
+
+    config_text = template_text + text_to_append
+
+    # check if config has already been run (uses rounded values for check!), adding it to the ledger if not.
+    # Configs that were made but not run yet are written again, the config directory is remade every time.
+    if not run_ledger.add_config(config_name, config_text, config_filename) and \
+            run_ledger.status(config_name) != CREATED:
+        return 0
+
+    # write config file
+    with open(config_filename, 'w') as file:
+        file.write(config_text)
 
     return 0
 
@@ -91,6 +88,7 @@ def main():
     configs_dir = os.path.join(git_dir, 'data/configs')
     output_dir_vulcan = '../../Emulator_VULCAN/data/vulcan_output/'  # vulcan needs a relative dir...
     sflux_dir = os.path.join(git_dir,'src/stellar_spectra/output')
+    spectrum_cache_dir = os.path.join(git_dir, 'data/spectrum_cache')    # kept between runs
 
     # index_dir : location of index of completed runs (for checking redundancies)
     #     for local runs: os.path.join(git_dir, 'index')
@@ -98,6 +96,11 @@ def main():
     index_dir = os.path.join(git_dir, 'index')
     runs_index = os.path.join(index_dir, 'runs_index.txt')
 
+    # ledger of all runs, seeded with the runs in the (legacy) runs index, done if their output is complete
+    run_ledger = RunLedger(os.path.join(index_dir, 'runs_ledger.sqlite'))
+    output_dir = os.path.join(str(Path(script_dir).parents[2]), 'Emulator_VULCAN/data/vulcan_output')
+    run_ledger.import_runs_index(runs_index, output_dir)
+
     num_workers = mp.cpu_count() - 1
 
     # remake the config directory
@@ -135,10 +138,11 @@ def main():
 
     # create parameter grid of valid configurations
     parameter_grid = ParameterGrid(parameter_ranges)
-    valid_parameter_grid = make_valid_parameter_grid(parameter_grid, num_workers, sflux_dir)
+    valid_parameter_grid = make_valid_parameter_grid(parameter_grid, num_workers, sflux_dir,
+                                                     cache_dir=spectrum_cache_dir)
 
     # make the mp parameters
-    mp_params = [(params, configs_dir, output_dir_vulcan, script_dir, runs_index) for params in valid_parameter_grid]
+    mp_params = [(params, configs_dir, output_dir_vulcan, script_dir, run_ledger) for params in valid_parameter_grid]
 
     # run mp Pool
     print('Generating vulcan_cfg files...')
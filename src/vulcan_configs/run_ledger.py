@@ -0,0 +1,257 @@
+import os
+import glob
+import time
+import socket
+import hashlib
+import sqlite3
+import psutil
+from pathlib import Path
+
+from runtime_scheduler import CONFIG_PARAMETERS, config_name, config_parameters
+from vul_reader import check_vul
+
+# statuses of a run, a run only moves forward except when it is restarted after failing or crashing
+CREATED = 'created'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+LEDGER_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    config_name TEXT PRIMARY KEY,
+    config_hash TEXT,
+    {', '.join(f'{parameter} REAL' for parameter in CONFIG_PARAMETERS)},
+    status TEXT NOT NULL,
+    config_file TEXT,
+    start_time REAL,
+    end_time REAL,
+    worker TEXT,
+    output_file TEXT,
+    output_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+"""
+
+
+def default_ledger_file():
+    """
+    index/runs_ledger.sqlite in the git directory.
+    """
+    git_dir = str(Path(os.path.dirname(os.path.abspath(__file__))).parents[1])
+    return os.path.join(git_dir, 'index', 'runs_ledger.sqlite')
+
+
+def config_hash(config_text):
+    return hashlib.sha1(config_text.encode()).hexdigest()
+
+
+def output_name(name):
+    return f'output_{name}.vul'
+
+
+class RunLedger:
+    """
+    SQLite ledger of all VULCAN runs, keyed on config name, shared by the config, run and check scripts.
+
+    Every process opens its own connection (the ledger can be passed to pool workers) and status transitions are
+    single conditional UPDATE statements, so concurrent workers can't claim the same run.
+    """
+
+    def __init__(self, ledger_file=None):
+        self.ledger_file = default_ledger_file() if ledger_file is None else ledger_file
+        self._connection = None
+        self._pid = None
+
+        os.makedirs(os.path.dirname(self.ledger_file), exist_ok=True)
+        with self.connection:
+            self.connection.executescript(LEDGER_SCHEMA)
+
+    def __getstate__(self):
+        # connections can't be pickled, every process opens its own
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.ledger_file, timeout=60.)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._pid = os.getpid()
+        return self._connection
+
+    def execute(self, query, params=()):
+        """
+        Execute a query in its own transaction, returns the cursor.
+        """
+        with self.connection:
+            return self.connection.execute(query, params)
+
+    def add_config(self, name, config_text=None, config_file=None, status=CREATED):
+        """
+        Add a config to the ledger, if it isn't in there already.
+
+        Returns:
+            added: (bool) False if the config was already in the ledger
+        """
+        parameters = config_parameters(f'vulcan_cfg_{name}.py')
+        if parameters is None:
+            parameters = [None] * len(CONFIG_PARAMETERS)
+        else:
+            parameters = [float(parameter) for parameter in parameters]
+
+        cursor = self.execute(
+            f'INSERT OR IGNORE INTO runs (config_name, config_hash, {", ".join(CONFIG_PARAMETERS)}, status, '
+            f'config_file) VALUES ({", ".join(["?"] * (len(CONFIG_PARAMETERS) + 4))})',
+            (name, None if config_text is None else config_hash(config_text), *parameters, status, config_file)
+        )
+        return cursor.rowcount == 1
+
+    def add_config_files(self, config_files):
+        """
+        Add config files that are not in the ledger yet, returns the number of added configs.
+        """
+        known = self.config_files()
+        num_added = 0
+        for config_file in config_files:
+            if config_name(config_file) in known:
+                continue
+            with open(config_file, 'r') as f:
+                config_text = f.read()
+            num_added += self.add_config(config_name(config_file), config_text, config_file)
+        return num_added
+
+    def import_runs_index(self, runs_index, output_dir=None):
+        """
+        Add the config names of a (legacy) runs_index.txt. Names are written to the runs index when the config is
+        made, not when the run finishes, so they are added as created runs, or as done runs if their output in
+        output_dir is complete.
+
+        Returns:
+            num_added: (int) number of configs that were not in the ledger yet
+        """
+        if not os.path.isfile(runs_index):
+            return 0
+
+        with open(runs_index, 'r') as f:
+            names = [line.strip() for line in f if line.strip() != '']
+
+        runs = []
+        for name in names:
+            output_file = None if output_dir is None else os.path.join(output_dir, output_name(name))
+            if output_file is not None and check_vul(output_file):
+                runs.append((name, DONE, output_file, os.path.getsize(output_file)))
+            else:
+                runs.append((name, CREATED, None, None))
+
+        with self.connection:
+            cursor = self.connection.executemany(
+                'INSERT OR IGNORE INTO runs (config_name, status, output_file, output_size) VALUES (?, ?, ?, ?)', runs
+            )
+        return cursor.rowcount
+
+    def start_run(self, name, worker=None):
+        """
+        Claim a run that was created or failed before and mark it as running.
+
+        Returns:
+            started: (bool) False if the run is running or done already, or not in the ledger
+        """
+        if worker is None:
+            worker = f'{socket.gethostname()}:{os.getpid()}'
+        cursor = self.execute(
+            'UPDATE runs SET status = ?, start_time = ?, end_time = NULL, worker = ? '
+            'WHERE config_name = ? AND status IN (?, ?)',
+            (RUNNING, time.time(), worker, name, CREATED, FAILED)
+        )
+        return cursor.rowcount == 1
+
+    def reset_stale_runs(self):
+        """
+        Mark runs as failed whose worker (on this host) died while running, so they can be restarted.
+        Returns the number of reset runs.
+        """
+        hostname = socket.gethostname()
+        stale = []
+        for name, worker in self.execute('SELECT config_name, worker FROM runs WHERE status = ?', (RUNNING,)):
+            host, _, pid = (worker or '').rpartition(':')
+            if host == hostname and pid.isdigit() and not psutil.pid_exists(int(pid)):
+                stale.append((FAILED, name, RUNNING))
+
+        with self.connection:
+            self.connection.executemany('UPDATE runs SET status = ? WHERE config_name = ? AND status = ?', stale)
+        return len(stale)
+
+    def finish_run(self, name, output_file):
+        """
+        Mark a running run as done if its output is complete (check_vul), as failed otherwise.
+        """
+        if check_vul(output_file):
+            status, output_size = DONE, os.path.getsize(output_file)
+        else:
+            status, output_size = FAILED, None
+
+        self.execute(
+            'UPDATE runs SET status = ?, end_time = ?, output_file = ?, output_size = ? WHERE config_name = ?',
+            (status, time.time(), output_file, output_size, name)
+        )
+        return status
+
+    def fail_run(self, name):
+        self.execute('UPDATE runs SET status = ?, end_time = ? WHERE config_name = ?', (FAILED, time.time(), name))
+
+    def sync_outputs(self, output_dir):
+        """
+        Mark runs with a complete output file (check_vul) in output_dir as done, e.g. outputs of runs from before
+        the ledger, and runs with an incomplete output as failed. Running runs are left alone, their output may
+        still be written. Returns the number of runs that were marked as done.
+        """
+        # only the outputs of runs that aren't done or running are checked
+        names = self.configs_with_status(CREATED, FAILED)
+        outputs = []
+        failed = []
+        for output_file in glob.glob(os.path.join(output_dir, 'output_*.vul')):
+            name = os.path.basename(output_file).removeprefix('output_').removesuffix('.vul')
+            if name not in names:
+                continue
+            if check_vul(output_file):
+                outputs.append((output_file, os.path.getsize(output_file), name, CREATED, FAILED))
+            else:
+                failed.append((name, CREATED))
+
+        with self.connection:
+            self.connection.executemany(
+                f"UPDATE runs SET status = '{FAILED}' WHERE config_name = ? AND status = ?", failed
+            )
+            cursor = self.connection.executemany(
+                f"UPDATE runs SET status = '{DONE}', output_file = ?, output_size = ? "
+                "WHERE config_name = ? AND status IN (?, ?)",
+                outputs
+            )
+        return cursor.rowcount
+
+    def status(self, name):
+        row = self.execute('SELECT status FROM runs WHERE config_name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def configs_with_status(self, *statuses):
+        """
+        Set of config names with one of the given statuses.
+        """
+        rows = self.execute(
+            f'SELECT config_name FROM runs WHERE status IN ({", ".join(["?"] * len(statuses))})', statuses
+        )
+        return set(row[0] for row in rows)
+
+    def config_files(self):
+        """
+        {config_name: config_file} of all configs in the ledger.
+        """
+        return dict(self.execute('SELECT config_name, config_file FROM runs').fetchall())
+
+    def counts(self):
+        """
+        {status: number of runs}
+        """
+        return dict(self.execute('SELECT status, COUNT(*) FROM runs GROUP BY status').fetchall())
@@ -6,16 +6,20 @@ import numpy as np
 from tqdm import tqdm
 import shutil
 import multiprocessing as mp
-from multiprocessing.managers import BaseManager
 import random
 import time
 from contextlib import redirect_stdout, redirect_stderr
 import psutil
+import socket
 from pathlib import Path
 import argparse
 
 # own module
-from vulcan_config_utils import CopyManager
+from vulcan_config_utils import CopyScheduler
+from vulcan_worker import init_vulcan_worker, get_vulcan_worker
+from runtime_scheduler import RuntimeLog, schedule_configs, config_name
+from run_ledger import RunLedger, output_name, DONE
+from vul_reader import convert_vul
 
 # TODO: don't know if this is nescessary
 # Limiting the number of threads
@@ -23,17 +27,17 @@ os.environ["OMP_NUM_THREADS"] = "1"
 
 
 def run_vulcan(params):
-    (config_file, copy_manager, std_output_dir) = params
+    (config_file, std_output_dir, output_dir, run_ledger, reload, convert) = params
 
-    # get available VULCAN dir copy
-    available_dir = copy_manager.get_available_copy()
+    # mark run as running in the ledger, unless it has been claimed or done in the meantime
+    name = config_name(config_file)
+    if not run_ledger.start_run(name, worker=f'{socket.gethostname()}:{os.getpid()}'):
+        print(f'{name} is already running or done, skipping')
+        return config_file, None
 
-    # change working directory of this process
-    os.chdir(available_dir)
-    sys.path.append(available_dir)
-
-    # copy config file to VULCAN directory
-    shutil.copyfile(config_file, os.path.join(available_dir, 'vulcan_cfg.py'))
+    # load config file in the VULCAN copy of this worker
+    vulcan_worker = get_vulcan_worker()
+    vulcan_worker.load_config(config_file)
 
     # make std_output redirect file
     cf_name = os.path.basename(config_file)
@@ -48,7 +52,7 @@ def run_vulcan(params):
     )
 
     # set this for vulcan.py
-    sys.argv[0] = os.path.join(available_dir, 'vulcan.py')
+    sys.argv[0] = os.path.join(vulcan_worker.vulcan_dir, 'vulcan.py')
 
     # save output to file
     with open(std_output_file, 'a+') as f:
@@ -56,23 +60,32 @@ def run_vulcan(params):
             with redirect_stderr(f):
                 start = time.time()  # start timer
 
-                # checks if vulcan has been imported already, because importing it runs the code
-                if 'vulcan' in sys.modules.keys():
-                    # reload vulcan submodules
-                    loaded_modules = [k for k in sys.modules.keys()]
-                    for m in loaded_modules:
-                        if m == 'vulcan':
-                            continue
-                        elif m.startswith('vulcan'):
-                            print(f'reload {m}')
-                            importlib.reload(sys.modules[m])
-
-                    # import vulcan to run it
-                    importlib.reload(sys.modules['vulcan'])
-                else:
-                    # import vulcan to run it
-                    import vulcan
-                    # VSCode says import vulcan can't be resolved, but ignore this.
+                try:
+                    if not reload:
+                        # run with the network, modules and cross-sections loaded by this worker
+                        vulcan_worker.run_vulcan()
+                    # fallback, rerun all of vulcan.py (e.g. for a VULCAN version with different steps)
+                    # checks if vulcan has been imported already, because importing it runs the code.
+                    elif 'vulcan' in sys.modules.keys():
+                        # reload vulcan submodules
+                        loaded_modules = [k for k in sys.modules.keys()]
+                        for m in loaded_modules:
+                            if m == 'vulcan':
+                                continue
+                            elif m.startswith('vulcan'):
+                                print(f'reload {m}')
+                                importlib.reload(sys.modules[m])
+
+                        # import vulcan to run it
+                        importlib.reload(sys.modules['vulcan'])
+                    else:
+                        # import vulcan to run it
+                        import vulcan
+                        # VSCode says import vulcan can't be resolved, but ignore this.
+                except BaseException:
+                    # VULCAN exits with sys.exit on some errors
+                    run_ledger.fail_run(name)
+                    raise
 
                 ######## Don't Uncomment This!!!! 
                 ##### Redundant line, VULCAN already runs in block above!!
@@ -82,8 +95,17 @@ def run_vulcan(params):
                 duration = (time.time() - start) / 60.
                 print(f'\nVULCAN run took {duration} minutes')  # save time
 
-    # add VULCAN dir copy back to list
-    copy_manager.add_used_copy(available_dir)
+    # done if VULCAN saved the output
+    output_file = os.path.join(output_dir, output_name(name))
+    status = run_ledger.finish_run(name, output_file)
+    if status != DONE:
+        print(f'{name} finished without output')
+    elif convert:
+        # per key readable copy of the output for generating the dataset, the .vul is kept so this doubles the
+        # storage of the outputs
+        convert_vul(output_file)
+
+    vulcan_worker.finish_task()
 
     # print info
     print(
@@ -91,16 +113,9 @@ def run_vulcan(params):
         f'\n{mp.current_process()}\n'
     )
 
-    return duration
+    return config_file, duration
 
-def string_slicer(my_str,sub):
-   index=my_str.find(sub)
-   if index !=-1 :
-         return my_str[index:]
-   else :
-         raise Exception('Sub string not found!')
-
-def main(batch_size, parallel, workers):
+def main(batch_size, parallel, workers, reload=False, convert=False):
     # setup directories
     script_dir = os.path.dirname(os.path.abspath(__file__))
     parent_dir = str(Path(script_dir).parents[2])
@@ -127,32 +142,23 @@ def main(batch_size, parallel, workers):
     config_files = glob.glob(os.path.join(configs_dir, 'vulcan_cfg*.py'))
     print(f'Found {len(config_files)} config file(s).')
 
-    # Checks for already run:
-    # Create list of completed configs
-    done_files = glob.glob(os.path.join(output_dir, 'output*.vul'))
-    print(f'   Found {len(done_files)} previously run config(s).')
-    # Remove prefixes & suffixes
-    for i,file in enumerate(done_files):
-        file = string_slicer(file,"/output_")
-        file = file.removeprefix("/output_")
-        file = file.removesuffix(".vul")
-        done_files[i] = file
-    # Cross-check with config_files list
-    to_remove = []
-    for file in config_files:
-        filename = string_slicer(file,"/vulcan_cfg_")
-        filename = filename.removeprefix("/vulcan_cfg_")
-        filename = filename.removesuffix(".py")
-        if filename in done_files:
-            to_remove.append(file)
-    # Remove flagged "to_remove" configs from config_files list
-    removed = 0
-    for file in to_remove:
-        if file in config_files:
-            config_files.remove(file)
-            removed +=1
-
-    print(f'   Removed {removed} config(s) from queue.')
+    # Checks for already run, with the run ledger:
+    # add new config files and mark configs with an output from earlier runs as done
+    run_ledger = RunLedger()
+    num_added = run_ledger.add_config_files(config_files)
+    num_synced = run_ledger.sync_outputs(output_dir)
+    num_reset = run_ledger.reset_stale_runs()
+    print(f'   Added {num_added} config(s) to the run ledger, found {num_synced} new output(s), '
+          f'reset {num_reset} crashed run(s).')
+
+    done_configs = run_ledger.configs_with_status(DONE)
+    print(f'   Found {len(done_configs)} previously run config(s).')
+
+    # remove done configs from queue
+    num_configs = len(config_files)
+    config_files = [file for file in config_files if config_name(file) not in done_configs]
+
+    print(f'   Removed {num_configs - len(config_files)} config(s) from queue.')
     print(f'{len(config_files)} config file(s) remaining...')
 
     # create random batch of config files
@@ -161,6 +167,9 @@ def main(batch_size, parallel, workers):
         batch_files = random.sample(config_files, batch_size)
         config_files = batch_files
 
+    # wall times of all runs, used to predict runtimes
+    runtime_log = RuntimeLog(os.path.join(output_dir, 'runtime_log.csv'))
+
     if parallel:
         # number of processes
         if workers:
@@ -168,30 +177,40 @@ def main(batch_size, parallel, workers):
         else:
             num_workers = mp.cpu_count() - 1
 
-        # setup copy manager
-        BaseManager.register('CopyManager', CopyManager)
-        manager = BaseManager()
-        manager.start()
-        mp_copy_manager = manager.CopyManager(num_workers, VULCAN_dir)
+        # setup copy scheduler, every worker leases its own VULCAN copy
+        copy_scheduler = CopyScheduler(num_workers, VULCAN_dir)
+
+        # longest predicted runtime first, so the long runs don't end up in the tail of the batch
+        config_files, _ = schedule_configs(config_files, runtime_log, num_workers)
 
         # make mp params
-        mp_params = [(cf, mp_copy_manager, std_output_dir) for cf in config_files]
+        mp_params = [(cf, std_output_dir, output_dir, run_ledger, reload, convert) for cf in config_files]
 
-        # run mp Pool
+        # run mp Pool, every worker keeps its VULCAN copy
         print(f'Running VULCAN for configs with {num_workers} workers...')
-        with mp.get_context("spawn").Pool(processes=num_workers) as pool:
-            results = list(tqdm(pool.imap(run_vulcan, mp_params),  # return results otherwise it doesn't work properly
-                                total=len(mp_params)))
-            print(f'{len(config_files)} configuration took on average {np.mean(results)} minutes.')
+        with mp.get_context("spawn").Pool(processes=num_workers, initializer=init_vulcan_worker,
+                                          initargs=(copy_scheduler,)) as pool:
+            durations = []
+            for config_file, duration in tqdm(pool.imap_unordered(run_vulcan, mp_params, chunksize=1),
+                                              total=len(mp_params)):
+                if duration is not None:
+                    runtime_log.record(config_file, duration)
+                    durations.append(duration)
+            print(f'{len(config_files)} configuration took on average {np.mean(durations)} minutes.')
+
+        copy_scheduler.print_utilization()
 
     else:
         # if sequential, only 1 copy
-        copy_manager = CopyManager(num_workers=1, VULCAN_dir=VULCAN_dir)
+        copy_scheduler = CopyScheduler(num_workers=1, VULCAN_dir=VULCAN_dir)
+        init_vulcan_worker(copy_scheduler)
 
         # run sequentially
         print('Running VULCAN for configs sequentially...')
         for params in tqdm(config_files):
-            run_vulcan((params, copy_manager, std_output_dir))
+            config_file, duration = run_vulcan((params, std_output_dir, output_dir, run_ledger, reload, convert))
+            if duration is not None:
+                runtime_log.record(config_file, duration)
 
 
 if __name__ == "__main__":
@@ -203,9 +222,14 @@ if __name__ == "__main__":
                         required=False)
     parser.add_argument('-p', '--parallel', help='Whether to use multiprocessing', type=bool, default=True,
                         required=False)
+    parser.add_argument('-r', '--reload', help='Rerun vulcan.py for every config instead of the persistent worker',
+                        action='store_true')
+    parser.add_argument('-c', '--convert', help='Convert every output to h5 after its run', action='store_true')
     args = vars(parser.parse_args())
 
     # run main
     main(batch_size=args['batch'],
          parallel=args['parallel'],
-         workers=args['workers'])
+         workers=args['workers'],
+         reload=args['reload'],
+         convert=args['convert'])
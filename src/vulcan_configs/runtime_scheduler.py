@@ -0,0 +1,140 @@
+import os
+import csv
+import time
+import heapq
+import numpy as np
+
+# config parameters in the config file names, see make_vulcan_configs.make_config
+CONFIG_PARAMETERS = ['orbit_radius', 'r_star', 'planet_mass', 'Z']
+RUNTIME_LOG_FIELDS = ['config_name'] + CONFIG_PARAMETERS + ['duration', 'time']
+
+
+def config_name(config_file):
+    """
+    vulcan_cfg_{orbit_radius}_{r_star}_{planet_mass}_{Z}.py -> {orbit_radius}_{r_star}_{planet_mass}_{Z}
+    """
+    return os.path.basename(config_file).removeprefix('vulcan_cfg_').removesuffix('.py')
+
+
+def config_parameters(config_file):
+    """
+    Parameters of a config, parsed from its file name. Returns None if the name can't be parsed.
+    """
+    values = config_name(config_file).split('_')
+    if len(values) != len(CONFIG_PARAMETERS):
+        return None
+    try:
+        return np.array([float(value) for value in values])
+    except ValueError:
+        return None
+
+
+class RuntimeLog:
+    """
+    Persistent log of VULCAN wall times (in minutes) per config, as a csv file that is appended to.
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+
+        if not os.path.isfile(log_file):
+            with open(log_file, 'w', newline='') as f:
+                csv.writer(f).writerow(RUNTIME_LOG_FIELDS)
+
+    def record(self, config_file, duration):
+        parameters = config_parameters(config_file)
+        if parameters is None:
+            parameters = [np.nan] * len(CONFIG_PARAMETERS)
+
+        with open(self.log_file, 'a', newline='') as f:
+            csv.writer(f).writerow([config_name(config_file), *parameters, duration, time.time()])
+
+    def load(self):
+        """
+        Returns:
+            parameters: (np.ndarray) [num_runs, num_parameters]
+            durations: (np.ndarray) [num_runs] in minutes
+        """
+        parameters = []
+        durations = []
+        with open(self.log_file, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                parameters.append([float(row[key]) for key in CONFIG_PARAMETERS])
+                durations.append(float(row['duration']))
+
+        parameters = np.array(parameters).reshape(-1, len(CONFIG_PARAMETERS))
+        durations = np.array(durations)
+
+        # configs with unparsable names can't be used for fitting
+        valid = np.all(np.isfinite(parameters), axis=1) & (durations > 0)
+        return parameters[valid], durations[valid]
+
+
+def runtime_features(parameters):
+    # runtimes are roughly power laws in the parameters
+    log_parameters = np.log(np.clip(parameters, 1e-10, None))
+    return np.concatenate([np.ones((len(parameters), 1)), log_parameters], axis=1)
+
+
+class RuntimePredictor:
+    """
+    Least-squares fit of the log runtime, linear in the log config parameters. Without enough logged runs it
+    predicts the median (or a constant) runtime for every config, so scheduling falls back to the input order.
+    """
+
+    def __init__(self, parameters, durations, ridge=1e-3):
+        self.coefficients = None
+        self.default = float(np.median(durations)) if len(durations) > 0 else 1.
+
+        features = runtime_features(parameters)
+        if len(durations) > features.shape[1]:
+            # ridge regularized normal equations, without penalizing the intercept
+            penalty = ridge * np.eye(features.shape[1])
+            penalty[0, 0] = 0.
+            self.coefficients = np.linalg.solve(features.T @ features + penalty, features.T @ np.log(durations))
+
+    def predict(self, config_files):
+        predictions = np.full(len(config_files), self.default)
+        if self.coefficients is None:
+            return predictions
+
+        for i, config_file in enumerate(config_files):
+            parameters = config_parameters(config_file)
+            if parameters is not None:
+                predictions[i] = np.exp(runtime_features(parameters[None, :]) @ self.coefficients)[0]
+
+        return predictions
+
+
+def expected_makespan(runtimes, num_workers):
+    """
+    Simulate greedy dispatch of runtimes (in order) to num_workers workers, returns the time the last one finishes.
+    """
+    workers = [0.] * num_workers
+    for runtime in runtimes:
+        heapq.heappush(workers, heapq.heappop(workers) + runtime)
+    return max(workers)
+
+
+def schedule_configs(config_files, runtime_log, num_workers):
+    """
+    Order config files longest-predicted-runtime first (LPT) and report the expected makespan.
+
+    Returns:
+        config_files: (list) sorted config files
+        predictions: (np.ndarray) predicted runtimes in minutes, in the same order
+    """
+    parameters, durations = runtime_log.load()
+    predictor = RuntimePredictor(parameters, durations)
+    predictions = predictor.predict(config_files)
+
+    order = np.argsort(-predictions, kind='stable')
+    config_files = [config_files[i] for i in order]
+    predictions = predictions[order]
+
+    print(f'Predicted runtimes from {len(durations)} logged runs'
+          f'{"" if predictor.coefficients is not None else " (not enough to fit, using median)"}.')
+    print(f'Expected makespan with {num_workers} workers: {expected_makespan(predictions, num_workers) / 60.:.2f} '
+          f'hours (total {np.sum(predictions) / 60.:.2f} CPU hours).')
+
+    return config_files, predictions
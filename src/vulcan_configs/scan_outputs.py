@@ -0,0 +1,203 @@
+import os
+import glob
+import json
+import zlib
+import pickle
+import multiprocessing as mp
+from tqdm import tqdm
+from pathlib import Path
+import argparse
+
+from vul_reader import check_vul, vul_h5_file, is_up_to_date, convert_vul, VulReader
+from runtime_scheduler import config_name
+
+# VULCAN end_case of a run that converged, 2 and 3 mean it hit the runtime or step count limit
+CONVERGED = 1
+
+# status of a scanned output, unverified outputs have no h5 conversion and were not checked in full
+COMPLETE = 'complete'
+TRUNCATED = 'truncated'
+UNVERIFIED = 'unverified'
+
+SCAN_CACHE_FILE = 'scan_cache.json'
+SCAN_REPORT_FILE = 'scan_report.json'
+
+
+def output_file_name(vul_file):
+    """
+    output_{name}.vul -> name
+    """
+    return os.path.basename(vul_file).removeprefix('output_').removesuffix('.vul')
+
+
+def file_crc32(filename, chunk_size=1 << 24):
+    crc = 0
+    with open(filename, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def read_end_case(vul_file, convert=False):
+    """
+    end_case of the parameter block of a complete output. Read from the h5 conversion when there is one (or when
+    convert is set), otherwise the .vul file is unpickled.
+    """
+    if convert:
+        convert_vul(vul_file)
+
+    if is_up_to_date(vul_file, vul_h5_file(vul_file)):
+        with VulReader(vul_file) as reader:
+            if 'end_case' not in reader.keys('parameter'):
+                return None
+            return int(reader.read('parameter', 'end_case'))
+
+    with open(vul_file, 'rb') as handle:
+        parameters = pickle.load(handle)['parameter']
+    end_case = parameters.get('end_case')
+    return None if end_case is None else int(end_case)
+
+
+def scan_output(params):
+    """
+    Check one output. An up to date h5 conversion was made from a complete output, so its end_case is read from
+    there. Other outputs are only recorded as unverified, unless verify is set: then the pickle is checked
+    completely (check_vul), its end_case is read and its crc32 checksum is computed.
+    """
+    (vul_file, convert, verify) = params
+
+    stat = os.stat(vul_file)
+    entry = {
+        'file': vul_file,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'status': UNVERIFIED,
+        'end_case': None,
+        'crc32': None
+    }
+
+    if not (verify or convert or is_up_to_date(vul_file, vul_h5_file(vul_file))):
+        return entry
+
+    if not is_up_to_date(vul_file, vul_h5_file(vul_file)) and not check_vul(vul_file):
+        entry['status'] = TRUNCATED
+    else:
+        try:
+            entry['end_case'] = read_end_case(vul_file, convert=convert)
+            entry['status'] = COMPLETE
+        except Exception:
+            # complete opcodes, but broken in between (unpickling garbage can raise about anything)
+            entry['status'] = TRUNCATED
+
+    if verify:
+        entry['crc32'] = file_crc32(vul_file)
+
+    return entry
+
+
+def load_scan_cache(cache_file):
+    if not os.path.isfile(cache_file):
+        return {}
+    with open(cache_file, 'r') as f:
+        return json.load(f)
+
+
+def save_json(obj, filename):
+    # write to a temporary file first, so an interrupted scan keeps the previous file
+    tmp_file = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_file, filename)
+
+
+def scan_outputs(output_dir, config_dir=None, num_workers=1, cache_file=None, report_file=None, convert=False,
+                 verify=False):
+    """
+    Check all .vul outputs in output_dir in parallel. Results are cached on (path, mtime, size), so only new or
+    changed outputs are scanned again. The scan only reads the h5 conversions, outputs without one are reported
+    as unverified. With verify, those (and new or changed outputs) are read in full: checked for truncation,
+    unpickled for their end_case and checksummed. An output that was verified before is not read again unless
+    its size or mtime changed, if it was complete before and is truncated now it is reported as corrupted.
+
+    Returns:
+        report: dict with the names of missing, truncated, unverified, non-converged and corrupted runs
+    """
+    cache_file = os.path.join(output_dir, SCAN_CACHE_FILE) if cache_file is None else cache_file
+    report_file = os.path.join(output_dir, SCAN_REPORT_FILE) if report_file is None else report_file
+
+    cache = load_scan_cache(cache_file)
+    vul_files = sorted(glob.glob(os.path.join(output_dir, 'output_*.vul')))
+
+    # only scan outputs that are new or changed since the last scan, or still unverified
+    to_scan = []
+    for vul_file in vul_files:
+        stat = os.stat(vul_file)
+        entry = cache.get(vul_file)
+        if entry is None or entry.get('status') is None or entry['size'] != stat.st_size or \
+                entry['mtime_ns'] != stat.st_mtime_ns:
+            to_scan.append(vul_file)
+        elif entry['status'] == UNVERIFIED and (verify or convert or is_up_to_date(vul_file, vul_h5_file(vul_file))):
+            to_scan.append(vul_file)
+
+    print(f'scanning {len(to_scan)} of {len(vul_files)} output(s) with {num_workers} workers...')
+    corrupted = []
+    if len(to_scan) > 0:
+        mp_params = [(vul_file, convert, verify) for vul_file in to_scan]
+        with mp.get_context("spawn").Pool(processes=num_workers) as pool:
+            for result in tqdm(pool.imap_unordered(scan_output, mp_params, chunksize=16), total=len(mp_params)):
+                entry = cache.get(result['file'])
+                if entry is not None and entry.get('status') == COMPLETE and result['status'] == TRUNCATED:
+                    corrupted.append(output_file_name(result['file']))
+                cache[result['file']] = result
+
+    # forget outputs that were removed
+    cache = {vul_file: cache[vul_file] for vul_file in vul_files}
+    save_json(cache, cache_file)
+
+    # make report
+    outputs = {output_file_name(vul_file): entry for vul_file, entry in cache.items()}
+    report = {
+        'output_dir': output_dir,
+        'num_outputs': len(outputs),
+        'missing': [],
+        'truncated': sorted(name for name, entry in outputs.items() if entry['status'] == TRUNCATED),
+        'unverified': sorted(name for name, entry in outputs.items() if entry['status'] == UNVERIFIED),
+        'not_converged': {name: entry['end_case'] for name, entry in sorted(outputs.items())
+                          if entry['status'] == COMPLETE and entry['end_case'] != CONVERGED},
+        'corrupted': sorted(corrupted)
+    }
+
+    if config_dir is not None:
+        config_names = [config_name(config_file) for config_file in glob.glob(os.path.join(config_dir, '*.py'))]
+        report['missing'] = sorted(name for name in config_names if name not in outputs)
+
+    save_json(report, report_file)
+
+    print(f'{report["num_outputs"]} output(s): {len(report["missing"])} missing, {len(report["truncated"])} '
+          f'truncated, {len(report["unverified"])} unverified, {len(report["not_converged"])} not converged, '
+          f'{len(report["corrupted"])} corrupted')
+    print(f'report saved to {report_file}')
+
+    return report
+
+
+if __name__ == "__main__":
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Check VULCAN outputs for missing, truncated and '
+                                                 'non-converged runs')
+    parser.add_argument('-w', '--workers', help='Number of multiprocessing-subprocesses', type=int, default=None,
+                        required=False)
+    parser.add_argument('-c', '--convert', help='Convert outputs to h5 while scanning', action='store_true')
+    parser.add_argument('-v', '--verify', help='Check outputs without an h5 conversion in full', action='store_true')
+    args = vars(parser.parse_args())
+
+    # setup directories
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = str(Path(script_dir).parents[2])
+    output_dir = os.path.join(parent_dir, 'Emulator_VULCAN/data/vulcan_output')
+    configs_dir = os.path.join(parent_dir, 'Emulator_VULCAN/data/configs')
+
+    scan_outputs(output_dir, configs_dir,
+                 num_workers=args['workers'] if args['workers'] else max(mp.cpu_count() - 1, 1),
+                 convert=args['convert'],
+                 verify=args['verify'])
@@ -0,0 +1,252 @@
+import os
+import glob
+import pickle
+import pickletools
+import multiprocessing as mp
+import numpy as np
+import h5py
+from tqdm import tqdm
+from pathlib import Path
+
+# bump when the layout of the converted files changes, older files are converted again
+VUL_H5_VERSION = 1
+
+
+def vul_h5_file(vul_file):
+    """
+    output_{name}.vul -> output_{name}.h5
+    """
+    return os.path.splitext(vul_file)[0] + '.h5'
+
+
+def check_vul(vul_file):
+    """
+    Check that a .vul output was written completely, without building the objects. The opcodes of the pickle are
+    walked up to the STOP of the top-level object, a run that was killed while saving misses data somewhere in
+    the stream, and nothing may follow the STOP.
+
+    Returns:
+        complete: (bool)
+    """
+    if not os.path.isfile(vul_file) or os.path.getsize(vul_file) < 3:
+        return False
+
+    with open(vul_file, 'rb') as f:
+        if f.read(1) != pickle.PROTO:
+            return False
+        f.seek(0)
+
+        try:
+            for opcode, _, _ in pickletools.genops(f):
+                pass
+        except (ValueError, EOFError):    # truncated argument or stream without STOP
+            return False
+
+        return opcode.name == 'STOP' and f.read(1) == b''
+
+
+def is_up_to_date(vul_file, h5_file):
+    """
+    Whether h5_file is a complete conversion of the current vul_file.
+    """
+    if not os.path.isfile(h5_file):
+        return False
+
+    try:
+        with h5py.File(h5_file, 'r') as f:
+            attrs = dict(f.attrs)
+    except OSError:
+        return False
+
+    stat = os.stat(vul_file)
+    return attrs.get('version') == VUL_H5_VERSION and attrs.get('source_size') == stat.st_size and \
+        attrs.get('source_mtime_ns') == stat.st_mtime_ns
+
+
+def save_value(group, key, value):
+    """
+    Save a value of the VULCAN output dicts in an h5 group. Numeric arrays (and lists of them) become datasets,
+    3d arrays like y_time are chunked per time step. Everything else is kept as a pickled blob.
+    """
+    if isinstance(value, dict):
+        subgroup = group.create_group(key)
+        for k, v in value.items():
+            save_value(subgroup, str(k), v)
+        return
+
+    kind = type(value).__name__
+    if isinstance(value, (list, tuple)) and len(value) > 0 and all(isinstance(v, str) for v in value):
+        group.create_dataset(key, data=np.array(value, dtype=h5py.string_dtype()))
+        group[key].attrs['kind'] = kind
+        return
+
+    array = None
+    if isinstance(value, (np.ndarray, list, tuple, int, float, np.number)) and not isinstance(value, bool):
+        try:
+            array = np.asarray(value)
+        except ValueError:    # ragged lists
+            array = None
+        if array is not None and array.dtype.kind not in 'biufc':
+            array = None
+
+    if array is not None:
+        chunks = (1, *array.shape[1:]) if array.ndim == 3 and array.shape[0] > 1 else None
+        group.create_dataset(key, data=array, chunks=chunks)
+    else:
+        group.create_dataset(key, data=np.void(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+        kind = 'pickle'
+
+    group[key].attrs['kind'] = kind
+
+
+def load_value(item, index=None):
+    """
+    Inverse of save_value. With index only those rows (first axis) of an array are read.
+    """
+    if isinstance(item, h5py.Group):
+        return {key: load_value(value) for key, value in item.items()}
+
+    kind = item.attrs.get('kind', 'ndarray')
+    if kind == 'pickle':
+        return pickle.loads(item[()].tobytes())
+
+    if item.dtype.kind == 'O':
+        value = [v.decode() if isinstance(v, bytes) else v for v in item[()]]
+        return tuple(value) if kind == 'tuple' else value
+
+    if index is not None:
+        # h5py needs increasing unique indices
+        index = np.asarray(index)
+        unique, inverse = np.unique(index, return_inverse=True)
+        return item[unique, ...][inverse]
+
+    value = item[()]
+    if kind == 'list':
+        return value.tolist()
+    if kind == 'tuple':
+        return tuple(value.tolist())
+    if kind in ('int', 'float'):
+        return value.item()
+    return value
+
+
+def convert_vul(vul_file, h5_file=None, overwrite=False):
+    """
+    Convert a pickled .vul output into an h5 file with one dataset per key, so single keys (or time steps of
+    y_time) can be read without unpickling the whole simulation state. The h5 file is written to a temporary
+    file first, so a crash never leaves a half written file behind.
+
+    Returns:
+        h5_file: (str) path of the converted file, None if vul_file is incomplete
+    """
+    if h5_file is None:
+        h5_file = vul_h5_file(vul_file)
+
+    if not overwrite and is_up_to_date(vul_file, h5_file):
+        return h5_file
+
+    if not check_vul(vul_file):
+        return None
+
+    stat = os.stat(vul_file)
+    with open(vul_file, 'rb') as handle:
+        data = pickle.load(handle)
+
+    tmp_file = f'{h5_file}.{os.getpid()}.tmp'
+    with h5py.File(tmp_file, 'w') as f:
+        for key, value in data.items():
+            save_value(f, key, value)
+        f.attrs['version'] = VUL_H5_VERSION
+        f.attrs['source_size'] = stat.st_size
+        f.attrs['source_mtime_ns'] = stat.st_mtime_ns
+    os.replace(tmp_file, h5_file)
+
+    return h5_file
+
+
+class VulReader:
+    """
+    Read keys of a VULCAN output, e.g. reader.read('variable', 'y_time', index=[25, 50]).
+
+    Uses the converted h5 file when it is up to date, otherwise the .vul file is converted first (convert=True)
+    or unpickled once and kept in memory (convert=False).
+    """
+
+    def __init__(self, vul_file, convert=False):
+        self.vul_file = vul_file
+        self.h5 = None
+        self.data = None
+
+        h5_file = vul_h5_file(vul_file)
+        if convert:
+            h5_file = convert_vul(vul_file, h5_file)
+            if h5_file is None:
+                raise EOFError(f'{vul_file} is incomplete')
+
+        if h5_file is not None and is_up_to_date(vul_file, h5_file):
+            self.h5 = h5py.File(h5_file, 'r')
+        else:
+            with open(vul_file, 'rb') as handle:
+                self.data = pickle.load(handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+    def keys(self, group=None):
+        source = self.h5 if self.h5 is not None else self.data
+        if group is not None:
+            source = source[group]
+        return list(source.keys())
+
+    def shape(self, group, key):
+        if self.h5 is not None:
+            return self.h5[group][key].shape
+        return np.shape(self.data[group][key])
+
+    def read(self, group, key, index=None):
+        """
+        Args:
+            group: (str) 'variable', 'atm' or 'parameter'
+            key: (str) key in the group
+            index: None or indices into the first axis (e.g. time steps of y_time)
+        """
+        if self.h5 is not None:
+            return load_value(self.h5[group][key], index=index)
+
+        value = self.data[group][key]
+        if index is not None:
+            return np.asarray(value)[np.asarray(index)]
+        return value
+
+
+def convert_outputs(output_dir, num_workers=1):
+    """
+    Convert all complete .vul outputs in output_dir that don't have an up to date h5 file.
+    """
+    vul_files = [file for file in glob.glob(os.path.join(output_dir, '*.vul'))
+                 if not is_up_to_date(file, vul_h5_file(file))]
+
+    print(f'converting {len(vul_files)} .vul file(s) with {num_workers} workers...')
+    with mp.get_context("spawn").Pool(processes=num_workers) as pool:
+        h5_files = list(tqdm(pool.imap_unordered(convert_vul, vul_files), total=len(vul_files)))
+
+    num_incomplete = sum(h5_file is None for h5_file in h5_files)
+    if num_incomplete > 0:
+        print(f'skipped {num_incomplete} incomplete .vul file(s)')
+
+
+if __name__ == "__main__":
+    # setup directories
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = str(Path(script_dir).parents[2])
+    output_dir = os.path.join(parent_dir, 'Emulator_VULCAN/data/vulcan_output')
+
+    convert_outputs(output_dir, num_workers=max(mp.cpu_count() - 1, 1))
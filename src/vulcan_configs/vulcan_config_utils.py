@@ -8,6 +8,14 @@ import multiprocessing as mp
 from tqdm import tqdm
 from pathlib import Path
 import shutil
+import time
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+import hashlib
+import stat
+import psutil
 
 # own modules
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -16,6 +24,20 @@ sys.path.append(src_dir)
 
 import src.vulcan_configs.vulcan_cfg_template as vulcan_cfg_template
 
+# files and directories (relative to the VULCAN dir) that VULCAN writes to, these are private copies in every
+# workspace:
+#   vulcan_cfg.py       the config, copied in for every run
+#   chem_funs.py        made by make_chem_funs.py for the network of the config
+#   *.py                all other code as well (it is small), so no module VULCAN or Python writes is shared
+#   output/             save_out, for a relative vulcan_cfg.output_dir
+#   plot/               plot_dir and movie_dir
+#   fastchem_vulcan/    input and output files of the FastChem run for the initial abundances (ini_mix = 'EQ')
+# Everything else (thermo, network, cross-section and atmosphere data, stellar fluxes) is hardlinked and made
+# read-only, also in the VULCAN dir itself, so a write to a shared file fails instead of changing the original.
+MUTABLE_VULCAN_FILES = ['vulcan_cfg.py', 'chem_funs.py']
+MUTABLE_VULCAN_DIRS = ['output', 'plot', 'fastchem_vulcan']
+WORKSPACE_HASH_FILE = '.workspace_hash'
+
 
 def analytic_MR(M):
     """
@@ -55,11 +77,23 @@ def TP_H14(pco, g, *args_analytical):
     # convert args_analytical tuple to a list so we can modify it
     T_int, T_irr, ka_0, ka_s, beta_s, beta_l = list(args_analytical)
 
-    P_b = vulcan_cfg_template.P_b
-
     # albedo(beta_s) also affects T_irr
     albedo = (1.0 - beta_s) / (1.0 + beta_s)
-    T_irr *= (1 - albedo) ** 0.25
+    T_irr = T_irr * (1 - albedo) ** 0.25   # not in place, T_irr can be a view of an array
+
+    internal_term, irradiation_term = TP_H14_terms(pco, g, T_int, ka_0, ka_s, beta_s, beta_l)
+    T = (internal_term + T_irr ** 4 / 8 * irradiation_term) ** 0.25
+
+    return T
+
+
+def TP_H14_terms(pco, g, T_int, ka_0, ka_s, beta_s, beta_l):
+    """
+    Terms of TP_H14 that don't depend on T_irr: T^4 = internal_term + T_irr^4 / 8 * irradiation_term. They only
+    depend on the gravity (and pressure grid), so they can be shared between configurations.
+    """
+    P_b = vulcan_cfg_template.P_b
+
     eps_L = 3. / 8
     eps_L3 = 1. / 3
     ka_CIA = 0
@@ -71,9 +105,8 @@ def TP_H14(pco, g, *args_analytical):
             ka_s / (ka_l * beta_s) - (ka_CIA) * m * beta_s / (eps_L3 * ka_s * m_0 * beta_l ** 2)))
     term3 = ka_0 * beta_s / (eps_L3 * ka_s * beta_l ** 2) * (1. / 3 - scipy.special.expn(4, ka_s * m / beta_s))
     term4 = 0.  # related to CIA
-    T = (term1 + T_irr ** 4 / 8 * (term2 + term3 + term4)) ** 0.25
 
-    return T
+    return term1, term2 + term3 + term4
 
 
 def calculate_TP(gs, para_anaTP):
@@ -101,7 +134,7 @@ def effective_temperature(R_s):
 
 
 def make_valid_parameters(mp_params):
-    from src.stellar_spectra.CreateSpecGrid import create_specs
+    from src.stellar_spectra.CreateSpecGrid import create_cached_spec, quantize_temperature
 
     (params, sflux_dir) = mp_params
 
@@ -131,12 +164,13 @@ def make_valid_parameters(mp_params):
     if np.max(Tco) > 2500 or np.min(Tco) < 500:
         return None
 
-    # create spectra
-    sflux_file = create_specs([T_eff.value], output_dir=sflux_dir, save_to_txt=True)  # in list because that's what Amy's function uses
+    # create spectra, of T_eff rounded to the resolution of the spectrum cache
+    T_spec = quantize_temperature(T_eff.value)
+    sflux_file = create_cached_spec((T_spec, sflux_dir, None))
 
-    # append to valid parameters
+    # append to valid parameters, with the T_eff of the spectrum
     valid_params = dict(
-        T_eff=T_eff.value,
+        T_eff=T_spec,
         T_irr=T_irr.value,
         sflux_file=str(sflux_file),
         r_star=R_star.value,
@@ -151,19 +185,234 @@ def make_valid_parameters(mp_params):
     return valid_params
 
 
-def make_valid_parameter_grid(parameter_grid, num_workers, sflux_dir):
+def parameter_grid_arrays(parameter_grid):
+    """
+    Parameter grid as a dict of flat float arrays, in the order ParameterGrid iterates (sorted keys, last key
+    varying fastest). Quantities are converted to floats in their own unit.
+    """
+    arrays = {}
+    for sub_grid in parameter_grid.param_grid:
+        keys = sorted(sub_grid.keys())
+        values = [u.Quantity(sub_grid[key]).value for key in keys]
+        for key, array in zip(keys, np.meshgrid(*values, indexing='ij')):
+            arrays.setdefault(key, []).append(array.ravel())
+
+    return {key: np.concatenate(array_list).astype(np.float64) for key, array_list in arrays.items()}
+
+
+def valid_parameter_arrays(orbit_radius, r_star, planet_mass):
+    """
+    Vectorized version of the physics in make_valid_parameters, on plain float arrays.
+
+    Args:
+        orbit_radius: (np.ndarray) [AU]
+        r_star: (np.ndarray) [Rsun]
+        planet_mass: (np.ndarray) [Mjup]
+
+    Returns:
+        valid: (np.ndarray) bool mask of configurations with 500 K <= T <= 2500 K
+        derived: (dict) T_eff [K], T_irr [K], Rp [cm], gs [cm/s^2] for all grid points
+    """
+    # unit conversions, only done once
+    Mjup_to_Mearth = u.Mjup.to(u.Mearth)
+    Rearth_to_Rjup = u.Rearth.to(u.Rjup)
+    Rjup_to_cm = u.Rjup.to(u.cm)
+    Mjup_to_g = u.Mjup.to(u.g)
+    Rsun_to_AU = u.Rsun.to(u.AU)
+    G = c.G.cgs.value
+
+    T_eff = effective_temperature(r_star)
+
+    # analytic_MR
+    M_earth = planet_mass * Mjup_to_Mearth
+    R_earth = np.where(M_earth < 120, 0.70 * M_earth ** 0.63, 17.78 * M_earth ** (-0.044))
+    Rp = R_earth * Rearth_to_Rjup * Rjup_to_cm
+
+    gs = G * planet_mass * Mjup_to_g / Rp ** 2
+    T_irr = irradiation_temperature(T_eff, r_star * Rsun_to_AU, orbit_radius)
+
+    # T-P profiles, the (expensive) terms of TP_H14 only depend on the gravity so are computed per unique gs.
+    # T_int, ka_0, ka_s, beta_s, beta_l of para_warm in make_config
+    T_int, ka_0, ka_s, beta_s, beta_l = 120., 0.1, 0.02, 1., 1.
+    Pco = np.logspace(np.log10(vulcan_cfg_template.P_b), np.log10(vulcan_cfg_template.P_t),
+                      vulcan_cfg_template.nz)
+    unique_gs, gs_index = np.unique(gs, return_inverse=True)
+    internal_term, irradiation_term = TP_H14_terms(Pco[None, :], unique_gs[:, None], T_int, ka_0, ka_s, beta_s,
+                                                   beta_l)
+
+    # per layer T^4 = internal_term + k * irradiation_term, with k = T_irr^4 / 8 (after albedo) and
+    # irradiation_term > 0, so 500 K <= T <= 2500 K in all layers is a range of k per unique gs
+    if np.any(irradiation_term <= 0):
+        raise ValueError('Irradiation term of TP_H14 should be positive!')
+    k_min = np.max((500. ** 4 - internal_term) / irradiation_term, axis=1)
+    k_max = np.min((2500. ** 4 - internal_term) / irradiation_term, axis=1)
+
+    albedo = (1.0 - beta_s) / (1.0 + beta_s)
+    k = (T_irr * (1 - albedo) ** 0.25) ** 4 / 8
+    valid = (k >= k_min[gs_index]) & (k <= k_max[gs_index])
+
+    derived = dict(T_eff=T_eff, T_irr=T_irr, Rp=Rp, gs=gs)
+
+    return valid, derived
+
+
+def make_valid_parameter_grid(parameter_grid, num_workers, sflux_dir, cache_dir=None):
+    """
+    Validate the whole parameter grid at once with numpy, and only make the stellar spectra for the unique
+    effective temperatures of the valid configurations. The spectra are taken from the spectrum cache in
+    cache_dir (data/spectrum_cache by default).
+    """
+    from src.stellar_spectra.CreateSpecGrid import create_specs_parallel, quantize_temperature
+
     print('Making valid parameter grid...')
 
-    mp_params = [(params, sflux_dir) for params in parameter_grid]
+    params = parameter_grid_arrays(parameter_grid)
+
+    valid, derived = valid_parameter_arrays(params['orbit_radius'], params['r_star'], params['planet_mass'])
+    print(f'{np.sum(valid)} of {len(valid)} configurations are valid')
+
+    # create spectra, once per (quantized) effective temperature, before any config is written
+    T_spec = np.array([quantize_temperature(T) for T in derived['T_eff'][valid]])
+    unique_T_eff, T_eff_index = np.unique(T_spec, return_inverse=True)
+    print(f'creating stellar spectra for {len(unique_T_eff)} effective temperatures...')
+    sflux_files = create_specs_parallel(unique_T_eff, output_dir=sflux_dir, num_workers=num_workers,
+                                        cache_dir=cache_dir)
+
+    # valid parameters, with the same keys and types as make_valid_parameters (T_eff of the spectrum)
+    valid_parameter_grid = []
+    for i, index in enumerate(np.flatnonzero(valid)):
+        valid_parameter_grid.append(dict(
+            T_eff=float(unique_T_eff[T_eff_index[i]]),
+            T_irr=float(derived['T_irr'][index]),
+            sflux_file=str(sflux_files[T_eff_index[i]]),
+            r_star=float(params['r_star'][index]),
+            Rp=float(derived['Rp'][index]),
+            planet_mass=float(params['planet_mass'][index]),
+            orbit_radius=float(params['orbit_radius'][index]),
+            gs=float(derived['gs'][index]),
+            Z=float(params['Z'][index]),
+            He_H=float(params['He_H'][index])
+        ))
+
+    return np.array(valid_parameter_grid)
+
+
+def is_mutable_path(rel_path):
+    """
+    Whether rel_path (relative to the VULCAN dir) is written to by VULCAN.
+    """
+    parts = Path(rel_path).parts
+    return rel_path in MUTABLE_VULCAN_FILES or rel_path.endswith('.py') or parts[0] in MUTABLE_VULCAN_DIRS or \
+        '__pycache__' in parts
+
+
+def vulcan_files(VULCAN_dir, mutable):
+    """
+    Sorted relative paths of the (mutable or read-only) files of the VULCAN directory, outside the mutable
+    directories.
+    """
+    selected_files = []
+    for root, dirs, files in os.walk(VULCAN_dir):
+        rel_root = os.path.relpath(root, VULCAN_dir)
+        dirs[:] = [d for d in dirs if d != '__pycache__' and d != '.git' and
+                   not (rel_root == '.' and d in MUTABLE_VULCAN_DIRS)]
+        for file in files:
+            rel_path = os.path.normpath(os.path.join(rel_root, file))
+            if is_mutable_path(rel_path) == mutable:
+                selected_files.append(rel_path)
+    return sorted(selected_files)
+
+
+def shared_vulcan_files(VULCAN_dir):
+    """
+    Sorted relative paths of the read-only files of the VULCAN directory.
+    """
+    return vulcan_files(VULCAN_dir, mutable=False)
+
+
+def make_read_only(path):
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if mode & 0o222:
+        os.chmod(path, mode & ~0o222)
+
+
+def vulcan_dir_hash(VULCAN_dir):
+    """
+    Hash of the shared (data) files of the VULCAN directory, by size and modification time. The code is copied
+    into the workspaces every time.
+    """
+    sha = hashlib.sha1()
+    for rel_path in shared_vulcan_files(VULCAN_dir):
+        file_stat = os.stat(os.path.join(VULCAN_dir, rel_path))
+        sha.update(rel_path.encode())
+        sha.update(f'{file_stat.st_size} {file_stat.st_mtime_ns}'.encode())
+    return sha.hexdigest()
+
+
+def copy_mutable_files(VULCAN_dir, copy_dir):
+    """
+    (Re)copy the files VULCAN writes to, so a workspace starts from the original VULCAN state.
+    """
+    for rel_path in vulcan_files(VULCAN_dir, mutable=True):
+        dst = os.path.join(copy_dir, rel_path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        shutil.copyfile(os.path.join(VULCAN_dir, rel_path), dst)
+
+    for directory in MUTABLE_VULCAN_DIRS:
+        if os.path.isdir(os.path.join(copy_dir, directory)):
+            shutil.rmtree(os.path.join(copy_dir, directory))
+        if os.path.isdir(os.path.join(VULCAN_dir, directory)):
+            shutil.copytree(os.path.join(VULCAN_dir, directory), os.path.join(copy_dir, directory))
+
+
+def make_workspace(VULCAN_dir, copy_dir, source_hash):
+    """
+    Make a VULCAN workspace in copy_dir: read-only files are hardlinked (symlinked across file systems) and only
+    the mutable files are copied. The shared files are made read-only (a hardlink shares the permissions with the
+    original), so VULCAN fails with a PermissionError instead of writing into the VULCAN dir through a link. The
+    hash file is written last, so an interrupted workspace is never reused.
+    """
+    if os.path.isdir(copy_dir):
+        shutil.rmtree(copy_dir)
+
+    for rel_path in shared_vulcan_files(VULCAN_dir):
+        src = os.path.join(VULCAN_dir, rel_path)
+        dst = os.path.join(copy_dir, rel_path)
+        make_read_only(src)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(src, dst)
+        except OSError:
+            os.symlink(os.path.abspath(src), dst)
+
+    copy_mutable_files(VULCAN_dir, copy_dir)
+
+    with open(os.path.join(copy_dir, WORKSPACE_HASH_FILE), 'w') as f:
+        f.write(source_hash)
+
+
+def is_valid_workspace(VULCAN_dir, copy_dir, source_hash):
+    """
+    Whether copy_dir is a complete workspace of the current VULCAN directory.
+    """
+    hash_file = os.path.join(copy_dir, WORKSPACE_HASH_FILE)
+    if not os.path.isfile(hash_file):
+        return False
+
+    with open(hash_file, 'r') as f:
+        if f.read() != source_hash:
+            return False
 
-    with mp.Pool(num_workers) as p:
-        results = list(tqdm(p.imap(make_valid_parameters, mp_params),  # return results otherwise it doesn't work properly
-                            total=len(mp_params)))
+    # all shared files still point to the (read-only) VULCAN files
+    for rel_path in shared_vulcan_files(VULCAN_dir):
+        src = os.path.join(VULCAN_dir, rel_path)
+        dst = os.path.join(copy_dir, rel_path)
+        if not os.path.exists(dst) or not os.path.samefile(src, dst) or os.stat(src).st_mode & 0o222:
+            return False
 
-    valid_parameter_grid = np.array(results).flatten()
-    # remove None values
-    valid_parameter_grid = valid_parameter_grid[valid_parameter_grid != np.array(None)]
-    return valid_parameter_grid
+    return True
 
 
 class CopyManager:
@@ -183,24 +432,30 @@ class CopyManager:
 
     def make_initial_copies(self, num_workers):
         """
-        Make num_workers copies of the VULCAN directory.
+        Make num_workers workspaces of the VULCAN directory. Valid workspaces of earlier runs are reused.
         """
         print(f'making {num_workers} copies of VULCAN...')
 
-        # remake the folder
-        if os.path.isdir(self.copies_base_dir):
-            shutil.rmtree(self.copies_base_dir)
-        os.mkdir(self.copies_base_dir)
+        os.makedirs(self.copies_base_dir, exist_ok=True)
+
+        source_hash = vulcan_dir_hash(self.VULCAN_dir)
 
         # make list of all available dirs
         copy_dir_list = []
 
-        # make copies
+        # make or reuse workspaces
+        num_reused = 0
         for i in tqdm(range(num_workers)):
             copy_dir = os.path.join(self.copies_base_dir, f'VULCAN_{i}')
-            shutil.copytree(self.VULCAN_dir, copy_dir)
+            if is_valid_workspace(self.VULCAN_dir, copy_dir, source_hash):
+                copy_mutable_files(self.VULCAN_dir, copy_dir)
+                num_reused += 1
+            else:
+                make_workspace(self.VULCAN_dir, copy_dir, source_hash)
             copy_dir_list.append(copy_dir)
 
+        print(f'reused {num_reused} of {num_workers} VULCAN copies')
+
         return copy_dir_list
 
     def get_available_copy(self):
@@ -224,4 +479,204 @@ class CopyManager:
         if used_copy not in self.available_copies:
             self.available_copies.append(used_copy)
         else:
-            raise ValueError(f'{used_copy} already in available_copies!')
\ No newline at end of file
+            raise ValueError(f'{used_copy} already in available_copies!')
+
+
+class CopyScheduler(CopyManager):
+    """
+    Pin one VULCAN copy per pool worker without a manager process.
+
+    Copies are leased through lease files in the copies directory, so acquiring a copy needs no IPC. Every change
+    of a lease (acquire, reclaim, renew and release) is done while holding an flock on the lock file of the copy,
+    so checking and taking over a lease is a single step. A lease holds the pid (and its creation time, against
+    pid reuse) of the worker and the time it was last renewed, it is renewed every lease_timeout / 4 seconds by a
+    heartbeat thread of the worker. Leases of dead workers, and leases not renewed within lease_timeout seconds
+    (e.g. of a worker on another host that crashed), are reclaimed by the next worker that needs a copy. Workers
+    save their usage next to the leases, so utilization can be reported at the end of a run.
+    """
+
+    def __init__(self, num_workers, VULCAN_dir, lease_timeout=600., poll_interval=1.):
+        super().__init__(num_workers, VULCAN_dir)
+
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+
+        self.lease_dir = os.path.join(self.copies_base_dir, 'leases')
+        self.usage_dir = os.path.join(self.copies_base_dir, 'usage')
+        for directory in [self.lease_dir, self.usage_dir]:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            os.mkdir(directory)
+
+        self.copies = list(self.available_copies)
+
+        # {copy_dir: threading.Event} stops the heartbeats of the copies leased by this process
+        self.heartbeats = {}
+
+    def __getstate__(self):
+        # heartbeats belong to the process that leased the copies
+        state = self.__dict__.copy()
+        state['heartbeats'] = {}
+        return state
+
+    def lease_file(self, copy_dir):
+        return os.path.join(self.lease_dir, f'{os.path.basename(copy_dir)}.lease')
+
+    @contextmanager
+    def locked(self, lease_file):
+        """
+        Hold the lock of a lease file, all changes to the lease are made while holding it.
+        """
+        with open(f'{lease_file}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def write_lease(self, lease_file):
+        """
+        Write a lease of this process, replaced atomically so a lease is never read half written.
+        """
+        pid = os.getpid()
+        lease = dict(pid=pid, create_time=psutil.Process(pid).create_time(), time=time.time())
+
+        tmp_file = f'{lease_file}.{pid}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(lease, f)
+        os.replace(tmp_file, lease_file)
+
+    @staticmethod
+    def read_lease(lease_file):
+        try:
+            with open(lease_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def is_stale(self, lease):
+        """
+        Whether the worker holding the lease died or stopped renewing it.
+        """
+        try:
+            if psutil.Process(lease['pid']).create_time() != lease['create_time']:
+                return True     # pid reused by another process
+        except psutil.NoSuchProcess:
+            return True
+
+        return self.lease_timeout is not None and time.time() - lease['time'] > self.lease_timeout
+
+    def try_acquire(self):
+        """
+        Lease the first free copy (or the first copy with a stale lease), starting at an offset depending on the
+        pid to avoid contention.
+        """
+        offset = os.getpid() % len(self.copies)
+        for copy_dir in self.copies[offset:] + self.copies[:offset]:
+            lease_file = self.lease_file(copy_dir)
+
+            with self.locked(lease_file):
+                lease = self.read_lease(lease_file)
+                if lease is not None and not self.is_stale(lease):
+                    continue
+                if lease is not None:
+                    print(f'reclaimed {os.path.basename(lease_file)} from pid {lease["pid"]}')
+                self.write_lease(lease_file)
+
+            self.start_heartbeat(copy_dir)
+            return copy_dir
+
+        return None
+
+    def get_available_copy(self, timeout=None):
+        """
+        Lease a copy for this process, waiting until one is free or reclaimed.
+        """
+        start = time.time()
+        while True:
+            copy_dir = self.try_acquire()
+            if copy_dir is not None:
+                return copy_dir
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f'No VULCAN copy available after {timeout} s!')
+            time.sleep(self.poll_interval)
+
+    def renew(self, copy_dir):
+        """
+        Renew the lease of this process on copy_dir.
+        """
+        lease_file = self.lease_file(copy_dir)
+        with self.locked(lease_file):
+            lease = self.read_lease(lease_file)
+            if lease is None or lease['pid'] != os.getpid():
+                raise ValueError(f'{copy_dir} is not leased by this process!')
+            self.write_lease(lease_file)
+
+    def start_heartbeat(self, copy_dir):
+        """
+        Renew the lease on copy_dir from a daemon thread while this process is alive, so long runs keep their copy.
+        """
+        if self.lease_timeout is None:
+            return
+
+        stop = threading.Event()
+        self.heartbeats[copy_dir] = stop
+
+        def heartbeat():
+            while not stop.wait(self.lease_timeout / 4):
+                try:
+                    self.renew(copy_dir)
+                except ValueError:
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+
+    def add_used_copy(self, used_copy):
+        """
+        Release the lease of this process on used_copy.
+        """
+        if used_copy in self.heartbeats:
+            self.heartbeats.pop(used_copy).set()
+
+        lease_file = self.lease_file(used_copy)
+        with self.locked(lease_file):
+            lease = self.read_lease(lease_file)
+            if lease is not None and lease['pid'] == os.getpid():
+                os.remove(lease_file)
+
+    def save_usage(self, copy_dir, usage):
+        """
+        Save the usage dict of this worker, written atomically.
+        """
+        usage = dict(usage, pid=os.getpid(), copy_dir=copy_dir)
+        usage_file = os.path.join(self.usage_dir, f'{os.getpid()}.json')
+        with open(f'{usage_file}.tmp', 'w') as f:
+            json.dump(usage, f)
+        os.replace(f'{usage_file}.tmp', usage_file)
+
+    def utilization(self):
+        """
+        Per worker usage, with utilization the busy fraction of the worker's lifetime.
+        """
+        usages = []
+        for usage_file in sorted(os.listdir(self.usage_dir)):
+            if not usage_file.endswith('.json'):
+                continue
+            with open(os.path.join(self.usage_dir, usage_file), 'r') as f:
+                usage = json.load(f)
+            wall_time = usage['last_time'] - usage['start_time']
+            usage['utilization'] = usage['busy_time'] / wall_time if wall_time > 0 else 0.
+            usages.append(usage)
+        return usages
+
+    def print_utilization(self):
+        usages = self.utilization()
+        if len(usages) == 0:
+            print('no worker usage recorded')
+            return
+
+        print(f'utilization of {len(usages)} workers:')
+        for usage in usages:
+            print(f'    pid {usage["pid"]} ({os.path.basename(usage["copy_dir"])}): {usage["num_tasks"]} tasks, '
+                  f'{usage["busy_time"] / 60.:.1f} min busy, {usage["utilization"]:.1%} utilization')
+        print(f'mean utilization: {np.mean([usage["utilization"] for usage in usages]):.1%}')
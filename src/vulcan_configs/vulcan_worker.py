@@ -0,0 +1,425 @@
+import os
+import sys
+import copy
+import time
+from multiprocessing import util
+import shutil
+import importlib
+import subprocess
+import numpy as np
+from pathlib import Path
+
+# own modules
+script_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = str(Path(script_dir).parents[1])
+sys.path.append(src_dir)
+
+from src.vulcan_configs.flux_resampling import flux_bins, resample_flux
+
+# persistent VULCAN state of this (pool worker) process
+vulcan_worker = None
+
+
+def init_vulcan_worker(copy_scheduler):
+    """
+    Pool initializer: pin a VULCAN copy to this process for its whole lifetime.
+    """
+    global vulcan_worker
+    vulcan_worker = VulcanWorker(copy_scheduler.get_available_copy(), copy_scheduler)
+
+    # release the copy when the worker exits normally, leases of killed workers are reclaimed by the scheduler
+    util.Finalize(vulcan_worker, copy_scheduler.add_used_copy, args=(vulcan_worker.vulcan_dir,), exitpriority=10)
+
+
+def get_vulcan_worker():
+    if vulcan_worker is None:
+        raise ValueError('VULCAN worker not initialized, use init_vulcan_worker as pool initializer!')
+    return vulcan_worker
+
+
+def load_sflux(sflux_file):
+    """
+    Stellar flux of sflux_file like VULCAN reads it (structured array with 'lambda' and 'flux'). Uses the .npy
+    sidecar written by CreateSpecGrid.save_spec when it's present and up to date, instead of parsing the text.
+    """
+    npy_file = os.path.splitext(sflux_file)[0] + '.npy'
+    if os.path.isfile(npy_file) and os.path.getmtime(npy_file) >= os.path.getmtime(sflux_file):
+        return np.load(npy_file)
+
+    return np.genfromtxt(sflux_file, dtype=float, skip_header=1, names=['lambda', 'flux'])
+
+
+def values_equal(a, b):
+    """
+    Deep equality of (nested dicts, lists and tuples of) values and numpy arrays.
+    """
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        if not isinstance(a, np.ndarray) or not isinstance(b, np.ndarray) or a.shape != b.shape:
+            return False
+        return np.array_equal(a, b, equal_nan=a.dtype.kind in 'fc' and b.dtype.kind in 'fc')
+    if isinstance(a, dict) or isinstance(b, dict):
+        return isinstance(a, dict) and isinstance(b, dict) and a.keys() == b.keys() and \
+            all(values_equal(a[key], b[key]) for key in a)
+    if isinstance(a, (list, tuple)) or isinstance(b, (list, tuple)):
+        return type(a) == type(b) and len(a) == len(b) and all(values_equal(x, y) for x, y in zip(a, b))
+    try:
+        return bool(a == b)
+    except Exception:
+        return a is b
+
+
+def changed_attributes(before, obj):
+    """
+    Attributes of obj that were added or changed compared to the (deep) snapshot before, including dicts and
+    lists that were changed in place. Of a dict that was already there only the added or changed items are
+    returned, because the rest of it (e.g. the rates in data_var.k) depends on the config.
+
+    Returns:
+        changed: dict, {name: new value}
+        updated: dict, {name: {key: new value}} items of the dicts that were changed in place
+    """
+    changed = {}
+    updated = {}
+    for key, value in vars(obj).items():
+        if key in before and values_equal(before[key], value):
+            continue
+        if key in before and isinstance(before[key], dict) and isinstance(value, dict):
+            updated[key] = {k: v for k, v in value.items() if k not in before[key] or
+                            not values_equal(before[key][k], v)}
+        else:
+            changed[key] = value
+    return changed, updated
+
+
+def restore_attributes(obj, attributes):
+    """
+    Apply the (changed, updated) attributes of changed_attributes to obj, as copies.
+    """
+    changed, updated = copy.deepcopy(attributes)
+    vars(obj).update(changed)
+    for key, items in updated.items():
+        getattr(obj, key).update(items)
+
+
+def snapshot_attributes(obj):
+    return copy.deepcopy(vars(obj))
+
+
+def cfg_bindings(module, vulcan_cfg):
+    """
+    Names the module bound from vulcan_cfg at import time (from vulcan_cfg import nz), with their values.
+    """
+    return {name: value for name, value in vars(module).items()
+            if not name.startswith('__') and hasattr(vulcan_cfg, name) and getattr(vulcan_cfg, name) is value}
+
+
+class VulcanWorker:
+    """
+    Long-lived VULCAN state of one process, working in its own VULCAN directory copy.
+
+    The VULCAN modules are imported once and only vulcan_cfg is reloaded for every config. chem_funs is made
+    for the network of the first config and only made again when the network changes. Photo cross-sections are
+    read once per stellar flux file (the wavelength bins depend on it) and reused for later configs.
+    """
+
+    def __init__(self, vulcan_dir, copy_scheduler):
+        self.vulcan_dir = vulcan_dir
+        self.copy_scheduler = copy_scheduler
+
+        # change working directory of this process, and make sure this copy is found first
+        os.chdir(vulcan_dir)
+        sys.path.insert(0, vulcan_dir)
+
+        # import VULCAN modules once, with chem_funs made for the network of the config, like vulcan.py does
+        import vulcan_cfg
+        self.vulcan_cfg = vulcan_cfg
+        self.make_chem_funs()
+        import chem_funs
+        import store, build_atm, op
+        import phy_const
+
+        self.chem_funs = chem_funs
+        self.store = store
+        self.build_atm = build_atm
+        self.op = op
+        self.phy_const = phy_const
+
+        # config values the modules bound at import time, they are only reloaded when one of these changes
+        self.bindings = {module: cfg_bindings(module, vulcan_cfg) for module in (store, build_atm, op)}
+
+        # {(sflux_file, ...): (data_var attributes, data_atm attributes)}
+        self.cross_cache = {}
+
+        # usage of this worker
+        self.start_time = time.time()
+        self.task_start = None
+        self.busy_time = 0.
+        self.num_tasks = 0
+
+    def load_config(self, config_file):
+        """
+        Copy config_file to this VULCAN copy and reload it into the imported vulcan_cfg module, so all VULCAN
+        modules see the new parameters. Starts a task of this worker and renews its lease.
+        """
+        self.copy_scheduler.renew(self.vulcan_dir)
+        self.task_start = time.time()
+
+        shutil.copyfile(config_file, os.path.join(self.vulcan_dir, 'vulcan_cfg.py'))
+        importlib.reload(self.vulcan_cfg)
+
+        # the species and reactions of chem_funs (and the modules that import them) depend on the network
+        network_changed = self.vulcan_cfg.network != self.network
+        if network_changed:
+            self.make_chem_funs()
+            importlib.reload(self.chem_funs)
+
+        # modules only see the new config through vulcan_cfg.x, except for values bound at import time
+        # (e.g. from vulcan_cfg import nz), only reload them when one of those changed. All of them, in import
+        # order, because they also bind names from each other
+        if network_changed or any(not values_equal(getattr(self.vulcan_cfg, name, None), value)
+                                  for bindings in self.bindings.values() for name, value in bindings.items()):
+            for module in self.bindings.keys():
+                importlib.reload(module)
+            self.bindings = {module: cfg_bindings(module, self.vulcan_cfg) for module in self.bindings.keys()}
+
+    def make_chem_funs(self):
+        """
+        Make chem_funs.py in this VULCAN copy for the network of the loaded config, like vulcan.py does.
+        """
+        subprocess.check_call([sys.executable, 'make_chem_funs.py'], cwd=self.vulcan_dir, stdout=subprocess.DEVNULL)
+        self.network = self.vulcan_cfg.network
+
+    def unsupported_settings(self):
+        """
+        Settings of the loaded config for which the steps of run_vulcan and ini_vulcan differ from vulcan.py.
+        """
+        vulcan_cfg = self.vulcan_cfg
+
+        unsupported = []
+        if vulcan_cfg.network != self.network:
+            unsupported.append(f'chem_funs is made for {self.network}, not {vulcan_cfg.network}')
+        if vulcan_cfg.use_ion:
+            unsupported.append('use_ion')
+        if vulcan_cfg.use_condense:
+            unsupported.append('use_condense')
+        if vulcan_cfg.T_cross_sp:
+            unsupported.append('T_cross_sp')
+        return unsupported
+
+    def finish_task(self):
+        """
+        Record the task started by load_config in the usage of this worker.
+        """
+        now = time.time()
+        self.busy_time += now - self.task_start
+        self.num_tasks += 1
+        self.task_start = None
+
+        self.copy_scheduler.save_usage(self.vulcan_dir, dict(
+            start_time=self.start_time,
+            last_time=now,
+            busy_time=self.busy_time,
+            num_tasks=self.num_tasks
+        ))
+
+    def read_cross(self, rate, data_var, data_atm):
+        """
+        rate.make_bins_read_cross, cached on the stellar flux file. Temperature dependent cross-sections
+        (T_cross_sp) depend on the T-P profile and are never cached.
+        """
+        vulcan_cfg = self.vulcan_cfg
+
+        if vulcan_cfg.T_cross_sp:
+            rate.make_bins_read_cross(data_var, data_atm)
+            return
+
+        key = (vulcan_cfg.sflux_file, vulcan_cfg.cross_folder, vulcan_cfg.dbin1, vulcan_cfg.dbin2,
+               vulcan_cfg.dbin_12trans, tuple(vulcan_cfg.scat_sp), vulcan_cfg.network)
+
+        if key not in self.cross_cache:
+            var_before = snapshot_attributes(data_var)
+            atm_before = snapshot_attributes(data_atm)
+
+            rate.make_bins_read_cross(data_var, data_atm)
+
+            self.cross_cache[key] = (changed_attributes(var_before, data_var),
+                                     changed_attributes(atm_before, data_atm))
+        else:
+            # copies, because VULCAN may change them in place
+            var_attributes, atm_attributes = self.cross_cache[key]
+            restore_attributes(data_var, var_attributes)
+            restore_attributes(data_atm, atm_attributes)
+
+    def ini_vulcan(self):
+        """
+        Initial steps of a VULCAN simulation for the loaded config, taken from vulcan.py.
+        """
+        unsupported = self.unsupported_settings()
+        if unsupported:
+            raise ValueError(f'ini_vulcan does not support the config: {", ".join(unsupported)}')
+
+        vulcan_cfg = self.vulcan_cfg
+        build_atm = self.build_atm
+        au = self.phy_const.au
+        r_sun = self.phy_const.r_sun
+
+        ### creat the instances for storing the variables and parameters
+        data_var = self.store.Variables()
+        data_atm = self.store.AtmData()
+
+        make_atm = build_atm.Atm()
+
+        # construct pico
+        data_atm = make_atm.f_pico(data_atm)
+        # construct Tco and Kzz
+        data_atm = make_atm.load_TPK(data_atm)
+
+        # Only setting up ms (the species molecular weight) if vulcan_cfg.use_moldiff == False
+        make_atm.mol_diff(data_atm)
+
+        # calculating the saturation pressure
+        if vulcan_cfg.use_condense == True: make_atm.sp_sat(data_atm)
+
+        # read-in network and calculating forward rates (also sets up the photo species)
+        rate = self.op.ReadRate()
+        data_var = rate.read_rate(data_var, data_atm)
+
+        # for low-T rates e.g. Jupiter
+        if vulcan_cfg.use_lowT_limit_rates == True: data_var = rate.lim_lowT_rates(data_var, data_atm)
+
+        # reversing and removing rates
+        data_var = rate.rev_rate(data_var, data_atm)
+        data_var = rate.remove_rate(data_var)
+
+        ini_abun = build_atm.InitialAbun()
+        # initialing y and ymix (the number density and the mixing ratio of every species)
+        data_var = ini_abun.ini_y(data_var, data_atm)
+
+        # storing the initial total number of atmos
+        data_var = ini_abun.ele_sum(data_var)
+
+        # calculating mean molecular weight, dz, and dzi and plotting TP
+        data_atm = make_atm.f_mu_dz(data_var, data_atm, output=None)
+
+        # specify the BC
+        make_atm.BC_flux(data_atm)
+
+        # Setting up for photo chemistry
+        if vulcan_cfg.use_photo == True:
+            self.read_cross(rate, data_var, data_atm)
+
+            # instead of make_atm.read_sflux, which parses the text file and interpolates on the VULCAN bins,
+            # only the raw flux is needed for the 2500 bins below
+            data_atm.sflux_raw = load_sflux(vulcan_cfg.sflux_file)
+
+        # modified vulcan code but with 2500 points so all spectra are uniform, with a cached resampling matrix
+        bins = flux_bins(data_var.bins[0], data_var.bins[-1])
+
+        data_var.sflux_top = resample_flux(data_atm.sflux_raw['lambda'], data_atm.sflux_raw['flux'], bins) * (
+                vulcan_cfg.r_star * r_sun / (au * vulcan_cfg.orbit_radius)) ** 2
+        data_var.bins = bins
+
+        return data_atm, data_var
+
+    def run_vulcan(self):
+        """
+        Run a VULCAN simulation for the loaded config and save its output: the steps of vulcan.py, with the
+        modules imported once by this worker. Unlike running vulcan.py again, chem_funs is not remade and
+        imported, the VULCAN modules are not reloaded (see load_config) and the photo cross-sections are cached
+        (see read_cross). rate.read_rate still runs for every config, because the forward rates depend on the
+        T-P profile.
+
+        Configs with settings that need steps of vulcan.py that are not done here (see unsupported_settings) are
+        run with vulcan.py in a subprocess instead.
+        """
+        unsupported = self.unsupported_settings()
+        if unsupported:
+            print(f'running vulcan.py in a subprocess, not supported by the worker: {", ".join(unsupported)}')
+            self.run_vulcan_subprocess()
+            return
+
+        vulcan_cfg = self.vulcan_cfg
+        build_atm = self.build_atm
+        op = self.op
+
+        ### creat the instances for storing the variables and parameters
+        data_var = self.store.Variables()
+        data_atm = self.store.AtmData()
+        data_para = self.store.Parameters()
+        data_para.start_time = time.time()
+
+        make_atm = build_atm.Atm()
+
+        # for plotting and printing, and save a copy of the config file
+        output = op.Output()
+        output.save_cfg(self.vulcan_dir)
+
+        # construct pico
+        data_atm = make_atm.f_pico(data_atm)
+        # construct Tco and Kzz
+        data_atm = make_atm.load_TPK(data_atm)
+
+        # Only setting up ms (the species molecular weight) if vulcan_cfg.use_moldiff == False
+        make_atm.mol_diff(data_atm)
+
+        # calculating the saturation pressure
+        if vulcan_cfg.use_condense == True: make_atm.sp_sat(data_atm)
+
+        # read-in network and calculating forward rates
+        rate = op.ReadRate()
+        data_var = rate.read_rate(data_var, data_atm)
+
+        # for low-T rates e.g. Jupiter
+        if vulcan_cfg.use_lowT_limit_rates == True: data_var = rate.lim_lowT_rates(data_var, data_atm)
+
+        # reversing and removing rates
+        data_var = rate.rev_rate(data_var, data_atm)
+        data_var = rate.remove_rate(data_var)
+
+        # initialing y and ymix (the number density and the mixing ratio of every species)
+        ini_abun = build_atm.InitialAbun()
+        data_var = ini_abun.ini_y(data_var, data_atm)
+
+        # storing the initial total number of atmos
+        data_var = ini_abun.ele_sum(data_var)
+
+        # calculating mean molecular weight, dz, and dzi and plotting TP
+        data_atm = make_atm.f_mu_dz(data_var, data_atm, output)
+
+        # specify the BC
+        make_atm.BC_flux(data_atm)
+
+        # setting the numerical solver to the desinated one in vulcan_cfg
+        solver = getattr(op, vulcan_cfg.ode_solver)()
+
+        # Setting up for photo chemistry
+        if vulcan_cfg.use_photo == True:
+            self.read_cross(rate, data_var, data_atm)
+            make_atm.read_sflux(data_var, data_atm)
+
+            # computing the optical depth (tau), flux, and the photolisys rates (J) for the first time
+            solver.compute_tau(data_var, data_atm)
+            solver.compute_flux(data_var, data_atm)
+            solver.compute_J(data_var, data_atm)
+
+            # removing rates
+            data_var = rate.remove_rate(data_var)
+
+        integ = op.Integration(solver, output)
+        # Assgining the specific solver corresponding to different B.C.s
+        solver.naming_solver(data_para)
+
+        # Running the integration loop
+        integ(data_var, data_atm, data_para, make_atm)
+
+        output.save_out(data_var, data_atm, data_para, self.vulcan_dir)
+
+    def run_vulcan_subprocess(self):
+        """
+        Run vulcan.py for the loaded config in this VULCAN copy, in a new process. It remakes chem_funs.py for
+        the network of the config, which load_config already did for the modules imported by this worker.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        subprocess.run([sys.executable, 'vulcan.py'], cwd=self.vulcan_dir, stdout=sys.stdout, stderr=sys.stderr,
+                       check=True)